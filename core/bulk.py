@@ -0,0 +1,385 @@
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Tuple
+
+from sqlalchemy.engine import Engine
+
+# COPY's text format: one line per row, tab separated, \N for null, and backslash
+# escapes for anything that would break the framing
+NULL = "\\N"
+ESCAPES = str.maketrans({"\\": "\\\\", "\t": "\\t", "\n": "\\n", "\r": "\\r"})
+
+# what a merge did with each row
+INSERTED = "inserted"
+UPDATED = "updated"
+UNCHANGED = "unchanged"
+
+
+@contextmanager
+def raw_cursor(engine: Engine, *setup: str) -> Iterator[Any]:
+    """
+    a raw psycopg2 cursor from the engine's pool, committed if nothing goes wrong.
+    `setup` runs first, in the same transaction
+    """
+    connection = engine.raw_connection()
+    try:
+        with connection.cursor() as cursor:
+            for statement in setup:
+                cursor.execute(statement)
+            yield cursor
+        connection.commit()
+    except Exception:
+        connection.rollback()
+        raise
+    finally:
+        connection.close()
+
+
+def encode(value: Any) -> str:
+    if value is None:
+        return NULL
+    if isinstance(value, bool):
+        return "t" if value else "f"
+    return str(value).translate(ESCAPES)
+
+
+def copy_lines(rows: Iterable[Tuple]) -> Iterator[str]:
+    for row in rows:
+        yield "\t".join(map(encode, row)) + "\n"
+
+
+# psycopg2's copy_expert reads from a file, so this wraps the rows in one that encodes
+# them as they're read, rather than building the whole payload up front
+class CopyReader:
+    def __init__(self, rows: Iterable[Tuple]):
+        self.lines = copy_lines(rows)
+        self.buffer = ""
+
+    def read(self, size: int = -1) -> str:
+        while size < 0 or len(self.buffer) < size:
+            line = next(self.lines, None)
+            if line is None:
+                break
+            self.buffer += line
+
+        if size < 0:
+            size = len(self.buffer)
+        data, self.buffer = self.buffer[:size], self.buffer[size:]
+        return data
+
+
+def staging_table(table: str) -> str:
+    return f"staging_{table}"
+
+
+def stage(cursor: Any, table: str, columns: Sequence[str]) -> str:
+    """
+    creates a temporary table with the types of `columns` in `table`, but none of its
+    constraints, which lives until the end of the transaction
+    """
+    staging = staging_table(table)
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS "
+        f"SELECT {', '.join(columns)} FROM {table} WITH NO DATA"
+    )
+    return staging
+
+
+def copy_rows(
+    cursor: Any, table: str, columns: Sequence[str], rows: Iterable[Tuple]
+) -> int:
+    """streams rows into `table` with COPY, and returns how many went in"""
+    cursor.copy_expert(
+        f"COPY {table} ({', '.join(columns)}) FROM STDIN", CopyReader(rows)
+    )
+    return cursor.rowcount
+
+
+# how a merge treats the rows that are already there: they're skipped, unless the
+# table tracks columns that change between loads. then a row that conflicts on
+# `conflict` gets the new values of `tracked`, and a new updated_at, but only if one of
+# them actually differs, so the rows that didn't change aren't rewritten
+@dataclass
+class Upsert:
+    conflict: Tuple[str, ...]
+    tracked: Tuple[str, ...]
+
+
+def on_conflict(table: str, upsert: Upsert | None) -> str:
+    if upsert is None:
+        return "ON CONFLICT DO NOTHING"
+    assignments = ", ".join(f"{c} = EXCLUDED.{c}" for c in upsert.tracked)
+    current = ", ".join(f"{table}.{c}" for c in upsert.tracked)
+    excluded = ", ".join(f"EXCLUDED.{c}" for c in upsert.tracked)
+    return (
+        f"ON CONFLICT ({', '.join(upsert.conflict)}) DO UPDATE "
+        f"SET {assignments}, updated_at = now() "
+        f"WHERE ROW({current}) IS DISTINCT FROM ROW({excluded})"
+    )
+
+
+def distinct_on(upsert: Upsert | None, expressions: Dict[str, str]) -> str:
+    """
+    an upsert can't touch the same row twice in one statement, so of the rows with the
+    same conflict key, only one is merged
+    """
+    if upsert is None:
+        return ""
+    return f"DISTINCT ON ({', '.join(expressions[c] for c in upsert.conflict)}) "
+
+
+def distinct_rows(rows: List[Tuple], positions: Sequence[int]) -> List[Tuple]:
+    """the first of the rows with the same values at `positions`"""
+    first: Dict[Tuple, Tuple] = {}
+    for row in rows:
+        first.setdefault(tuple(row[i] for i in positions), row)
+    return list(first.values())
+
+
+def counted(statement: str) -> str:
+    """wraps an INSERT, so it returns how many rows it inserted, and how many updated"""
+    return (
+        f"WITH merged AS ({statement} RETURNING xmax = 0 AS inserted) "
+        "SELECT count(*) FILTER (WHERE inserted), count(*) FILTER (WHERE NOT inserted) "
+        "FROM merged"
+    )
+
+
+def merge(
+    cursor: Any,
+    table: str,
+    columns: Sequence[str],
+    staging: str,
+    upsert: Upsert | None = None,
+) -> Tuple[int, int]:
+    """
+    moves the staged rows into `table` in one statement, skipping or refreshing the
+    ones that conflict with rows already there, and returns how many were inserted,
+    and how many updated
+    """
+    column_list = ", ".join(columns)
+    distinct = distinct_on(upsert, {c: c for c in columns})
+    cursor.execute(
+        counted(
+            f"INSERT INTO {table} ({column_list}) "
+            f"SELECT {distinct}{column_list} FROM {staging} "
+            f"{on_conflict(table, upsert)}"
+        )
+    )
+    return cursor.fetchone()
+
+
+# a foreign key that's resolved inside postgres: the staged `columns` hold the raw
+# values (an import_id, a license name) that match `keys` in the referenced `table`,
+# and the merge swaps them for that row's id, in `target`
+@dataclass
+class Reference:
+    target: str
+    table: str
+    columns: Tuple[str, ...]
+    keys: Tuple[str, ...]
+    # insert the referenced rows that don't exist yet, rather than dropping the row
+    create: bool = False
+    # the target is nullable, so a row without a value for it still goes in
+    optional: bool = False
+    # extra conditions on the referenced table, e.g. the source of a user
+    where: Dict[str, Any] = field(default_factory=dict)
+    # conditions on the row the referenced one belongs to, as the column pointing at
+    # it, its table, and the conditions, e.g. the package manager of a version's package
+    parent: Tuple[str, str, Dict[str, Any]] | None = None
+
+
+# rows whose referenced row isn't there, grouped by reference
+@dataclass
+class Missing:
+    reference: Reference
+    rows: int
+    keys: int
+    sample: List[str]
+
+
+def join_condition(alias: str, reference: Reference) -> Tuple[str, List[Any]]:
+    conditions = [
+        f"{alias}.{key} = s.{column}"
+        for key, column in zip(reference.keys, reference.columns)
+    ]
+    conditions += [f"{alias}.{column} = %s" for column in reference.where]
+    params = list(reference.where.values())
+    if reference.parent:
+        column, table, where = reference.parent
+        conditions.append(
+            f"{alias}.{column} IN (SELECT id FROM {table} WHERE "
+            + " AND ".join(f"{c} = %s" for c in where)
+            + ")"
+        )
+        params += where.values()
+    return " AND ".join(conditions), params
+
+
+def stage_resolved(
+    cursor: Any, table: str, columns: Sequence[str], references: Sequence[Reference]
+) -> str:
+    """
+    like stage, but the columns that belong to a reference take the type of the key
+    they'll be matched against, rather than the type of a column in `table`
+    """
+    sources = {}
+    for i, reference in enumerate(references):
+        for column, key in zip(reference.columns, reference.keys):
+            sources[column] = f"r{i}.{key}"
+
+    select = ", ".join(f"{sources.get(c, f't.{c}')} AS {c}" for c in columns)
+    tables = ", ".join(
+        [f"{table} t"] + [f"{r.table} r{i}" for i, r in enumerate(references)]
+    )
+    staging = staging_table(table)
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging} ON COMMIT DROP AS "
+        f"SELECT {select} FROM {tables} WITH NO DATA"
+    )
+    return staging
+
+
+def create_references(
+    cursor: Any, staging: str, references: Sequence[Reference]
+) -> None:
+    """inserts every referenced row that should be created and isn't there yet"""
+    for reference in references:
+        if not reference.create:
+            continue
+        keys = ", ".join(reference.keys + tuple(reference.where))
+        values = ", ".join(reference.columns + ("%s",) * len(reference.where))
+        not_null = " AND ".join(f"{c} IS NOT NULL" for c in reference.columns)
+        cursor.execute(
+            f"INSERT INTO {reference.table} ({keys}) "
+            f"SELECT DISTINCT {values} FROM {staging} WHERE {not_null} "
+            "ON CONFLICT DO NOTHING",
+            list(reference.where.values()),
+        )
+
+
+def find_missing(
+    cursor: Any, staging: str, references: Sequence[Reference], sample: int = 5
+) -> List[Missing]:
+    """counts the staged rows that reference a row that isn't there, per reference"""
+    missing = []
+    for reference in references:
+        if reference.create:
+            continue
+        condition, params = join_condition("r", reference)
+        key = "concat_ws('/', " + ", ".join(f"s.{c}" for c in reference.columns) + ")"
+        not_null = " AND ".join(f"s.{c} IS NOT NULL" for c in reference.columns)
+        cursor.execute(
+            f"SELECT count(*), count(DISTINCT {key}), "
+            f"(array_agg(DISTINCT {key}))[1:{sample}] "
+            f"FROM {staging} s WHERE {not_null} AND NOT EXISTS "
+            f"(SELECT 1 FROM {reference.table} r WHERE {condition})",
+            params,
+        )
+        rows, keys, examples = cursor.fetchone()
+        if rows:
+            missing.append(Missing(reference, rows, keys, examples))
+    return missing
+
+
+def merge_resolved(
+    cursor: Any,
+    table: str,
+    columns: Sequence[str],
+    staging: str,
+    references: Sequence[Reference],
+    upsert: Upsert | None = None,
+) -> Tuple[int, int]:
+    """
+    like merge, but joins the staged rows to the tables they reference, so their ids
+    are looked up in the same statement. rows with a missing reference are dropped
+    """
+    referenced = {c for reference in references for c in reference.columns}
+    plain = [c for c in columns if c not in referenced]
+
+    targets = plain + [reference.target for reference in references]
+    select = [f"s.{c}" for c in plain] + [f"r{i}.id" for i in range(len(references))]
+    joins, params = [], []
+    for i, reference in enumerate(references):
+        condition, where = join_condition(f"r{i}", reference)
+        join = "LEFT JOIN" if reference.optional else "JOIN"
+        joins.append(f"{join} {reference.table} r{i} ON {condition}")
+        params += where
+
+    distinct = distinct_on(upsert, dict(zip(targets, select)))
+    cursor.execute(
+        counted(
+            f"INSERT INTO {table} ({', '.join(targets)}) "
+            f"SELECT {distinct}{', '.join(select)} FROM {staging} s {' '.join(joins)} "
+            f"{on_conflict(table, upsert)}"
+        ),
+        params,
+    )
+    return cursor.fetchone()
+
+
+def merge_returning(
+    cursor: Any,
+    table: str,
+    columns: Sequence[str],
+    staging: str,
+    key: str,
+    upsert: Upsert | None = None,
+    scope: Sequence[str] = (),
+) -> List[Tuple[Any, Any, str]]:
+    """
+    like merge, but returns (key, id, state) for every staged row, where state is
+    whether it was inserted, updated, or already there as it is. `scope` has the
+    columns the key is only unique within, e.g. the package manager of an import_id
+
+    every part of the statement sees the table as it was before the insert, so the
+    second half only finds the rows that already existed
+    """
+    column_list = ", ".join(columns)
+    distinct = distinct_on(upsert, {c: c for c in columns})
+    matched = (key, *scope)
+    condition = " AND ".join(f"t.{c} = s.{c}" for c in matched)
+    cursor.execute(
+        f"WITH merged AS ("
+        f"INSERT INTO {table} ({column_list}) "
+        f"SELECT {distinct}{column_list} FROM {staging} "
+        f"{on_conflict(table, upsert)} RETURNING {key}, id, xmax = 0 AS inserted) "
+        f"SELECT {key}, id, CASE WHEN inserted THEN '{INSERTED}' ELSE '{UPDATED}' END "
+        "FROM merged "
+        "UNION ALL "
+        f"SELECT t.{key}, t.id, '{UNCHANGED}' FROM {table} t "
+        f"JOIN (SELECT DISTINCT {', '.join(matched)} FROM {staging}) s "
+        f"ON {condition} "
+        f"WHERE NOT EXISTS (SELECT 1 FROM merged m WHERE m.{key} = t.{key})"
+    )
+    return cursor.fetchall()
+
+
+# the keys a reconciliation goes by: every key in the snapshot (`current`), so the rows
+# that aren't among them are gone, or just the keys that were removed from it
+@dataclass
+class Keys:
+    columns: Tuple[str, ...]
+    rows: Iterable[Tuple]
+    current: bool = True
+
+
+def stage_keys(cursor: Any, name: str, keys: Keys) -> str:
+    """copies keys into a temporary table, analyzed, so they can be joined against"""
+    staging = f"keys_{name}"
+    cursor.execute(
+        f"CREATE TEMPORARY TABLE {staging} "
+        f"({', '.join(f'{c} text' for c in keys.columns)}) ON COMMIT DROP"
+    )
+    copy_rows(cursor, staging, keys.columns, keys.rows)
+    cursor.execute(f"ANALYZE {staging}")
+    return staging
+
+
+def gone(keys: Keys, staging: str, condition: str) -> str:
+    """
+    the condition for a row to be gone, given how its key matches a staged one: not
+    among the current keys, which is an anti join, or among the removed ones
+    """
+    exists = f"EXISTS (SELECT 1 FROM {staging} k WHERE {condition})"
+    return f"NOT {exists}" if keys.current else exists
@@ -17,9 +17,14 @@ class PackageManager(Enum):
 TEST = env_vars("TEST", "false")
 FETCH = env_vars("FETCH", "true")
 NO_CACHE = env_vars("NO_CACHE", "true")
+KEEP_ARCHIVE = env_vars("KEEP_ARCHIVE", "false")
+ID_MAPS = env_vars("ID_MAPS", "true")
+FAST_LOAD = env_vars("FAST_LOAD", "false")
+INCREMENTAL = env_vars("INCREMENTAL", "false")
+SHADOW_LOAD = env_vars("SHADOW_LOAD", "false")
 SOURCES = {
     PackageManager.CRATES: "https://static.crates.io/db-dump.tar.gz",
-    PackageManager.HOMEBREW: "https://github.com/Homebrew/homebrew-core/tree/master/Formula",  # noqa
+    PackageManager.HOMEBREW: "https://formulae.brew.sh/api/formula.json",
 }
 
 # The three configuration values URLTypes, DependencyTypes, and UserTypes will query the
@@ -31,14 +36,24 @@ class ExecConf:
     test: bool
     fetch: bool
     no_cache: bool
+    keep_archive: bool
+    id_maps: bool
+    fast_load: bool
+    incremental: bool
+    shadow_load: bool
 
     def __init__(self) -> None:
         self.test = TEST
         self.fetch = FETCH
         self.no_cache = NO_CACHE
+        self.keep_archive = KEEP_ARCHIVE
+        self.id_maps = ID_MAPS
+        self.fast_load = FAST_LOAD
+        self.incremental = INCREMENTAL
+        self.shadow_load = SHADOW_LOAD
 
     def __str__(self):
-        return f"ExecConf(test={self.test},fetch={self.fetch},no_cache={self.no_cache}"
+        return f"ExecConf(test={self.test},fetch={self.fetch},no_cache={self.no_cache},keep_archive={self.keep_archive},id_maps={self.id_maps},fast_load={self.fast_load},incremental={self.incremental},shadow_load={self.shadow_load})"  # noqa
 
 
 class PMConf:
@@ -0,0 +1,186 @@
+import time
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from dataclasses import dataclass, field
+from os import getenv
+from typing import Any, Callable, Dict, List, Set, Tuple, Type
+
+from sqlalchemy.orm.decl_api import DeclarativeMeta
+
+from core.logger import Logger
+from core.pipeline import WRITERS
+
+# how many load stages may run at once
+STAGE_WORKERS = int(getenv("STAGE_WORKERS", 2))
+# how many db connections the stages may hold between them. each stage holds one,
+# and each of its writers another
+DB_CONNECTIONS = int(getenv("DB_CONNECTIONS", STAGE_WORKERS * (WRITERS + 1) + 1))
+
+
+# one step of a load: `run` fills `model`'s table
+#
+# it runs after the stages that fill the tables `model` has foreign keys to, and after
+# the ones named in `after`. stages that read the same `source` (e.g. outputs a
+# transformer fans out of one file) never run at the same time
+@dataclass
+class Stage:
+    name: str
+    run: Callable[[], Any]
+    model: Type[DeclarativeMeta] | None = None
+    after: Tuple[str, ...] = ()
+    source: str | None = None
+    depends_on: Set[str] = field(default_factory=set)
+    started: float = 0.0
+    finished: float = 0.0
+
+    @property
+    def duration(self) -> float:
+        return self.finished - self.started
+
+
+# runs a load's stages as a DAG: whatever has its dependencies done, and its source
+# free, starts as soon as a worker is, within the connection budget
+class DAG:
+    def __init__(
+        self,
+        name: str,
+        stages: List[Stage],
+        workers: int = STAGE_WORKERS,
+        connections: int = DB_CONNECTIONS,
+    ):
+        self.name = name
+        self.stages = {stage.name: stage for stage in stages}
+        self.logger = Logger(f"{name}_dag")
+        # leave one connection for whatever runs outside the stages
+        per_stage = WRITERS + 1
+        self.workers = max(1, min(workers, (connections - 1) // per_stage))
+        self.resolve()
+
+    def resolve(self) -> None:
+        """works out each stage's dependencies, from its model's foreign keys"""
+        writers_of = {
+            stage.model.__tablename__: name
+            for name, stage in self.stages.items()
+            if stage.model is not None
+        }
+
+        for name, stage in self.stages.items():
+            stage.depends_on = set(stage.after)
+            if stage.model is not None:
+                for foreign_key in stage.model.__table__.foreign_keys:
+                    parent = writers_of.get(foreign_key.column.table.name)
+                    if parent and parent != name:
+                        stage.depends_on.add(parent)
+
+            unknown = stage.depends_on - self.stages.keys()
+            if unknown:
+                raise ValueError(f"{name} depends on unknown stages {unknown}")
+
+        self.check_cycles()
+
+    def check_cycles(self) -> None:
+        done: Set[str] = set()
+        remaining = dict(self.stages)
+        while remaining:
+            ready = [n for n, s in remaining.items() if s.depends_on <= done]
+            if not ready:
+                raise ValueError(f"stages {sorted(remaining)} depend on each other")
+            for name in ready:
+                done.add(name)
+                del remaining[name]
+
+    def run(self) -> None:
+        start = time.perf_counter()
+        done: Set[str] = set()
+        running: Dict[Future, Stage] = {}
+        busy_sources: Set[str] = set()
+        error: BaseException | None = None
+
+        def ready() -> List[Stage]:
+            started = done | {stage.name for stage in running.values()}
+            return [
+                stage
+                for name, stage in self.stages.items()
+                if name not in started
+                and stage.depends_on <= done
+                and (stage.source is None or stage.source not in busy_sources)
+            ]
+
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=f"{self.name}-stage"
+        ) as executor:
+            while len(done) < len(self.stages):
+                if error is None:
+                    for stage in ready():
+                        if len(running) >= self.workers:
+                            break
+                        if stage.source in busy_sources:
+                            continue
+                        if stage.source:
+                            busy_sources.add(stage.source)
+                        self.logger.debug(f"starting {stage.name}")
+                        running[executor.submit(self.timed, stage)] = stage
+
+                if not running:
+                    break
+
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    stage = running.pop(future)
+                    busy_sources.discard(stage.source)
+                    if future.exception() is not None:
+                        # let what's running finish, but don't start anything else
+                        self.logger.error(f"{stage.name} failed: {future.exception()}")
+                        error = error or future.exception()
+                    else:
+                        done.add(stage.name)
+
+        if error is not None:
+            raise error
+
+        self.report(time.perf_counter() - start, start)
+
+    @staticmethod
+    def timed(stage: Stage) -> None:
+        stage.started = time.perf_counter()
+        try:
+            stage.run()
+        finally:
+            stage.finished = time.perf_counter()
+
+    def critical_path(self) -> List[Stage]:
+        """
+        the chain of dependent stages that took the longest, start to end: the load
+        can't finish faster than this, however many workers it has
+        """
+        longest: Dict[str, Tuple[float, List[Stage]]] = {}
+
+        def path(name: str) -> Tuple[float, List[Stage]]:
+            if name not in longest:
+                stage = self.stages[name]
+                before = max(
+                    (path(dependency) for dependency in stage.depends_on),
+                    key=lambda p: p[0],
+                    default=(0.0, []),
+                )
+                longest[name] = (before[0] + stage.duration, before[1] + [stage])
+            return longest[name]
+
+        return max((path(name) for name in self.stages), key=lambda p: p[0])[1]
+
+    def report(self, elapsed: float, start: float) -> None:
+        total = sum(stage.duration for stage in self.stages.values())
+        self.logger.log(
+            f"{len(self.stages)} stages in {elapsed:.1f}s, {total:.1f}s of work, "
+            f"{self.workers} at a time"
+        )
+        for stage in sorted(self.stages.values(), key=lambda s: s.started):
+            self.logger.debug(
+                f"{stage.name}: {stage.started - start:.1f}s -> "
+                f"{stage.finished - start:.1f}s ({stage.duration:.1f}s)"
+            )
+
+        path = self.critical_path()
+        self.logger.log(
+            f"critical path ({sum(s.duration for s in path):.1f}s): "
+            + " -> ".join(f"{s.name} ({s.duration:.1f}s)" for s in path)
+        )
@@ -1,12 +1,49 @@
 import os
-from typing import Any, Dict, Iterable, List, Type
+import time
+from functools import partial, wraps
+from threading import Lock
+from typing import (
+    Any,
+    Callable,
+    ContextManager,
+    Dict,
+    Iterable,
+    List,
+    Set,
+    Tuple,
+    Type,
+)
 
+from psycopg2.errors import DeadlockDetected, SerializationFailure
+from psycopg2.extras import execute_values, register_uuid
 from sqlalchemy import UUID, create_engine
 from sqlalchemy.dialects import postgresql
-from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy.orm.decl_api import DeclarativeMeta
 
+from core.bulk import (
+    INSERTED,
+    UPDATED,
+    Keys,
+    Reference,
+    Upsert,
+    copy_rows,
+    create_references,
+    distinct_rows,
+    find_missing,
+    gone,
+    merge,
+    merge_resolved,
+    merge_returning,
+    on_conflict,
+    raw_cursor,
+    stage,
+    stage_keys,
+    stage_resolved,
+)
+from core.dag import DB_CONNECTIONS
+from core.idmap import IdMap
+from core.licenses import normalize_license
 from core.logger import Logger
 from core.models import (
     URL,
@@ -24,354 +61,1033 @@ from core.models import (
     UserVersion,
     Version,
 )
-from core.utils import build_query_params
+from core.pipeline import Pipeline
+from core.sizing import BATCH_SIZE, BatchSizer
+from core.structs import (
+    DEPENDENCIES,
+    PACKAGE_URLS,
+    PACKAGES,
+    URLS,
+    USER_PACKAGES,
+    USER_VERSIONS,
+    USERS,
+    VERSIONS,
+    Batch,
+    Written,
+)
+from core.utils import build_query_params, env_vars
 
 CHAI_DATABASE_URL = os.getenv("CHAI_DATABASE_URL")
-DEFAULT_BATCH_SIZE = 10000
+# copy: COPY each batch into a staging table, then merge it in with one INSERT SELECT
+# insert: one multi-row INSERT per batch
+LOAD_METHOD = os.getenv("LOAD_METHOD", "copy")
+# client: look foreign keys up in the id caches, and send the ids
+# server: send the raw import ids, and resolve them with a join inside postgres. this
+# needs the copy load method, so with insert, ids are always resolved client side
+RESOLVE_IDS = os.getenv("RESOLVE_IDS", "client")
+SERVER_SIDE = LOAD_METHOD == "copy" and RESOLVE_IDS == "server"
+# refresh the columns that change between loads, in the rows that are already there.
+# otherwise, those rows are skipped
+UPSERT = env_vars("UPSERT", "true")
+# those columns, by table, and the unique key that matches a row to the one there.
+# every other table only ever gets new rows
+UPSERTS = {
+    Package.__tablename__: Upsert(("package_manager_id", "import_id"), ("readme",)),
+    Version.__tablename__: Upsert(("package_id", "version"), ("downloads",)),
+}
+# import ids are only unique within a package manager, or a source for users, so the
+# ids of rows that are already there are looked up within the one being loaded
+SCOPES = {
+    Package.__tablename__: "package_manager_id",
+    User.__tablename__: "source_id",
+    # and versions within their package, which is the package manager's
+    Version.__tablename__: "package_id",
+}
+# a snapshot without more than this share of a package manager's packages, versions,
+# or owners is more likely broken than pruned, so nothing is deleted
+MAX_DELETE_FRACTION = float(os.getenv("MAX_DELETE_FRACTION", 0.05))
+
+# so psycopg2 can send uuid.UUIDs as they are
+register_uuid()
+
+# concurrent writers can deadlock on the same unique keys, in which case postgres
+# aborts one of them, which is safe to run again
+DEADLOCK_RETRIES = 3
+
+
+def retry_deadlocks(method: Callable) -> Callable:
+    @wraps(method)
+    def wrapper(self, *args, **kwargs):
+        for attempt in range(1, DEADLOCK_RETRIES + 1):
+            try:
+                return method(self, *args, **kwargs)
+            except (DeadlockDetected, SerializationFailure) as e:
+                if attempt == DEADLOCK_RETRIES:
+                    raise
+                self.logger.warn(f"{e.pgerror.strip()}, retrying ({attempt})")
+
+    return wrapper
 
 
 # ORMs suck, go back to SQL
 class DB:
     def __init__(self):
         self.logger = Logger("DB")
-        self.engine = create_engine(CHAI_DATABASE_URL)
+        # every stage, and every writer in it, holds a connection
+        self.engine = create_engine(CHAI_DATABASE_URL, pool_size=max(5, DB_CONNECTIONS))
         self.session = sessionmaker(self.engine)
         self.logger.debug("connected")
 
         # Initialize caches
-        self.package_cache = {}
-        self.user_cache = {}
-        self.version_cache = {}
-        self.license_cache = {}
-
-    def _cache_objects(
-        self, objects: List[DeclarativeMeta], key_attr: str, value_attr: str
-    ):
-        """cache an object based on a key and value attribute"""
-        return {getattr(obj, key_attr): getattr(obj, value_attr) for obj in objects}
-
-    def _batch_fetch(self, model: Type[DeclarativeMeta], attr: str, values: List[Any]):
-        """fetch a batch of objects based on a list of values for a given attribute"""
+        self.package_cache = IdMap()
+        self.user_cache = IdMap()
+        self.version_cache = IdMap()
+        self.license_cache = IdMap()
+        # keys the current batch looked up and didn't find, so they're looked up once
+        self.misses: Set[Tuple[str, str]] = set()
+
+        # batch sizes, per stage
+        self.sizers: Dict[str, BatchSizer] = {}
+        # the value of each table's column in SCOPES, for the load that's running
+        self.scopes: Dict[str, Any] = {}
+        # how many of the package manager's rows each table has after delete_missing,
+        # and how many keys the snapshot has, when it was given every current one
+        self.loaded: Dict[str, Tuple[int, int]] = {}
+        # packages published again under a new import id, which the packages stage
+        # deletes as it goes, and how many the package manager had before it, so
+        # they count against MAX_DELETE_FRACTION along with the ones delete_missing
+        # finds gone
+        self.republished = 0
+        self.package_count = 0
+        self.republished_lock = Lock()
+
+    def caches(self) -> Dict[str, IdMap]:
+        """the id caches, by the table they map ids of"""
+        return {
+            Package.__tablename__: self.package_cache,
+            User.__tablename__: self.user_cache,
+            Version.__tablename__: self.version_cache,
+            License.__tablename__: self.license_cache,
+        }
+
+    def _cursor(self) -> ContextManager[Any]:
+        """a raw psycopg2 cursor from the pool, committed if nothing goes wrong"""
+        return raw_cursor(self.engine)
+
+    def _fetch_ids(
+        self, model: Type[DeclarativeMeta], key_attr: str, values: List[Any]
+    ) -> Dict[Any, UUID]:
+        """maps a batch of values of a given attribute to their ids, as plain tuples"""
         with self.session() as session:
-            return session.query(model).filter(getattr(model, attr).in_(values)).all()
+            key = getattr(model, key_attr)
+            query = session.query(key, model.id).filter(key.in_(values))
+            if key_attr == "import_id":
+                query = query.filter_by(**self._scope(model.__tablename__))
+            if key_attr == "import_id" and model is Version:
+                packages = self._scope(Package.__tablename__)
+                if packages:
+                    query = query.join(Package, Package.id == Version.package_id)
+                    query = query.filter_by(**packages)
+            return dict(query.all())
+
+    def _scope(self, table: str) -> Dict[str, Any]:
+        """keeps a lookup by import_id within the package manager, or source, loaded"""
+        return {SCOPES[table]: self.scopes[table]} if table in self.scopes else {}
+
+    def _version(self) -> Reference:
+        """
+        the reference to a version by its import_id, which, like a package's, is only
+        unique within the package manager of its package
+        """
+        packages = self._scope(Package.__tablename__)
+        parent = ("package_id", Package.__tablename__, packages) if packages else None
+        return Reference(
+            "version_id",
+            Version.__tablename__,
+            ("version_id",),
+            ("import_id",),
+            parent=parent,
+        )
+
+    def _fetch_url_ids(
+        self, urls: List[Tuple[str, UUID]]
+    ) -> Dict[Tuple[str, UUID], UUID]:
+        """maps a batch of (url, url_type_id) pairs to their ids, in one VALUES join"""
+        stmt = (
+            "SELECT u.url, u.url_type_id, u.id FROM urls u "
+            "JOIN (VALUES %s) AS v (url, url_type_id) "
+            "ON u.url = v.url AND u.url_type_id = v.url_type_id"
+        )
+        with self._cursor() as cursor:
+            rows = execute_values(cursor, stmt, urls, page_size=len(urls), fetch=True)
+        return {(url, url_type_id): id for url, url_type_id, id in rows}
 
     def _process_batch(
-        self, items: List[Dict[str, Any]], process_func: callable
-    ) -> List[DeclarativeMeta]:
-        """process a batch of items, and filter out any Nones"""
-        return [obj for obj in (process_func(item) for item in items) if obj]
+        self, batch: Batch, process_func: Callable[..., Tuple | None]
+    ) -> List[Tuple]:
+        """process a batch of rows, and filter out any Nones"""
+        return [row for row in (process_func(*item) for item in batch.rows) if row]
 
+    def _load(
+        self,
+        name: str,
+        batches: Iterable[Batch],
+        prepare: Callable[[Batch], Callable[[], Written] | None],
+        finish: Callable[[Dict[Any, UUID]], Any] | None = None,
+    ) -> None:
+        """
+        runs a load stage: its batches are re-chunked to the size its sizer picks,
+        and every write is timed, so the sizer can adjust the next ones. `finish` gets
+        the ids each write returned
+        """
+        sizer = self.sizers.get(name)
+        if sizer is None:
+            sizer = BatchSizer(name, BATCH_SIZE, self.logger)
+            self.sizers[name] = sizer
+        sizer.reset()
+
+        def timed(batch: Batch) -> Callable[[], Written] | None:
+            job = prepare(batch)
+            if job is None:
+                return None
+
+            def run() -> Written:
+                start = time.perf_counter()
+                result = job()
+                sizer.record(batch.rows, time.perf_counter() - start)
+                return result
+
+            return run
+
+        written = Written()
+
+        def done(result: Written) -> None:
+            written.add(result)
+            if finish:
+                finish(result.ids)
+
+        Pipeline(name, logger=self.logger).run(sizer.rebatch(batches), timed, done)
+        sizer.report()
+        self.logger.log(f"{name}: {written}")
+
+    @retry_deadlocks
     def _insert_batch(
         self,
         model: Type[DeclarativeMeta],
-        objects: List[Dict[str, Any]],
-    ) -> None:
+        columns: Tuple[str, ...],
+        rows: List[Tuple],
+        key: str | None = None,
+    ) -> Written:
         """
-        inserts a batch of items, any model, into the database
-        however, this mandates `on conflict do nothing`
+        inserts a batch of rows, any model, into the database
+        rows that are already there are skipped, or, for the tables in UPSERTS,
+        refreshed if their tracked columns changed
+
+        with a `key`, it also returns the id of every row in the batch, by that key,
+        whether it was inserted just now or was already there, so the caches can be
+        filled without reading back what was just written
         """
-        # we use statements here, not the ORM because of the on_conflict_do_nothing
-        # https://github.com/sqlalchemy/sqlalchemy/issues/5374
-        with self.session() as session:
-            stmt = insert(model).values(objects).on_conflict_do_nothing()
-            session.execute(stmt)
-            self.logger.debug(f"inserted {len(objects)} objects into {model.__name__}")
-            session.commit()
+        if not rows:
+            return Written()
+
+        # with server side resolution, nothing reads the caches
+        if SERVER_SIDE:
+            key = None
+
+        upsert = self._upsert(model)
+        if LOAD_METHOD == "copy":
+            written = self._copy_batch(model, columns, rows, key, upsert)
+        else:
+            written = self._values_batch(model, columns, rows, key, upsert)
+
+        self.logger.debug(f"{model.__name__}: {written} of {len(rows)}")
+        return written
+
+    @staticmethod
+    def _upsert(model: Type[DeclarativeMeta]) -> Upsert | None:
+        return UPSERTS.get(model.__tablename__) if UPSERT else None
+
+    def _copy_batch(
+        self,
+        model: Type[DeclarativeMeta],
+        columns: Tuple[str, ...],
+        rows: List[Tuple],
+        key: str | None = None,
+        upsert: Upsert | None = None,
+    ) -> Written:
+        """
+        streams the rows into a temporary staging table with COPY, which skips the
+        statement building and parameter binding entirely, and then moves them into
+        the table with a single INSERT ... SELECT, in the same transaction
+        """
+        table = model.__tablename__
+        with self._cursor() as cursor:
+            staging = stage(cursor, table, columns)
+            copy_rows(cursor, staging, columns, rows)
+            if not key:
+                inserted, updated = merge(cursor, table, columns, staging, upsert)
+                return Written(inserted, updated, len(rows) - inserted - updated)
+
+            scope = (SCOPES[table],) if table in SCOPES else ()
+            returned = merge_returning(
+                cursor, table, columns, staging, key, upsert, scope
+            )
+
+        inserted = sum(1 for _, _, state in returned if state == INSERTED)
+        updated = sum(1 for _, _, state in returned if state == UPDATED)
+        return Written(
+            inserted,
+            updated,
+            len(rows) - inserted - updated,
+            {value: id for value, id, _ in returned},
+        )
+
+    @retry_deadlocks
+    def _resolve_batch(
+        self,
+        model: Type[DeclarativeMeta],
+        columns: Tuple[str, ...],
+        rows: List[Tuple],
+        references: Tuple[Reference, ...],
+    ) -> Written:
+        """
+        loads a batch whose foreign keys are still raw import ids: they're staged as
+        they are, and swapped for ids by the merge, with a join. rows whose parent
+        isn't there are reported once per batch, rather than one by one
+        """
+        if not rows:
+            return Written()
+
+        table = model.__tablename__
+        with self._cursor() as cursor:
+            staging = stage_resolved(cursor, table, columns, references)
+            copy_rows(cursor, staging, columns, rows)
+            create_references(cursor, staging, references)
+            for missing in find_missing(cursor, staging, references):
+                self.logger.warn(
+                    f"{missing.rows} {table} rows reference {missing.keys} missing "
+                    f"{missing.reference.table}, e.g. {', '.join(missing.sample)}"
+                )
+            inserted, updated = merge_resolved(
+                cursor, table, columns, staging, references, self._upsert(model)
+            )
+
+        written = Written(inserted, updated, len(rows) - inserted - updated)
+        self.logger.debug(f"{model.__name__}: {written} of {len(rows)}")
+        return written
+
+    def _values_batch(
+        self,
+        model: Type[DeclarativeMeta],
+        columns: Tuple[str, ...],
+        rows: List[Tuple],
+        key: str | None = None,
+        upsert: Upsert | None = None,
+    ) -> Written:
+        # the rows are already tuples in the order of columns, so they go straight to
+        # psycopg2, without an ORM object or a dict per row
+        table = model.__tablename__
+        stmt = (
+            f"INSERT INTO {table} ({', '.join(columns)}) VALUES %s "
+            f"{on_conflict(table, upsert)} "
+            f"RETURNING {f'{key}, id, ' if key else ''}xmax = 0"
+        )
+        merged = rows
+        if upsert:
+            merged = distinct_rows(rows, [columns.index(c) for c in upsert.conflict])
+
+        with self._cursor() as cursor:
+            returned = execute_values(
+                cursor, stmt, merged, page_size=len(merged), fetch=True
+            )
+        inserted = sum(1 for row in returned if row[-1])
+        updated = len(returned) - inserted
+        written = Written(inserted, updated, len(rows) - inserted - updated)
+        if not key:
+            return written
+
+        # RETURNING skips the rows that were already there, so look those up
+        written.ids = {value: id for value, id, _ in returned}
+        i = columns.index(key)
+        existing = [row[i] for row in rows if row[i] not in written.ids]
+        if existing:
+            written.ids.update(self._fetch_ids(model, key, existing))
+        return written
 
     def insert_packages(
         self,
-        package_generator: Iterable[str],
+        package_batches: Iterable[Batch],
         package_manager_id: UUID,
         package_manager_name: str,
-    ) -> List[UUID]:
-        def process_package(item: Dict[str, str]):
-            derived_id = f"{package_manager_name}/{item['name']}"
-            return Package(
-                derived_id=derived_id,
-                name=item["name"],
-                package_manager_id=package_manager_id,
-                import_id=item["import_id"],
-                readme=item["readme"],
-            ).to_dict()
-
-        batch = []
-        for item in package_generator:
-            batch.append(process_package(item))
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self._insert_batch(Package, batch)
-                batch = []
-        if batch:
-            self._insert_batch(Package, batch)
-
-    # TODO: needs explanation or simplification
+    ) -> None:
+        columns = ("derived_id", "name", "package_manager_id", "import_id", "readme")
+        self.scopes[Package.__tablename__] = package_manager_id
+        self.republished = 0
+        with self._cursor() as cursor:
+            cursor.execute(
+                "SELECT count(*) FROM packages WHERE package_manager_id = %s",
+                (package_manager_id,),
+            )
+            (self.package_count,) = cursor.fetchone()
+
+        def prepare(batch: Batch):
+            batch.expect(PACKAGES)
+            rows = [
+                (
+                    f"{package_manager_name}/{name}",
+                    name,
+                    package_manager_id,
+                    import_id,
+                    readme,
+                )
+                for import_id, name, readme in batch.rows
+            ]
+            return partial(self._insert_package_batch, columns, rows)
+
+        self._load(
+            "packages",
+            package_batches,
+            prepare,
+            self.package_cache.update,
+        )
+
+    def _insert_package_batch(
+        self, columns: Tuple[str, ...], rows: List[Tuple]
+    ) -> Written:
+        self._delete_republished(columns, rows)
+        return self._insert_batch(Package, columns, rows, "import_id")
+
+    @retry_deadlocks
+    def _delete_republished(self, columns: Tuple[str, ...], rows: List[Tuple]) -> None:
+        """
+        a package that was deleted, and then published again under the same name,
+        has a new import_id, but the same derived_id. the old one, and everything
+        referencing it, is deleted, so the new one can go in. unless, counting the
+        ones before it, more than MAX_DELETE_FRACTION of the package manager's
+        packages would be, in which case the load fails
+        """
+        derived, import_id = columns.index("derived_id"), columns.index("import_id")
+        with self._cursor() as cursor:
+            cursor.execute(
+                "CREATE TEMPORARY TABLE removed_packages ON COMMIT DROP AS "
+                "SELECT p.id, p.import_id FROM packages p "
+                "JOIN unnest(%s::text[], %s::text[]) AS b (derived_id, import_id) "
+                "ON p.derived_id = b.derived_id WHERE p.import_id <> b.import_id",
+                ([row[derived] for row in rows], [row[import_id] for row in rows]),
+            )
+            republished = cursor.rowcount
+            if not republished:
+                return
+
+            # so concurrent writers don't both get under the limit
+            with self.republished_lock:
+                total = self.republished + republished
+                if total > MAX_DELETE_FRACTION * self.package_count:
+                    raise ValueError(
+                        f"{total} of {self.package_count} packages were published "
+                        f"again under new import ids, more than "
+                        f"{MAX_DELETE_FRACTION:.1%}, not deleting them"
+                    )
+
+                cursor.execute(
+                    "CREATE TEMPORARY TABLE removed_versions ON COMMIT DROP AS "
+                    "SELECT id, import_id FROM versions "
+                    "WHERE package_id IN (SELECT id FROM removed_packages)"
+                )
+                cursor.execute(
+                    "CREATE TEMPORARY TABLE removed_owners ON COMMIT DROP AS "
+                    "SELECT id FROM user_packages "
+                    "WHERE package_id IN (SELECT id FROM removed_packages)"
+                )
+                cursor.execute("SELECT import_id FROM removed_packages")
+                package_ids = [import_id for (import_id,) in cursor.fetchall()]
+                cursor.execute("SELECT import_id FROM removed_versions")
+                version_ids = [import_id for (import_id,) in cursor.fetchall()]
+                deleted = self._delete_removed(cursor)
+                self.republished = total
+
+        self.package_cache.discard(package_ids)
+        self.version_cache.discard(version_ids)
+        self.logger.warn(
+            f"{', '.join(package_ids)} were published again under new import ids, "
+            "deleted "
+            + ", ".join(f"{count} {table}" for table, count in deleted.items())
+        )
+
+    # each cache maps a key (import_id for most, name for licenses) to the id of the
+    # row in our db. before processing a batch, we look up whichever keys in it
+    # aren't cached yet, in a single query
     def _update_cache(
         self,
-        cache: dict,
+        cache: IdMap,
         model: Type[DeclarativeMeta],
         key_attr: str,
-        value_attr: str,
-        items: List[Dict[str, str]],
-        query_param: str,
+        values: List[str],
     ):
-        ids_to_fetch = build_query_params(items, cache, query_param)
+        ids_to_fetch = build_query_params(values, cache)
         if ids_to_fetch:
-            fetched_objects = self._batch_fetch(model, key_attr, list(ids_to_fetch))
-            cache.update(self._cache_objects(fetched_objects, key_attr, value_attr))
+            cache.update(self._fetch_ids(model, key_attr, ids_to_fetch))
+
+    def _cached_id(
+        self, cache: IdMap, model: Type[DeclarativeMeta], key_attr: str, key: str
+    ) -> UUID | None:
+        """
+        a key's id from its cache, or, if the cache evicted it since the batch warmed
+        it, from the database
+        """
+        id = cache.get(key)
+        miss = (model.__tablename__, key)
+        if id is None and miss not in self.misses:
+            id = self._fetch_ids(model, key_attr, [key]).get(key)
+            if id is None:
+                self.misses.add(miss)
+            else:
+                cache[key] = id
+        return id
 
     def update_caches(
         self,
-        items,
-        update_packages=False,
-        update_users=False,
-        update_versions=False,
-        update_licenses=False,
+        batch: Batch,
+        packages: str | None = None,
+        users: str | None = None,
+        versions: str | None = None,
+        licenses: str | None = None,
     ):
-        if update_packages:
-            self._update_cache(
-                self.package_cache, Package, "import_id", "id", items, "crate_id"
-            )
-        if update_users:
+        """warms the caches with the ids referenced by the named columns of a batch"""
+        self.misses.clear()
+        if packages:
             self._update_cache(
-                self.user_cache, User, "import_id", "id", items, "owner_id"
+                self.package_cache, Package, "import_id", batch.column(packages)
             )
-        if update_versions:
+        if users:
+            self._update_cache(self.user_cache, User, "import_id", batch.column(users))
+        if versions:
             self._update_cache(
-                self.version_cache, Version, "import_id", "id", items, "version_id"
+                self.version_cache, Version, "import_id", batch.column(versions)
             )
-        if update_licenses:
+        if licenses:
             self._update_cache(
-                self.license_cache, License, "name", "id", items, "license"
+                self.license_cache, License, "name", batch.column(licenses)
             )
 
-    def insert_versions(self, version_generator: Iterable[dict[str, str]]):
-        batch = []
-        for item in version_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self.update_caches(batch, update_packages=True, update_licenses=True)
-                versions = self._process_batch(batch, self._process_version)
-                self._insert_batch(Version, versions)
-                batch = []
-
-        if batch:
-            self.update_caches(batch, update_packages=True, update_licenses=True)
+    def insert_versions(self, version_batches: Iterable[Batch]):
+        columns = (
+            "package_id",
+            "version",
+            "import_id",
+            "size",
+            "published_at",
+            "license_id",
+            "downloads",
+            "checksum",
+        )
+
+        references = (
+            Reference(
+                "package_id",
+                Package.__tablename__,
+                ("crate_id",),
+                ("import_id",),
+                where=self._scope(Package.__tablename__),
+            ),
+            Reference(
+                "license_id",
+                License.__tablename__,
+                ("license",),
+                ("name",),
+                create=True,
+                optional=True,
+            ),
+        )
+
+        def prepare(batch: Batch):
+            batch.expect(VERSIONS)
+            if SERVER_SIDE:
+                i = VERSIONS.index("license")
+                rows = [
+                    row[:i] + (normalize_license(row[i]),) + row[i + 1 :]
+                    for row in batch.rows
+                ]
+                return partial(self._resolve_batch, Version, VERSIONS, rows, references)
+
+            self.update_caches(batch, packages="crate_id")
+            self._upsert_licenses(batch.column("license"))
             versions = self._process_batch(batch, self._process_version)
-            self._insert_batch(Version, versions)
+            return partial(self._insert_batch, Version, columns, versions, "import_id")
+
+        self._load(
+            "versions",
+            version_batches,
+            prepare,
+            None if SERVER_SIDE else self.version_cache.update,
+        )
 
-    def _process_version(self, item: Dict[str, str]):
-        package_id = self.package_cache.get(item["crate_id"])
+    def _upsert_licenses(self, licenses: List[str]) -> None:
+        """
+        caches the ids of a batch's licenses, by their normalized names, creating the
+        ones that don't exist yet, all in one statement
+        """
+        names = build_query_params(map(normalize_license, licenses), self.license_cache)
+        if not names:
+            return
+
+        # the licenses that were already there aren't in the insert's RETURNING, so
+        # they're selected alongside it, from the snapshot it started with
+        with self._cursor() as cursor:
+            cursor.execute(
+                "WITH names (name) AS (SELECT unnest(%s::text[])), "
+                "created AS ("
+                f"INSERT INTO {License.__tablename__} (name) SELECT name FROM names "
+                "ON CONFLICT (name) DO NOTHING RETURNING name, id) "
+                "SELECT name, id, true FROM created UNION ALL "
+                f"SELECT l.name, l.id, false FROM {License.__tablename__} l "
+                "JOIN names USING (name)",
+                (names,),
+            )
+            rows = cursor.fetchall()
+
+        self.license_cache.update((name, id) for name, id, _ in rows)
+        created = [name for name, _, new in rows if new]
+        if created:
+            self.logger.log(f"created {len(created)} licenses")
+            self.logger.debug(f"created licenses {created}")
+
+        # created by someone else since, so neither inserted nor seen
+        self._update_cache(self.license_cache, License, "name", names)
+
+    def _process_version(
+        self,
+        crate_id: str,
+        version: str,
+        import_id: str,
+        size: int | None,
+        published_at: str,
+        license: str,
+        downloads: int | None,
+        checksum: str,
+    ) -> Tuple | None:
+        package_id = self._cached_id(self.package_cache, Package, "import_id", crate_id)
         if not package_id:
-            self.logger.warn(f"package {item['crate_id']} not found")
+            self.logger.warn(f"package {crate_id} not found")
             return None
 
-        license_id = self.license_cache.get(item["license"])
-        if not license_id:
-            self.logger.log(f"creating an entry for {item['license']}")
-            license_id = self.select_license_by_name(item["license"], create=True)
-            self.license_cache[item["license"]] = license_id
+        # the batch's licenses were all created up front
+        license_id = self._cached_id(
+            self.license_cache, License, "name", normalize_license(license)
+        )
 
-        if package_id is None or item["version"] is None or item["import_id"] is None:
-            self.logger.warn(f"something weird: {item}")
+        if package_id is None or version is None or import_id is None:
+            self.logger.warn(f"something weird: {crate_id}, {version}, {import_id}")
             return None
 
-        return Version(
-            package_id=package_id,
-            version=item["version"],
-            import_id=item["import_id"],
-            size=item["size"],
-            published_at=item["published_at"],
-            license_id=license_id,
-            downloads=item["downloads"],
-            checksum=item["checksum"],
-        ).to_dict()
-
-    def insert_dependencies(self, dependency_generator: Iterable[dict[str, str]]):
-        batch = []
-        for item in dependency_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self.update_caches(batch, update_versions=True, update_packages=True)
-                dependencies = self._process_batch(batch, self._process_depends_on)
-                self._insert_batch(DependsOn, dependencies)
-                batch = []
-
-        if batch:
-            self.update_caches(batch, update_versions=True, update_packages=True)
+        return (
+            package_id,
+            version,
+            import_id,
+            size,
+            published_at,
+            license_id,
+            downloads,
+            checksum,
+        )
+
+    def insert_dependencies(self, dependency_batches: Iterable[Batch]):
+        columns = ("version_id", "dependency_id", "semver_range", "dependency_type_id")
+
+        references = (
+            self._version(),
+            Reference(
+                "dependency_id",
+                Package.__tablename__,
+                ("crate_id",),
+                ("import_id",),
+                where=self._scope(Package.__tablename__),
+            ),
+        )
+
+        def prepare(batch: Batch):
+            batch.expect(DEPENDENCIES)
+            if SERVER_SIDE:
+                return partial(
+                    self._resolve_batch, DependsOn, DEPENDENCIES, batch.rows, references
+                )
+
+            self.update_caches(batch, versions="version_id", packages="crate_id")
             dependencies = self._process_batch(batch, self._process_depends_on)
-            self._insert_batch(DependsOn, dependencies)
-
-    def _process_depends_on(self, item: Dict[str, str]):
-        return DependsOn(
-            version_id=self.version_cache[item["version_id"]],
-            dependency_id=self.package_cache[item["crate_id"]],
-            semver_range=item["semver_range"],
-        ).to_dict()
-
-    def insert_users(self, user_generator: Iterable[dict[str, str]], source_id: UUID):
-        def process_user(item: Dict[str, str]):
-            return User(
-                username=item["username"],
-                import_id=item["import_id"],
-                source_id=source_id,
-            ).to_dict()
-
-        batch = []
-        for item in user_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self._insert_batch(User, self._process_batch(batch, process_user))
-                batch = []
-
-        if batch:
-            self._insert_batch(User, self._process_batch(batch, process_user))
-
-    def insert_user_packages(self, user_package_generator: Iterable[dict[str, str]]):
-        batch = []
-        for item in user_package_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self.update_caches(batch, update_packages=True, update_users=True)
-                user_packages = self._process_batch(batch, self._process_user_package)
-                self._insert_batch(UserPackage, user_packages)
-                batch = []
-
-        if batch:
-            self.update_caches(batch, update_packages=True, update_users=True)
-            user_packages = self._process_batch(batch, self._process_user_package)
-            self._insert_batch(UserPackage, user_packages)
+            return partial(self._insert_batch, DependsOn, columns, dependencies)
+
+        self._load("dependencies", dependency_batches, prepare)
+        self._delete_untyped_dependencies()
 
-    def _process_user_package(self, item: Dict[str, str]):
-        if item["owner_id"] not in self.user_cache:
-            self.logger.warn(f"user {item['owner_id']} not found")
+    def _delete_untyped_dependencies(self) -> None:
+        """
+        loads before dependency types were mapped wrote every dependency with a NULL
+        type, which the unique key can't match, so a reload writes typed rows next to
+        them. the untyped rows of the package manager's versions that have a typed
+        row for the same dependency now are deleted
+        """
+        scope = self._scope(Package.__tablename__)
+        conditions = " AND ".join(f"p.{column} = %s" for column in scope) or "true"
+        with self._cursor() as cursor:
+            cursor.execute(
+                f"DELETE FROM {DependsOn.__tablename__} d "
+                "WHERE d.dependency_type_id IS NULL AND d.version_id IN ("
+                "SELECT v.id FROM versions v JOIN packages p ON p.id = v.package_id "
+                f"WHERE {conditions}) AND EXISTS ("
+                f"SELECT 1 FROM {DependsOn.__tablename__} t "
+                "WHERE t.version_id = d.version_id "
+                "AND t.dependency_id = d.dependency_id "
+                "AND t.dependency_type_id IS NOT NULL)",
+                list(scope.values()),
+            )
+            deleted = cursor.rowcount
+        if deleted:
+            self.logger.log(f"deleted {deleted} untyped dependencies, now typed")
+
+    def _process_depends_on(
+        self,
+        version_id: str,
+        crate_id: str,
+        semver_range: str,
+        dependency_type_id: UUID,
+    ) -> Tuple | None:
+        version = self._cached_id(self.version_cache, Version, "import_id", version_id)
+        if version is None:
+            self.logger.warn(f"version {version_id} not found")
             return None
 
-        if item["crate_id"] not in self.package_cache:
-            self.logger.warn(f"package {item['crate_id']} not found")
+        package = self._cached_id(self.package_cache, Package, "import_id", crate_id)
+        if package is None:
+            self.logger.warn(f"package {crate_id} not found")
             return None
 
-        return UserPackage(
-            user_id=self.user_cache[item["owner_id"]],
-            package_id=self.package_cache[item["crate_id"]],
-        ).to_dict()
+        return (version, package, semver_range, dependency_type_id)
+
+    def insert_users(self, user_batches: Iterable[Batch], source_id: UUID):
+        columns = ("username", "import_id", "source_id")
+        self.scopes[User.__tablename__] = source_id
+
+        def prepare(batch: Batch):
+            batch.expect(USERS)
+            rows = [
+                (username, import_id, source_id)
+                for import_id, username, _ in batch.rows
+            ]
+            return partial(self._insert_batch, User, columns, rows, "import_id")
+
+        self._load("users", user_batches, prepare, self.user_cache.update)
+
+    def insert_user_packages(self, user_package_batches: Iterable[Batch]):
+        columns = ("user_id", "package_id")
+
+        references = (
+            Reference(
+                "user_id",
+                User.__tablename__,
+                ("owner_id",),
+                ("import_id",),
+                where=self._scope(User.__tablename__),
+            ),
+            Reference(
+                "package_id",
+                Package.__tablename__,
+                ("crate_id",),
+                ("import_id",),
+                where=self._scope(Package.__tablename__),
+            ),
+        )
 
-    def insert_user_versions(
-        self, user_version_generator: Iterable[dict[str, str]], source_id: UUID
-    ):
-        version_cache = {}
-        user_cache = {}
+        def prepare(batch: Batch):
+            batch.expect(USER_PACKAGES)
+            if SERVER_SIDE:
+                return partial(
+                    self._resolve_batch,
+                    UserPackage,
+                    USER_PACKAGES,
+                    batch.rows,
+                    references,
+                )
 
-        def fetch_versions_and_users(items: List[Dict[str, str]]):
-            version_ids = build_query_params(items, version_cache, "version_id")
-            user_ids = build_query_params(items, user_cache, "published_by")
+            self.update_caches(batch, packages="crate_id", users="owner_id")
+            user_packages = self._process_batch(batch, self._process_user_package)
+            return partial(self._insert_batch, UserPackage, columns, user_packages)
 
-            if version_ids:
-                versions = self._batch_fetch(Version, "import_id", list(version_ids))
-                version_cache.update(self._cache_objects(versions, "import_id", "id"))
+        self._load("user_packages", user_package_batches, prepare)
 
-            if user_ids:
-                users = self._batch_fetch(User, "import_id", list(user_ids))
-                user_cache.update(self._cache_objects(users, "import_id", "id"))
+    def _process_user_package(self, crate_id: str, owner_id: str) -> Tuple | None:
+        user = self._cached_id(self.user_cache, User, "import_id", owner_id)
+        if user is None:
+            self.logger.warn(f"user {owner_id} not found")
+            return None
+
+        package = self._cached_id(self.package_cache, Package, "import_id", crate_id)
+        if package is None:
+            self.logger.warn(f"package {crate_id} not found")
+            return None
 
-        def process_user_version(item: Dict[str, str]):
-            user_id = user_cache.get(item["published_by"])
+        return (user, package)
+
+    def insert_user_versions(
+        self, user_version_batches: Iterable[Batch], source_id: UUID
+    ):
+        columns = ("user_id", "version_id")
+
+        def process_user_version(version_id: str, published_by: str):
+            user_id = self._cached_id(self.user_cache, User, "import_id", published_by)
             if not user_id:
-                self.logger.warn(f"user_id not found for {item['published_by']}")
+                self.logger.warn(f"user_id not found for {published_by}")
                 return None
 
-            version_id = version_cache.get(item["version_id"])
-            if not version_id:
-                self.logger.warn(f"version_id not found for {item['version_id']}")
+            version_uuid = self._cached_id(
+                self.version_cache, Version, "import_id", version_id
+            )
+            if not version_uuid:
+                self.logger.warn(f"version_id not found for {version_id}")
                 return None
 
-            return UserVersion(
-                user_id=user_id,
-                version_id=version_id,
-            ).to_dict()
-
-        batch = []
-        for item in user_version_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                fetch_versions_and_users(batch)
-                self._insert_batch(
-                    UserVersion, self._process_batch(batch, process_user_version)
+            return (user_id, version_uuid)
+
+        references = (
+            self._version(),
+            Reference(
+                "user_id",
+                User.__tablename__,
+                ("published_by",),
+                ("import_id",),
+                where={"source_id": source_id},
+            ),
+        )
+
+        def prepare(batch: Batch):
+            batch.expect(USER_VERSIONS)
+            if SERVER_SIDE:
+                return partial(
+                    self._resolve_batch,
+                    UserVersion,
+                    USER_VERSIONS,
+                    batch.rows,
+                    references,
                 )
-                batch = []
 
-        if batch:
-            fetch_versions_and_users(batch)
-            self._insert_batch(
-                UserVersion, self._process_batch(batch, process_user_version)
-            )
+            # insert_users and insert_versions leave these warm
+            self.update_caches(batch, versions="version_id", users="published_by")
+            user_versions = self._process_batch(batch, process_user_version)
+            return partial(self._insert_batch, UserVersion, columns, user_versions)
 
-    def insert_urls(self, url_generator: Iterable[str]):
-        def process_url(item: Dict[str, str]):
-            return URL(url=item["url"], url_type_id=item["url_type_id"]).to_dict()
+        self._load("user_versions", user_version_batches, prepare)
 
-        batch = []
-        for item in url_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                self._insert_batch(URL, self._process_batch(batch, process_url))
-                batch = []
+    def insert_urls(self, url_batches: Iterable[Batch]):
+        def prepare(batch: Batch):
+            batch.expect(URLS)
+            return partial(self._insert_batch, URL, URLS, batch.rows)
 
-        if batch:
-            self._insert_batch(URL, self._process_batch(batch, process_url))
+        self._load("urls", url_batches, prepare)
 
-    def insert_package_urls(self, package_url_generator: Iterable[dict[str, str]]):
+    def insert_package_urls(self, package_url_batches: Iterable[Batch]):
+        columns = ("package_id", "url_id")
         url_cache: Dict[tuple[str, str], UUID] = {}
 
-        def fetch_packages_and_urls(items: List[Dict[str, str]]):
-            package_ids = build_query_params(items, self.package_cache, "import_id")
-
-            if package_ids:
-                packages = self._batch_fetch(Package, "import_id", list(package_ids))
-                self.package_cache.update(
-                    self._cache_objects(packages, "import_id", "id")
-                )
+        def fetch_packages_and_urls(batch: Batch):
+            self.update_caches(batch, packages="import_id")
 
-            # for url ids, we can't use batch_fetch, because we need to provide the
+            # for url ids, we can't use _fetch_ids, because we need to provide the
             # url_type_id in addition to the url string itself
-            # so, let's do it the old fashioned way
-            for item in items:
-                url = item["url"]
-                url_type_id = item["url_type_id"]
-                if (url, url_type_id) not in url_cache:
-                    url_cache[(url, url_type_id)] = self.select_url_by_url_and_type(
-                        url, url_type_id
-                    ).id
-
-        def process_package_url(item: Dict[str, str]):
-            package_id = self.package_cache.get(item["import_id"])
+            urls = {(url, url_type_id) for _, url, url_type_id in batch.rows}
+            urls_to_fetch = [key for key in urls if key not in url_cache]
+            if urls_to_fetch:
+                url_cache.update(self._fetch_url_ids(urls_to_fetch))
+
+        def process_package_url(import_id: str, url: str, url_type_id: UUID):
+            package_id = self._cached_id(
+                self.package_cache, Package, "import_id", import_id
+            )
             if not package_id:
-                self.logger.warn(f"package_id not found for {item['import_id']}")
+                self.logger.warn(f"package_id not found for {import_id}")
                 return None
 
-            url_id = url_cache.get((item["url"], item["url_type_id"]))
+            url_id = url_cache.get((url, url_type_id))
             if not url_id:
-                self.logger.warn(f"url_id not found for {item['url']}")
+                self.logger.warn(f"url_id not found for {url}")
                 return None
 
-            return PackageURL(
-                package_id=package_id,
-                url_id=url_id,
-            ).to_dict()
-
-        batch = []
-        for item in package_url_generator:
-            batch.append(item)
-            if len(batch) == DEFAULT_BATCH_SIZE:
-                fetch_packages_and_urls(batch)
-                self._insert_batch(
-                    PackageURL, self._process_batch(batch, process_package_url)
+            return (package_id, url_id)
+
+        references = (
+            Reference(
+                "package_id",
+                Package.__tablename__,
+                ("import_id",),
+                ("import_id",),
+                where=self._scope(Package.__tablename__),
+            ),
+            Reference(
+                "url_id",
+                URL.__tablename__,
+                ("url", "url_type_id"),
+                ("url", "url_type_id"),
+            ),
+        )
+
+        def prepare(batch: Batch):
+            batch.expect(PACKAGE_URLS)
+            if SERVER_SIDE:
+                return partial(
+                    self._resolve_batch,
+                    PackageURL,
+                    PACKAGE_URLS,
+                    batch.rows,
+                    references,
                 )
-                batch = []
 
-        if batch:
             fetch_packages_and_urls(batch)
-            self._insert_batch(
-                PackageURL, self._process_batch(batch, process_package_url)
+            package_urls = self._process_batch(batch, process_package_url)
+            return partial(self._insert_batch, PackageURL, columns, package_urls)
+
+        self._load("package_urls", package_url_batches, prepare)
+
+    @staticmethod
+    def _delete_removed(cursor: Any) -> Dict[str, int]:
+        """
+        deletes the rows in the removed_packages, removed_versions and removed_owners
+        temporary tables, and every row referencing them, children first, so no
+        foreign key is ever left dangling
+        """
+        deleted: Dict[str, int] = {}
+        for table, condition in (
+            (
+                DependsOn.__tablename__,
+                "version_id IN (SELECT id FROM removed_versions) "
+                "OR dependency_id IN (SELECT id FROM removed_packages)",
+            ),
+            (
+                UserVersion.__tablename__,
+                "version_id IN (SELECT id FROM removed_versions)",
+            ),
+            (Version.__tablename__, "id IN (SELECT id FROM removed_versions)"),
+            (UserPackage.__tablename__, "id IN (SELECT id FROM removed_owners)"),
+            (
+                PackageURL.__tablename__,
+                "package_id IN (SELECT id FROM removed_packages)",
+            ),
+            (Package.__tablename__, "id IN (SELECT id FROM removed_packages)"),
+        ):
+            cursor.execute(f"DELETE FROM {table} WHERE {condition}")
+            deleted[table] = cursor.rowcount
+        return deleted
+
+    def delete_missing(
+        self,
+        package_manager_id: UUID,
+        packages: Keys,
+        versions: Keys,
+        user_packages: Keys,
+    ) -> Dict[str, int]:
+        """
+        deletes a package manager's packages, versions and owners that its snapshot
+        doesn't have anymore, along with every row referencing them, in bulk, in one
+        transaction. packages and versions go by import_id, and owners by the import
+        ids of the package and the user (crate_id, owner_id)
+        """
+        params = (package_manager_id,)
+        self.loaded = {}
+        with self._cursor() as cursor:
+            staged_packages = stage_keys(cursor, "packages", packages)
+            staged_versions = stage_keys(cursor, "versions", versions)
+            staged_owners = stage_keys(cursor, "user_packages", user_packages)
+
+            # what's gone, and what goes with it
+            cursor.execute(
+                "CREATE TEMPORARY TABLE removed_packages ON COMMIT DROP AS "
+                "SELECT p.id, p.import_id FROM packages p "
+                "WHERE p.package_manager_id = %s AND "
+                + gone(packages, staged_packages, "k.import_id = p.import_id"),
+                params,
             )
+            cursor.execute(
+                "CREATE TEMPORARY TABLE removed_versions ON COMMIT DROP AS "
+                "SELECT id, import_id, missing FROM ("
+                "SELECT v.id, v.import_id, v.package_id, "
+                + gone(versions, staged_versions, "k.import_id = v.import_id")
+                + " AS missing FROM versions v "
+                "JOIN packages p ON p.id = v.package_id "
+                "WHERE p.package_manager_id = %s) v "
+                "WHERE missing OR package_id IN (SELECT id FROM removed_packages)",
+                params,
+            )
+            cursor.execute(
+                "CREATE TEMPORARY TABLE removed_owners ON COMMIT DROP AS "
+                "SELECT id, missing FROM ("
+                "SELECT up.id, up.package_id, "
+                + gone(
+                    user_packages,
+                    staged_owners,
+                    "k.crate_id = p.import_id AND k.owner_id = u.import_id",
+                )
+                + " AS missing FROM user_packages up "
+                "JOIN packages p ON p.id = up.package_id "
+                "JOIN users u ON u.id = up.user_id "
+                "WHERE p.package_manager_id = %s) up "
+                "WHERE missing OR package_id IN (SELECT id FROM removed_packages)",
+                params,
+            )
+
+            # the rows that are gone themselves, against all of the package manager's.
+            # the ones that only go with their package don't count, and the packages
+            # the packages stage deleted, since they were published again, do
+            cursor.execute(
+                "SELECT "
+                "(SELECT count(*) FROM removed_packages), "
+                "(SELECT count(*) FROM packages WHERE package_manager_id = %s), "
+                "(SELECT count(*) FROM removed_versions WHERE missing), "
+                "(SELECT count(*) FROM versions v JOIN packages p "
+                "ON p.id = v.package_id WHERE p.package_manager_id = %s), "
+                "(SELECT count(*) FROM removed_owners WHERE missing), "
+                "(SELECT count(*) FROM user_packages up JOIN packages p "
+                "ON p.id = up.package_id WHERE p.package_manager_id = %s)",
+                params * 3,
+            )
+            counts = cursor.fetchone()
+            for table, missing, total in (
+                ("packages", counts[0] + self.republished, counts[1]),
+                ("versions", counts[2], counts[3]),
+                ("user_packages", counts[4], counts[5]),
+            ):
+                if missing > MAX_DELETE_FRACTION * total:
+                    self.logger.error(
+                        f"{missing} of {total} {table} are gone from the snapshot, "
+                        f"more than {MAX_DELETE_FRACTION:.1%}, not deleting anything"
+                    )
+                    return {}
+
+            cursor.execute("SELECT import_id FROM removed_packages")
+            package_ids = [import_id for (import_id,) in cursor.fetchall()]
+            cursor.execute("SELECT import_id FROM removed_versions")
+            version_ids = [import_id for (import_id,) in cursor.fetchall()]
+
+            deleted = self._delete_removed(cursor)
+
+            # what's left is the rows the snapshot has, unless the load lost some
+            for table, keys, staged, total in (
+                ("packages", packages, staged_packages, counts[1]),
+                ("versions", versions, staged_versions, counts[3]),
+                ("user_packages", user_packages, staged_owners, counts[5]),
+            ):
+                if keys.current:
+                    cursor.execute(
+                        f"SELECT count(*) FROM (SELECT DISTINCT * FROM {staged}) k"
+                    )
+                    (source,) = cursor.fetchone()
+                    self.loaded[table] = (total - deleted[table], source)
+
+        # so nothing resolves to the rows that are gone
+        self.package_cache.discard(package_ids)
+        self.version_cache.discard(version_ids)
+
+        self.logger.log(
+            "deleted "
+            + ", ".join(f"{count} {table}" for table, count in deleted.items())
+        )
+        return deleted
 
     def insert_source(self, name: str) -> Source:
         with self.session() as session:
@@ -395,6 +1111,17 @@ class DB:
             session.add(LoadHistory(package_manager_id=package_manager_id))
             session.commit()
 
+    def select_latest_load_history(
+        self, package_manager_id: UUID
+    ) -> LoadHistory | None:
+        with self.session() as session:
+            return (
+                session.query(LoadHistory)
+                .filter_by(package_manager_id=package_manager_id)
+                .order_by(LoadHistory.created_at.desc())
+                .first()
+            )
+
     def insert_url_types(self, name: str) -> URLType:
         with self.session() as session:
             session.add(URLType(name=name))
@@ -0,0 +1,97 @@
+from hashlib import blake2b
+from typing import Any, Callable, Iterable, Iterator, List, Tuple
+
+from core.idmap import Table
+from core.logger import Logger
+
+# what separates the values of a row, when it's hashed
+SEPARATOR = "\x1f"
+
+
+def row_digest(values: Iterable[str]) -> bytes:
+    return blake2b(SEPARATOR.join(values).encode(), digest_size=16).digest()
+
+
+def picker(header: List[str], columns: Tuple[str, ...]) -> Callable[[List], Any]:
+    """picks `columns` out of a csv row: the value, for one, or a tuple of them"""
+    indices = [header.index(column) for column in columns]
+    if len(indices) == 1:
+        i = indices[0]
+        return lambda row: row[i]
+    return lambda row: tuple(row[i] for i in indices)
+
+
+# compares a raw file in the latest snapshot with the same file in an earlier one, by
+# its primary key, and a hash of the columns that are read from it
+#
+# the earlier file's rows are loaded first, as key -> 16 byte digest, in the same flat
+# tables the id maps use. then `filter` streams the latest file, passing on the rows
+# that are new (inserted), or whose hash changed (updated), and once it's through,
+# the keys it never saw are the rows that were deleted
+class FileDiff:
+    def __init__(
+        self,
+        name: str,
+        key: Tuple[str, ...],
+        columns: Tuple[str, ...],
+        logger: Logger | None = None,
+    ):
+        self.name = name
+        self.key = key
+        self.columns = columns
+        self.logger = logger or Logger(f"{name}_diff")
+        self.previous = Table()
+        self.seen = Table()
+        self.inserted = self.updated = self.unchanged = 0
+        self.deleted: List[Tuple] = []
+
+    def getters(
+        self, header: List[str]
+    ) -> Tuple[Callable[[List], Any], Callable[[List], Tuple]]:
+        key = picker(header, self.key)
+        indices = [header.index(column) for column in self.columns]
+        return key, lambda row: tuple(row[i] for i in indices)
+
+    def load(self, header: List[str], rows: Iterable[List[str]]) -> bool:
+        """
+        reads the earlier file's rows. if it doesn't have the key, or the columns,
+        e.g. because the dump's format changed, it can't be compared
+        """
+        try:
+            key, values = self.getters(header)
+        except ValueError:
+            return False
+
+        for row in rows:
+            if row:
+                self.previous.put(key(row), row_digest(values(row)))
+        return True
+
+    def filter(self, header: List[str], rows: Iterable[List[str]]) -> Iterator[List]:
+        """the rows of the latest file that were inserted or updated"""
+        key, values = self.getters(header)
+        for row in rows:
+            if not row:
+                continue
+
+            k, digest = key(row), row_digest(values(row))
+            self.seen.put(k, digest)
+            before = self.previous.get(k)
+            if before is None:
+                self.inserted += 1
+                yield row
+            elif before != digest:
+                self.updated += 1
+                yield row
+            else:
+                self.unchanged += 1
+
+        self.deleted = [
+            k if isinstance(k, tuple) else (k,)
+            for k, _ in self.previous.items()
+            if self.seen.get(k) is None
+        ]
+        self.logger.log(
+            f"{self.name}: {self.inserted} inserted, {self.updated} updated, "
+            f"{self.unchanged} unchanged, {len(self.deleted)} deleted"
+        )
@@ -0,0 +1,259 @@
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass, field, replace
+from os import getenv
+from typing import Any, Dict, List
+
+from sqlalchemy.engine import Engine
+
+from core.bulk import raw_cursor
+from core.dag import Stage
+from core.logger import Logger
+
+# tables with at most this many rows are loaded without their secondary indexes and
+# foreign keys, which are put back once they're filled
+FAST_LOAD_ROWS = int(getenv("FAST_LOAD_ROWS", 1000))
+# how many indexes of one table are rebuilt at once
+INDEX_WORKERS = int(getenv("INDEX_WORKERS", 2))
+# the load itself looks rows up by these, to map import ids to ids, so their indexes
+# stay
+LOOKUP_COLUMNS = ("import_id",)
+
+# a table's non-unique indexes that back no constraint, with the columns they're on
+INDEXES = """
+SELECT i.relname, pg_get_indexdef(i.oid), ARRAY(
+    SELECT a.attname::text FROM unnest(x.indkey) k
+    JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k
+)
+FROM pg_index x
+JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = %s::regclass
+AND NOT x.indisunique AND NOT x.indisprimary
+AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+ORDER BY i.relname
+"""
+
+FOREIGN_KEYS = """
+SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint
+WHERE conrelid = %s::regclass AND contype = 'f'
+ORDER BY conname
+"""
+
+
+# what was taken off a table for its load, exactly as postgres describes it
+@dataclass
+class Dropped:
+    table: str
+    indexes: Dict[str, str] = field(default_factory=dict)
+    foreign_keys: Dict[str, str] = field(default_factory=dict)
+
+    def __bool__(self) -> bool:
+        return bool(self.indexes or self.foreign_keys)
+
+
+# loads empty tables without the indexes and foreign keys a bootstrap doesn't need
+#
+# every row written to a table pays for each of its indexes, and has each of its
+# foreign keys checked. into an empty table, it's far cheaper to build the indexes
+# once, from the whole table, and to check the foreign keys in one pass. so before the
+# load, the non-unique indexes (but those on `LOOKUP_COLUMNS`) and the foreign keys of
+# every empty table are dropped. unique ones stay, since the merges conflict on them
+#
+# as soon as a table's stage is done, its indexes are rebuilt, a few at once, its
+# foreign keys added back and validated, and it's analyzed, all before the stages
+# depending on it start. what was dropped is written to `path` first, so if the load
+# dies halfway, the next one puts it back before anything else
+class FastLoad:
+    def __init__(
+        self,
+        name: str,
+        engine: Engine,
+        max_rows: int = FAST_LOAD_ROWS,
+        workers: int = INDEX_WORKERS,
+        path: str | None = None,
+    ):
+        self.engine = engine
+        self.max_rows = max_rows
+        self.workers = max(1, workers)
+        self.path = path or f"data/{name}/fast_load.json"
+        self.logger = Logger(f"{name}_fast_load")
+        self.dropped: Dict[str, Dropped] = {}
+
+    def prepare(self, stages: List[Stage]) -> List[Stage]:
+        """
+        drops what the empty tables the stages fill don't need during the load, and
+        returns the stages, each restoring its table once it's done
+        """
+        self.recover()
+
+        tables = [stage.model.__tablename__ for stage in stages if stage.model]
+        with raw_cursor(self.engine) as cursor:
+            for table in tables:
+                if self.is_empty(cursor, table):
+                    dropped = self.describe(cursor, table)
+                    if dropped:
+                        self.dropped[table] = dropped
+
+        if not self.dropped:
+            return stages
+
+        # written down before anything is dropped, so nothing is ever lost
+        self.save()
+        with raw_cursor(self.engine) as cursor:
+            for dropped in self.dropped.values():
+                self.drop(cursor, dropped)
+
+        return [self.restoring(stage) for stage in stages]
+
+    def restoring(self, stage: Stage) -> Stage:
+        if stage.model is None or stage.model.__tablename__ not in self.dropped:
+            return stage
+
+        table = stage.model.__tablename__
+
+        def run() -> Any:
+            result = stage.run()
+            self.restore(table)
+            return result
+
+        return replace(stage, run=run)
+
+    def is_empty(self, cursor: Any, table: str) -> bool:
+        cursor.execute(
+            f"SELECT count(*) FROM (SELECT 1 FROM {table} LIMIT %s) t",
+            (self.max_rows + 1,),
+        )
+        return cursor.fetchone()[0] <= self.max_rows
+
+    @staticmethod
+    def describe(cursor: Any, table: str) -> Dropped:
+        """what would be dropped from a table"""
+        dropped = Dropped(table)
+        cursor.execute(INDEXES, (table,))
+        for name, definition, columns in cursor.fetchall():
+            if not set(columns) & set(LOOKUP_COLUMNS):
+                dropped.indexes[name] = definition
+        cursor.execute(FOREIGN_KEYS, (table,))
+        dropped.foreign_keys = dict(cursor.fetchall())
+        return dropped
+
+    def drop(self, cursor: Any, dropped: Dropped) -> None:
+        for name in dropped.foreign_keys:
+            cursor.execute(f'ALTER TABLE {dropped.table} DROP CONSTRAINT "{name}"')
+        for name in dropped.indexes:
+            cursor.execute(f'DROP INDEX "{name}"')
+        self.logger.log(
+            f"{dropped.table} is empty, loading it without {len(dropped.indexes)} "
+            f"indexes and {len(dropped.foreign_keys)} foreign keys"
+        )
+
+    def restore(self, table: str) -> None:
+        """rebuilds what was dropped from a table, and checks it's all as it was"""
+        dropped = self.dropped[table]
+        start = time.perf_counter()
+
+        # an earlier restore may have got part of the way
+        with raw_cursor(self.engine) as cursor:
+            present = self.describe(cursor, table)
+
+        # building indexes only blocks writes, not each other
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=f"{table}-index"
+        ) as executor:
+            for future in [
+                executor.submit(self.execute, definition)
+                for name, definition in dropped.indexes.items()
+                if name not in present.indexes
+            ]:
+                future.result()
+
+        # added unvalidated, which is instant, then validated in one pass each, which
+        # doesn't lock out the tables they reference. each in its own transaction, so
+        # tables restored at the same time can't deadlock on each other's locks
+        for name, definition in dropped.foreign_keys.items():
+            unvalidated = (
+                definition
+                if definition.endswith("NOT VALID")
+                else f"{definition} NOT VALID"
+            )
+            if name not in present.foreign_keys:
+                self.execute(
+                    f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {unvalidated}'
+                )
+            if definition != unvalidated:
+                self.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+
+        self.execute(f"ANALYZE {table}")
+
+        with raw_cursor(self.engine) as cursor:
+            restored = self.describe(cursor, table)
+        if not self.matches(dropped, restored):
+            raise ValueError(f"{table} wasn't restored as it was: {restored}")
+
+        del self.dropped[table]
+        self.save()
+        self.logger.log(
+            f"{table}: rebuilt {len(dropped.indexes)} indexes and "
+            f"{len(dropped.foreign_keys)} foreign keys in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+
+    @staticmethod
+    def matches(dropped: Dropped, restored: Dropped) -> bool:
+        # indexes on the lookup columns were never dropped, and are in both
+        return all(
+            restored.indexes.get(name) == definition
+            for name, definition in dropped.indexes.items()
+        ) and all(
+            restored.foreign_keys.get(name) == definition
+            for name, definition in dropped.foreign_keys.items()
+        )
+
+    def restore_all(self) -> None:
+        """restores whatever is still dropped, e.g. because its stage failed"""
+        for table in list(self.dropped):
+            self.restore(table)
+
+    def execute(self, statement: str) -> None:
+        with raw_cursor(self.engine) as cursor:
+            cursor.execute(statement)
+
+    def recover(self) -> None:
+        """puts back what an earlier load dropped, and died before restoring"""
+        for table, dropped in self.load().items():
+            self.logger.warn(f"restoring {table}, from a load that didn't finish")
+            self.dropped[table] = dropped
+            self.restore(table)
+
+    def load(self) -> Dict[str, Dropped]:
+        if not os.path.exists(self.path):
+            return {}
+        with open(self.path) as f:
+            return {
+                table: Dropped(table, entry["indexes"], entry["foreign_keys"])
+                for table, entry in json.load(f).items()
+            }
+
+    def save(self) -> None:
+        if not self.dropped:
+            if os.path.exists(self.path):
+                os.remove(self.path)
+            return
+
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {
+                    table: {
+                        "indexes": dropped.indexes,
+                        "foreign_keys": dropped.foreign_keys,
+                    }
+                    for table, dropped in self.dropped.items()
+                },
+                f,
+                indent=2,
+            )
+        os.replace(tmp_path, self.path)
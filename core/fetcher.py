@@ -1,15 +1,38 @@
+import json
 import os
 import tarfile
-from dataclasses import dataclass
+from codecs import getincrementaldecoder
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from dataclasses import asdict, dataclass
 from datetime import datetime
-from io import BytesIO
-from shutil import rmtree
-from typing import Any
+from hashlib import sha256
+from os import getenv
+from shutil import copyfileobj, rmtree
+from typing import IO, Any, Dict, Generator, Iterable, List, Set
+from urllib.parse import urlparse
 
-from requests import get
+import yaml
+from requests import Response, Session, get
+from requests.adapters import HTTPAdapter
+from requests.exceptions import ChunkedEncodingError, ConnectionError, Timeout
+from urllib3.util.retry import Retry
 
 from core.config import Config
 from core.logger import Logger
+from core.snapshot import SnapshotStore
+from core.utils import is_tarball
+
+# how much of the response we hold in memory at once when streaming
+CHUNK_SIZE = 1024 * 1024
+# how the downloader splits a file into range requests, and how many it runs at once
+RANGE_SIZE = int(getenv("RANGE_SIZE", 64 * 1024 * 1024))
+DOWNLOAD_WORKERS = int(getenv("DOWNLOAD_WORKERS", 4))
+# (connect, read) timeouts, in seconds
+TIMEOUT = (10, 60)
+WHITESPACE = " \t\n\r"
+# the longest a JSON token split by a chunk boundary can be, other than a string
+TOKEN_SIZE = 16
+RETRIES = 5
 
 
 @dataclass
@@ -19,21 +42,297 @@ class Data:
     content: Any  # json or bytes
 
 
+# what the source told us about the last dump we loaded, so the next run can ask
+# "has anything changed?" instead of downloading it all over again
+@dataclass
+class Validators:
+    etag: str | None
+    last_modified: str | None
+    size: int | None
+    digest: str
+    snapshot: str
+    fetched_at: str
+
+
+class HashingReader:
+    """wraps a file-like object, and hashes / counts every byte read through it"""
+
+    def __init__(self, fileobj: IO[bytes]):
+        self.fileobj = fileobj
+        self.hash = sha256()
+        self.size = 0
+
+    def read(self, size: int = -1) -> bytes:
+        chunk = self.fileobj.read(size)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        return chunk
+
+    def hexdigest(self) -> str:
+        return self.hash.hexdigest()
+
+
+@dataclass
+class Download:
+    path: str
+    size: int
+    digest: str
+    etag: str | None
+    last_modified: str | None
+
+
+class Downloader:
+    """
+    downloads a single url to disk, as RANGE_SIZE chunks fetched by a pool of workers
+    over one pooled session
+
+    progress is checkpointed to `<destination>.state.json`, so a download interrupted
+    by a dropped connection, or a restart, resumes with only the missing chunks. the
+    assembled file is verified against the expected size and digest before it's moved
+    to `destination`. servers that don't support ranges get a single streamed request
+    """
+
+    def __init__(
+        self,
+        url: str,
+        destination: str,
+        workers: int = DOWNLOAD_WORKERS,
+        range_size: int = RANGE_SIZE,
+        headers: Dict[str, str] | None = None,
+        logger: Logger | None = None,
+    ):
+        self.url = url
+        self.destination = destination
+        self.partial_path = f"{destination}.partial"
+        self.state_path = f"{destination}.state.json"
+        self.workers = max(1, workers)
+        self.range_size = range_size
+        self.headers = headers or {}
+        self.logger = logger or Logger("downloader")
+
+        # urllib3 retries failed connections and 5xx responses, with backoff
+        retry = Retry(
+            total=RETRIES,
+            backoff_factor=1,
+            status_forcelist=[429, 500, 502, 503, 504],
+            allowed_methods=["HEAD", "GET"],
+        )
+        adapter = HTTPAdapter(pool_maxsize=self.workers, max_retries=retry)
+        self.session = Session()
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self.size: int | None = None
+        self.etag: str | None = None
+        self.last_modified: str | None = None
+        self.ranges = False
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.session.close()
+
+    def probe(self) -> Response:
+        """asks the server what we're about to download, without downloading it"""
+        response = self.session.head(
+            self.url, headers=self.headers, allow_redirects=True, timeout=TIMEOUT
+        )
+        if response.status_code == 304:
+            return response
+        response.raise_for_status()
+
+        length = response.headers.get("Content-Length")
+        self.size = int(length) if length else None
+        self.etag = response.headers.get("ETag")
+        self.last_modified = response.headers.get("Last-Modified")
+        self.ranges = response.headers.get("Accept-Ranges") == "bytes"
+        self.logger.debug(f"{self.url}: size={self.size}, ranges={self.ranges}")
+        return response
+
+    def download(
+        self, expected_size: int | None = None, expected_digest: str | None = None
+    ) -> Download:
+        if self.size is None and not self.ranges:
+            self.probe()
+
+        os.makedirs(os.path.dirname(self.destination) or ".", exist_ok=True)
+        if self.ranges and self.size:
+            self.download_ranges()
+        else:
+            self.logger.warn(f"{self.url} doesn't support ranges, downloading it whole")
+            self.download_whole()
+
+        digest = self.verify(expected_size or self.size, expected_digest)
+        os.replace(self.partial_path, self.destination)
+        if os.path.exists(self.state_path):
+            os.remove(self.state_path)
+
+        return Download(
+            path=self.destination,
+            size=os.path.getsize(self.destination),
+            digest=digest,
+            etag=self.etag,
+            last_modified=self.last_modified,
+        )
+
+    def load_state(self) -> List[int]:
+        """chunks a previous attempt finished, if it was downloading the same file"""
+        if not os.path.exists(self.state_path) or not os.path.exists(self.partial_path):
+            return []
+
+        try:
+            with open(self.state_path) as f:
+                state = json.load(f)
+        except ValueError:
+            return []
+
+        same_file = (
+            state.get("url") == self.url
+            and state.get("etag") == self.etag
+            and state.get("size") == self.size
+            and state.get("range_size") == self.range_size
+        )
+        if not same_file or os.path.getsize(self.partial_path) != self.size:
+            self.logger.log(f"{self.url} changed since the last attempt, restarting")
+            return []
+
+        return state.get("done", [])
+
+    def save_state(self, done: List[int]) -> None:
+        state = {
+            "url": self.url,
+            "etag": self.etag,
+            "size": self.size,
+            "range_size": self.range_size,
+            "done": sorted(done),
+        }
+        tmp_path = f"{self.state_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(state, f)
+        os.replace(tmp_path, self.state_path)
+
+    def download_ranges(self) -> None:
+        done = self.load_state()
+        if not done:
+            # preallocate, so every worker can write its chunk at its own offset
+            with open(self.partial_path, "wb") as f:
+                f.truncate(self.size)
+            self.save_state(done)
+
+        chunks = range(0, (self.size + self.range_size - 1) // self.range_size)
+        finished = set(done)
+        todo = [chunk for chunk in chunks if chunk not in finished]
+        if done:
+            self.logger.log(f"resuming {self.url}: {len(done)}/{len(chunks)} done")
+
+        fd = os.open(self.partial_path, os.O_WRONLY)
+        try:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                futures = [executor.submit(self.fetch_range, fd, c) for c in todo]
+                try:
+                    for future in as_completed(futures):
+                        done.append(future.result())
+                        self.save_state(done)
+                        self.logger.debug(f"chunk {len(done)}/{len(chunks)} done")
+                except Exception:
+                    # finished chunks are checkpointed, the next run resumes from them
+                    for future in futures:
+                        future.cancel()
+                    raise
+        finally:
+            os.close(fd)
+
+    def fetch_range(self, fd: int, chunk: int) -> int:
+        """fetches a single chunk, resuming within it if the connection drops"""
+        start = chunk * self.range_size
+        end = min(start + self.range_size, self.size) - 1
+        offset = start
+
+        for attempt in range(RETRIES + 1):
+            headers = {"Range": f"bytes={offset}-{end}"}
+            # if the file changed under us, we get a 200 instead of mixing versions
+            if self.etag:
+                headers["If-Range"] = self.etag
+
+            try:
+                with self.session.get(
+                    self.url, headers=headers, stream=True, timeout=TIMEOUT
+                ) as response:
+                    response.raise_for_status()
+                    if response.status_code != 206:
+                        raise ValueError(f"{self.url} changed during the download")
+
+                    for data in response.iter_content(CHUNK_SIZE):
+                        os.pwrite(fd, data, offset)
+                        offset += len(data)
+            except (ChunkedEncodingError, ConnectionError, Timeout) as e:
+                if attempt == RETRIES:
+                    raise e
+                self.logger.warn(f"chunk {chunk} failed at {offset}, retrying: {e}")
+                continue
+
+            if offset == end + 1:
+                return chunk
+
+        raise ValueError(f"chunk {chunk} of {self.url} came back short")
+
+    def download_whole(self) -> None:
+        with self.session.get(self.url, stream=True, timeout=TIMEOUT) as response:
+            response.raise_for_status()
+            with open(self.partial_path, "wb") as f:
+                for data in response.iter_content(CHUNK_SIZE):
+                    f.write(data)
+
+    def verify(self, expected_size: int | None, expected_digest: str | None) -> str:
+        """checks the assembled file, throwing it away if it's corrupt"""
+        size = os.path.getsize(self.partial_path)
+        hash = sha256()
+        with open(self.partial_path, "rb") as f:
+            while data := f.read(CHUNK_SIZE):
+                hash.update(data)
+        digest = hash.hexdigest()
+
+        problem = None
+        if expected_size is not None and size != expected_size:
+            problem = f"expected {expected_size} bytes, got {size}"
+        elif expected_digest is not None and digest != expected_digest:
+            problem = f"expected sha256 {expected_digest}, got {digest}"
+
+        if problem:
+            self.logger.error(f"{self.url} is corrupt: {problem}")
+            os.remove(self.partial_path)
+            if os.path.exists(self.state_path):
+                os.remove(self.state_path)
+            raise ValueError(f"{self.url} failed verification: {problem}")
+
+        self.logger.debug(f"verified {self.url}: {size} bytes, sha256 {digest}")
+        return digest
+
+
 class Fetcher:
     def __init__(self, name: str, config: Config):
         self.name = name
         self.source = config.pm_config.source
         self.output = f"data/{name}"
+        self.validators_path = f"{self.output}/latest.json"
         self.logger = Logger(f"{name}_fetcher")
+        self.snapshots = SnapshotStore(self.output, logger=self.logger)
         self.no_cache = config.exec_config.no_cache
         self.test = config.exec_config.test
+        self.keep_archive = config.exec_config.keep_archive
+        self.incremental = config.exec_config.incremental
+        # set by the fetch, and only persisted once the load succeeded
+        self.validators: Validators | None = None
+        self.changed = True
 
     def write(self, files: list[Data]):
         """generic write function for some collection of files"""
 
-        # prep the file location
+        # prep the file location. we write into a staging directory, which is only
+        # published as data/<name>/<date> once everything is on disk
         now = datetime.now().strftime("%Y-%m-%d")
-        root_path = f"{self.output}/{now}"
+        root_path = self.snapshots.staging()
 
         # write
         # it can be anything - json, tarball, etc.
@@ -50,17 +349,66 @@ class Fetcher:
                 self.logger.debug(f"writing {full_path}")
                 f.write(file_content)
 
-        # update the latest symlink
-        self.update_symlink(now)
+        # publish, which also updates the latest symlink
+        self.snapshots.publish(root_path, now, replace=True)
 
     def update_symlink(self, latest_path: str):
-        latest_symlink = f"{self.output}/latest"
-        if os.path.islink(latest_symlink):
-            self.logger.debug(f"removing existing symlink {latest_symlink}")
-            os.remove(latest_symlink)
+        self.snapshots.activate(latest_path)
+
+    def load_validators(self) -> Validators | None:
+        """the validators of the last successfully loaded dump, if any"""
+        if not os.path.exists(self.validators_path):
+            return None
+
+        try:
+            with open(self.validators_path) as f:
+                return Validators(**json.load(f))
+        except (ValueError, TypeError) as e:
+            self.logger.warn(f"ignoring unreadable {self.validators_path}: {e}")
+            return None
+
+    def save_validators(self) -> None:
+        """
+        persists the validators of the current fetch next to the latest symlink
+
+        call this only after the load succeeded, otherwise a failed run would make the
+        next one think there's nothing new to load
+        """
+        if self.validators is None:
+            return
+
+        tmp_path = f"{self.validators_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(asdict(self.validators), f, indent=2)
+        os.replace(tmp_path, self.validators_path)
+        self.logger.debug(f"saved validators to {self.validators_path}")
+
+    def conditional_headers(self, previous: Validators | None) -> Dict[str, str]:
+        headers = {}
+        if previous is None:
+            return headers
+        if previous.etag:
+            headers["If-None-Match"] = previous.etag
+        if previous.last_modified:
+            headers["If-Modified-Since"] = previous.last_modified
+        return headers
+
+    def unchanged(self, previous: Validators | None, response) -> bool:
+        """checks whether the response describes the dump we already loaded"""
+        if previous is None:
+            return False
+
+        if response.status_code == 304:
+            return True
 
-        self.logger.debug(f"creating symlink {latest_symlink} -> {latest_path}")
-        os.symlink(latest_path, latest_symlink)
+        # some servers ignore conditional requests, so compare the validators
+        # ourselves before reading the body
+        etag = response.headers.get("ETag")
+        size = response.headers.get("Content-Length")
+        if etag and etag == previous.etag:
+            return size is None or previous.size is None or int(size) == previous.size
+
+        return False
 
     def fetch(self):
         if self.fetch:
@@ -74,46 +422,350 @@ class Fetcher:
             return response.content
 
     def cleanup(self):
-        if self.no_cache:
+        # incremental loads diff against the snapshot they last loaded, so they keep
+        # the snapshots, as far as the retention policy allows
+        if self.no_cache and not self.incremental:
+            # keep the validators, so we still skip unchanged dumps next time, and the
+            # id maps, so the next load doesn't have to look every id up again
+            validators = self.load_validators()
+            idmap = f"{self.output}/.idmap"
+            kept = f"{self.output}.idmap"
+            if os.path.isdir(idmap):
+                os.replace(idmap, kept)
             rmtree(self.output, ignore_errors=True)
             os.makedirs(self.output, exist_ok=True)
+            if os.path.isdir(kept):
+                os.replace(kept, idmap)
+            if validators:
+                self.validators = validators
+                self.save_validators()
 
 
 class TarballFetcher(Fetcher):
-    def __init__(self, name: str, config: Config):
+    def __init__(self, name: str, config: Config, members: Iterable[str] | None = None):
+        """
+        members are the file names a transformer reads (see Transformer.manifest), and
+        if provided, every other file in the tarball is skipped instead of written
+        """
         super().__init__(name, config)
+        self.members: Set[str] | None = set(members) if members else None
+        self.file_name = (
+            os.path.basename(urlparse(self.source).path) or f"{name}.tar.gz"
+        )
+
+    def wanted(self, member: tarfile.TarInfo) -> bool:
+        if not member.isfile():
+            return False
+        if self.members is None:
+            return True
+        return os.path.basename(member.name) in self.members
+
+    def missing_members(self, snapshot_path: str) -> Set[str]:
+        """the requested members that an existing snapshot doesn't have"""
+        if self.members is None:
+            return set()
+
+        found = set()
+        for _, _, files in os.walk(snapshot_path):
+            # a kept tarball has everything, transformers read straight from it
+            if any(is_tarball(file) for file in files):
+                return set()
+            found.update(files)
+        return self.members - found
+
+    def download(self) -> bool:
+        """
+        downloads the tarball to disk with resumable, parallel range requests, verifies
+        it, and only then extracts it into a snapshot
+
+        an interrupted download picks up where it left off on the next run. returns
+        whether the dump differs from the last one loaded
+        """
+        previous = self.load_validators()
+        downloader = Downloader(
+            self.source,
+            f"{self.output}/.download/{self.file_name}",
+            headers=self.conditional_headers(previous),
+            logger=self.logger,
+        )
+
+        with downloader:
+            probe = downloader.probe()
+            if self.unchanged(previous, probe):
+                return self.skip(previous)
+
+            # a download that can't be split into ranges can't be resumed either, so
+            # it isn't written to disk first
+            if not (downloader.ranges and downloader.size) and not self.keep_archive:
+                return self.stream(downloader, previous)
+
+            download = downloader.download()
+
+        validators = Validators(
+            etag=download.etag,
+            last_modified=download.last_modified,
+            size=download.size,
+            digest=download.digest,
+            snapshot=download.digest,
+            fetched_at=datetime.now().isoformat(),
+        )
+
+        # no need to extract a dump we already have
+        snapshot_path = f"{self.output}/{download.digest}"
+        if os.path.isdir(snapshot_path) and not self.missing_members(snapshot_path):
+            os.remove(download.path)
+            return self.publish(None, previous, validators)
+
+        if self.keep_archive:
+            root_path = self.snapshots.staging()
+            os.replace(download.path, os.path.join(root_path, self.file_name))
+        else:
+            with open(download.path, "rb") as f:
+                root_path = self.extract(f)
+            os.remove(download.path)
+
+        return self.publish(root_path, previous, validators)
+
+    def stream(self, downloader: Downloader, previous: Validators | None) -> bool:
+        """
+        untars the tarball straight from the response, as it arrives, for servers that
+        don't support ranges. the response body is hashed as it's read, and checked
+        against the size the server announced, before the snapshot is published
+        """
+        self.logger.log(f"{self.source} doesn't support ranges, streaming it")
+        with downloader.session.get(
+            self.source, stream=True, timeout=TIMEOUT
+        ) as response:
+            response.raise_for_status()
+            reader = HashingReader(response.raw)
+            root_path = self.extract(reader)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+
+        if downloader.size is not None and reader.size != downloader.size:
+            rmtree(root_path, ignore_errors=True)
+            raise ValueError(
+                f"{self.source} came back short: expected {downloader.size} bytes, "
+                f"got {reader.size}"
+            )
+
+        validators = Validators(
+            etag=etag,
+            last_modified=last_modified,
+            size=reader.size,
+            digest=reader.hexdigest(),
+            snapshot=reader.hexdigest(),
+            fetched_at=datetime.now().isoformat(),
+        )
+        return self.publish(root_path, previous, validators)
+
+    def skip(self, previous: Validators) -> bool:
+        self.logger.log(f"{self.source} hasn't changed since {previous.fetched_at}")
+        self.changed = False
+        return self.changed
+
+    def extract(self, fileobj: IO[bytes]) -> str:
+        """
+        untars a gzipped file or stream into a fresh staging directory, and returns its
+        path. the stream is read to the end, so a HashingReader sees every byte
+        """
+        root_path = self.snapshots.staging()
+
+        try:
+            # r|gz treats the archive as a non-seekable stream, so the same code works
+            # for a response body and for a file on disk
+            with tarfile.open(fileobj=fileobj, mode="r|gz", bufsize=CHUNK_SIZE) as tar:
+                # members we don't want are read past, never written
+                for member in tar:
+                    if self.wanted(member):
+                        self.write_member(tar, member, root_path)
+                    elif member.isfile():
+                        self.logger.debug(f"skipping {member.name}")
+            while fileobj.read(CHUNK_SIZE):
+                pass
+        except Exception:
+            rmtree(root_path, ignore_errors=True)
+            raise
+
+        return root_path
+
+    def publish(
+        self, root_path: str | None, previous: Validators | None, validators: Validators
+    ) -> bool:
+        """
+        moves an extracted dump into its content-addressed snapshot, and points the
+        latest symlink at it. a root_path of None means the snapshot already exists
+        """
+        digest = validators.digest
+        if root_path is None:
+            self.logger.log(
+                f"snapshot {digest} already exists, not extracting it again"
+            )
+            self.snapshots.activate(digest)
+        else:
+            # an older snapshot of the same dump might've skipped files we now need
+            replace = self.snapshots.exists(digest) and bool(
+                self.missing_members(self.snapshots.path(digest))
+            )
+            self.snapshots.publish(root_path, digest, replace=replace)
+
+        self.validators = validators
+        self.changed = previous is None or previous.digest != digest
+        if not self.changed:
+            self.logger.log(f"downloaded dump is identical to snapshot {digest}")
+
+        return self.changed
+
+    def write_member(
+        self, tar: tarfile.TarFile, member: tarfile.TarInfo, root_path: str
+    ) -> None:
+        """copies a single tar member to disk, in chunks"""
+        destination = os.path.normpath(member.name)
+        if os.path.isabs(destination) or destination.startswith(".."):
+            self.logger.warn(f"skipping {member.name}, it's outside the archive")
+            return
+
+        full_path = os.path.join(root_path, destination)
+        os.makedirs(os.path.dirname(full_path), exist_ok=True)
+
+        self.logger.debug(f"writing {full_path}")
+        with open(full_path, "wb") as f:
+            copyfileobj(tar.extractfile(member), f, CHUNK_SIZE)
 
-    def fetch(self) -> list[Data]:
-        content = super().fetch()
 
-        bytes_io_object = BytesIO(content)
-        bytes_io_object.seek(0)
+def iter_json_array(chunks: Iterable[str]) -> Generator[Any, None, None]:
+    """
+    incrementally parses a JSON array, yielding its elements as soon as each one is
+    complete, so only the element being parsed (and one chunk) is ever in memory
 
-        files = []
-        with tarfile.open(fileobj=bytes_io_object, mode="r:gz") as tar:
-            for member in tar.getmembers():
-                if member.isfile():
-                    bytes_io_file = BytesIO(tar.extractfile(member).read())
-                    destination_key = member.name
-                    file_name = destination_key.split("/")[-1]
-                    file_path = "/".join(destination_key.split("/")[:-1])
-                    self.logger.debug(f"file_path/file_name: {file_path}/{file_name}")
-                    files.append(Data(file_path, file_name, bytes_io_file.read()))
+    a document that isn't an array is yielded whole, as a single record. an array
+    that's malformed, e.g. with a missing or doubled comma, raises a ValueError
+    """
+    decoder = json.JSONDecoder()
+    chunks = iter(chunks)
+    buffer = ""
+    pos = 0
 
-        return files
+    def more() -> bool:
+        """appends the next chunk, dropping everything we already parsed"""
+        nonlocal buffer, pos
+        for chunk in chunks:
+            if chunk:
+                buffer = buffer[pos:] + chunk
+                pos = 0
+                return True
+        return False
+
+    def skip() -> None:
+        nonlocal pos
+        while True:
+            while pos < len(buffer) and buffer[pos] in WHITESPACE:
+                pos += 1
+            if pos < len(buffer) or not more():
+                return
+
+    skip()
+    if not buffer.startswith("[", pos):
+        while more():
+            pass
+        if buffer[pos:].strip():
+            yield json.loads(buffer[pos:])
+        return
+    pos += 1
+
+    skip()
+    if not buffer.startswith("]", pos):
+        while True:
+            if pos == len(buffer):
+                raise ValueError("unexpected end of JSON array")
+
+            try:
+                element, end = decoder.raw_decode(buffer, pos)
+            except json.JSONDecodeError as e:
+                # only an element cut off by the end of the buffer can parse with more
+                # of it: a string that runs on, or a token that was split. it's tried
+                # again once the buffer has at least doubled, so a long element isn't
+                # parsed over again for every chunk
+                cut_off = e.msg.startswith("Unterminated string") or (
+                    e.pos >= len(buffer) - TOKEN_SIZE
+                )
+                if not cut_off or not more():
+                    raise
+                wanted = 2 * (len(buffer) - pos)
+                while len(buffer) - pos < wanted and more():
+                    pass
+                continue
+
+            # a number cut off at the end of a chunk ("12" of "12.5") parses just
+            # fine, so an element is only complete once we see what follows it
+            complete = end < len(buffer) and buffer[end] in WHITESPACE + ",]"
+            if not complete and end >= len(buffer) - TOKEN_SIZE and more():
+                continue
+
+            yield element
+            pos = end
+            skip()
+            if buffer.startswith("]", pos):
+                break
+            if not buffer.startswith(",", pos):
+                found = repr(buffer[pos : pos + 20]) if pos < len(buffer) else "the end"
+                raise ValueError(f"expected , or ] after an array element, got {found}")
+            pos += 1
+            skip()
+
+    pos += 1
+    skip()
+    if pos < len(buffer):
+        raise ValueError(f"extra data after the JSON array: {buffer[pos : pos + 20]!r}")
 
 
 class JSONFetcher(Fetcher):
-    def __init__(self, name: str, source: str):
-        super().__init__(name, source)
+    def __init__(self, name: str, config: Config):
+        super().__init__(name, config)
 
-    def fetch(self):
-        pass
+    def fetch(self) -> Generator[Any, None, None]:
+        """
+        streams a JSON array from the source, and yields its elements one by one, so
+        documents like homebrew's formula.json never need to fit in memory
+        """
+        with get(self.source, stream=True, timeout=TIMEOUT) as response:
+            try:
+                response.raise_for_status()
+            except Exception as e:
+                self.logger.error(f"error fetching {self.source}: {e}")
+                raise e
+
+            # JSON is utf-8, whatever the headers say, and a character can be split
+            # across two chunks
+            decoder = getincrementaldecoder("utf-8")()
+            chunks = (
+                decoder.decode(chunk) for chunk in response.iter_content(CHUNK_SIZE)
+            )
+            count = 0
+            for count, record in enumerate(iter_json_array(chunks), 1):
+                yield record
+            self.logger.log(f"streamed {count} records from {self.source}")
 
 
 class YAMLFetcher(Fetcher):
-    def __init__(self, name: str, source: str):
-        super().__init__(name, source)
+    def __init__(self, name: str, config: Config):
+        super().__init__(name, config)
 
-    def fetch(self):
-        pass
+    def fetch(self) -> Generator[Any, None, None]:
+        """
+        streams a (multi-document) YAML file from the source, and yields each document
+        as soon as it's parsed, so only one document is ever in memory
+        """
+        with get(self.source, stream=True, timeout=TIMEOUT) as response:
+            try:
+                response.raise_for_status()
+            except Exception as e:
+                self.logger.error(f"error fetching {self.source}: {e}")
+                raise e
+
+            # the yaml reader pulls from the raw response in small chunks
+            response.raw.decode_content = True
+            count = 0
+            for count, document in enumerate(yaml.safe_load_all(response.raw), 1):
+                yield document
+            self.logger.log(f"streamed {count} documents from {self.source}")
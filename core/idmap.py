@@ -0,0 +1,496 @@
+import heapq
+import json
+import mmap
+import os
+import struct
+from array import array
+from bisect import bisect_left
+from os import getenv
+from threading import RLock
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Set, Tuple
+from uuid import UUID
+
+from core.logger import Logger
+from core.sizing import MAX_BATCH_ROWS
+
+# the most memory, in MB, each id map may use before it starts evicting the entries
+# that weren't used for the longest. 0 means no limit
+ID_CACHE_MB = int(getenv("ID_CACHE_MB", 0))
+
+EMPTY = -(2**63)
+FIBONACCI = 0x9E3779B97F4A7C15
+MASK = 2**64 - 1
+MAX_LOAD = 0.66
+# an integer key costs an 8 byte key and a 16 byte id per slot, at most 2/3 full
+SLOT_BYTES = 8 + 16
+ENTRY_BYTES = int(SLOT_BYTES / MAX_LOAD) + 1
+# a bounded map never holds less than this, so the ids a batch warms (one per row of
+# a column, at most MAX_BATCH_ROWS) fit in the newer of its two generations, and
+# can't evict each other between being fetched and being used
+MIN_ENTRIES = 2 * MAX_BATCH_ROWS
+# a saved map is a list of segments, one per load that added ids, and once there
+# are more than this, they're compacted into one
+MAX_SEGMENTS = 8
+MAGIC = b"CHAIIDM1"
+# an id of all zeros marks a key as removed: saved, it hides the key in the older
+# segments, until a compaction drops both
+REMOVED = bytes(16)
+HEADER = struct.Struct("<8sq")
+
+
+def integer_key(key: Any) -> int | None:
+    """
+    the key as an integer, if it round trips as one, e.g. crates' numeric ids. "007"
+    doesn't, so it stays a string
+    """
+    if isinstance(key, int):
+        return key if 0 <= key < 2**63 else None
+    if (
+        isinstance(key, str)
+        and 0 < len(key) < 19
+        and key.isascii()
+        and key.isdigit()
+        and (key[0] != "0" or key == "0")
+    ):
+        return int(key)
+    return None
+
+
+def normal_key(key: Any) -> Any:
+    """the key as the tables keep it"""
+    k = integer_key(key)
+    return key if k is None else k
+
+
+# an open addressing hash table over flat arrays: integer keys in one, the ids as
+# packed 16 byte UUIDs in another, so an entry is ~36 bytes instead of the few
+# hundred a str -> UUID dict entry takes. keys that aren't integers, like license
+# names, go in a dict, still with packed ids
+class Table:
+    def __init__(self, bits: int = 10):
+        self.bits = bits
+        self.slots = 1 << bits
+        self.keys = array("q", [EMPTY]) * self.slots
+        self.ids = bytearray(16 * self.slots)
+        self.size = 0
+        self.strings: Dict[Any, bytes] = {}
+
+    def __len__(self) -> int:
+        return self.size + len(self.strings)
+
+    def slot(self, key: int) -> int:
+        """where `key` is, or the empty slot where it would go"""
+        i = ((key * FIBONACCI) & MASK) >> (64 - self.bits)
+        keys, mask = self.keys, self.slots - 1
+        while True:
+            found = keys[i]
+            if found == key or found == EMPTY:
+                return i
+            i = (i + 1) & mask
+
+    def get(self, key: Any) -> bytes | None:
+        k = integer_key(key)
+        if k is None:
+            return self.strings.get(key)
+        i = self.slot(k)
+        if self.keys[i] == EMPTY:
+            return None
+        return bytes(self.ids[16 * i : 16 * i + 16])
+
+    def put(self, key: Any, packed: bytes) -> None:
+        k = integer_key(key)
+        if k is None:
+            self.strings[key] = packed
+            return
+        if self.size + 1 > self.slots * MAX_LOAD:
+            self.grow()
+        i = self.slot(k)
+        if self.keys[i] == EMPTY:
+            self.keys[i] = k
+            self.size += 1
+        self.ids[16 * i : 16 * i + 16] = packed
+
+    def grow(self) -> None:
+        keys, ids = self.keys, self.ids
+        self.bits += 1
+        self.slots = 1 << self.bits
+        self.keys = array("q", [EMPTY]) * self.slots
+        self.ids = bytearray(16 * self.slots)
+        for j, key in enumerate(keys):
+            if key != EMPTY:
+                i = self.slot(key)
+                self.keys[i] = key
+                self.ids[16 * i : 16 * i + 16] = ids[16 * j : 16 * j + 16]
+
+    def integers(self) -> Iterator[Tuple[int, bytes]]:
+        for j, key in enumerate(self.keys):
+            if key != EMPTY:
+                yield key, bytes(self.ids[16 * j : 16 * j + 16])
+
+    def items(self) -> Iterator[Tuple[Any, bytes]]:
+        for key, packed in self.integers():
+            yield str(key), packed
+        yield from self.strings.items()
+
+    @property
+    def nbytes(self) -> int:
+        strings = sum(len(key) + 100 for key in self.strings)
+        return self.keys.itemsize * self.slots + len(self.ids) + strings
+
+
+# a saved id map segment: the integer keys sorted in one int64 array, their ids in a
+# parallel array of 16 byte UUIDs, and the other keys as json at the end. it's memory
+# mapped, so the os pages in only what lookups touch, and they're a binary search
+#
+#   magic (8 bytes) | count (int64) | keys (count x int64) | ids (count x 16 bytes) |
+#   {"string key": "hex id", ...}
+class Segment:
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as f:
+            self.mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.count = HEADER.unpack_from(self.mmap)
+        if magic != MAGIC:
+            self.mmap.close()
+            raise ValueError(f"{path} isn't an id map segment")
+
+        view = memoryview(self.mmap)
+        keys_end = HEADER.size + 8 * self.count
+        ids_end = keys_end + 16 * self.count
+        self.keys = view[HEADER.size : keys_end].cast("q")
+        self.ids = view[keys_end:ids_end]
+        self.strings = {
+            key: bytes.fromhex(id)
+            for key, id in json.loads(bytes(view[ids_end:]) or b"{}").items()
+        }
+
+    def __len__(self) -> int:
+        return self.count + len(self.strings)
+
+    def get(self, key: Any) -> bytes | None:
+        k = integer_key(key)
+        if k is None:
+            return self.strings.get(key)
+        i = bisect_left(self.keys, k)
+        if i < self.count and self.keys[i] == k:
+            return bytes(self.ids[16 * i : 16 * i + 16])
+        return None
+
+    def integers(self) -> Iterator[Tuple[int, bytes]]:
+        for i in range(self.count):
+            yield self.keys[i], bytes(self.ids[16 * i : 16 * i + 16])
+
+    def close(self) -> None:
+        self.keys.release()
+        self.ids.release()
+        self.mmap.close()
+
+    @staticmethod
+    def write(
+        path: str, integers: Iterable[Tuple[int, bytes]], strings: Dict[str, bytes]
+    ) -> None:
+        """writes a segment, from integer keys in ascending order, atomically"""
+        keys, ids = array("q"), bytearray()
+        for key, packed in integers:
+            keys.append(key)
+            ids += packed
+
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(HEADER.pack(MAGIC, len(keys)))
+            f.write(keys.tobytes())
+            f.write(ids)
+            f.write(json.dumps({k: v.hex() for k, v in strings.items()}).encode())
+        os.replace(tmp_path, path)
+
+
+# what DB caches import ids -> ids in: a dict, as far as the loaders are concerned,
+# but compact, and optionally bounded
+#
+# with a memory cap, it keeps two generations: new and recently used entries go in
+# the hot one, and once that holds half of what fits, it becomes the cold one, and
+# the old cold one is dropped. an entry found in the cold generation moves back to
+# the hot one, so what's evicted is roughly what was used least recently. an evicted
+# id is just fetched again, the next time a batch needs it
+#
+# below both, it can have saved segments (see IdMapStore), newest first, which are
+# read only: what's learnt on top of them is what gets saved next
+#
+# stages that run concurrently share the caches, and even a lookup can move entries
+# around, so every access holds the map's lock
+class IdMap:
+    def __init__(self, max_mb: int = ID_CACHE_MB):
+        self.capacity = max_mb * 1024 * 1024 // ENTRY_BYTES
+        if max_mb and self.capacity < MIN_ENTRIES:
+            Logger("idmap").warn(
+                f"{max_mb}MB holds fewer than {MIN_ENTRIES} ids, the most a batch "
+                f"needs, so it's raised to {MIN_ENTRIES * ENTRY_BYTES / 2**20:.1f}MB"
+            )
+            self.capacity = MIN_ENTRIES
+        self.hot = Table()
+        self.cold: Table | None = None
+        self.segments: List[Segment] = []
+        # keys whose rows were deleted, which no generation can evict
+        self.removed: Set[Any] = set()
+        self.evicted = 0
+        self.lock = RLock()
+
+    def __len__(self) -> int:
+        """
+        an upper bound on how many keys are mapped: a key is counted in every
+        generation and segment it's in, and removed ones are still counted
+        """
+        tables = len(self.hot) + (len(self.cold) if self.cold else 0)
+        return tables + sum(len(segment) for segment in self.segments)
+
+    def packed(self, key: Any) -> bytes | None:
+        with self.lock:
+            if self.removed and normal_key(key) in self.removed:
+                return None
+            packed = self.hot.get(key)
+            if packed is None and self.cold is not None:
+                packed = self.cold.get(key)
+                if packed is not None:
+                    self.store(key, packed)
+            if packed is None:
+                packed = self.saved(key)
+            return packed
+
+    def saved(self, key: Any) -> bytes | None:
+        for segment in self.segments:
+            packed = segment.get(key)
+            if packed is not None:
+                return None if packed == REMOVED else packed
+        return None
+
+    def get(self, key: Any, default: UUID | None = None) -> UUID | None:
+        packed = self.packed(key)
+        return default if packed is None else UUID(bytes=packed)
+
+    def __getitem__(self, key: Any) -> UUID:
+        packed = self.packed(key)
+        if packed is None:
+            raise KeyError(key)
+        return UUID(bytes=packed)
+
+    def __contains__(self, key: Any) -> bool:
+        return self.packed(key) is not None
+
+    def __setitem__(self, key: Any, id: UUID) -> None:
+        self.store(key, id.bytes)
+
+    def store(self, key: Any, packed: bytes) -> None:
+        with self.lock:
+            if self.removed:
+                self.removed.discard(normal_key(key))
+            self.hot.put(key, packed)
+            if self.capacity and len(self.hot) >= self.capacity // 2:
+                if self.cold is not None:
+                    self.evicted += len(self.cold)
+                self.cold, self.hot = self.hot, Table()
+
+    def update(self, ids: Mapping[Any, UUID] | Iterable[Tuple[Any, UUID]]) -> None:
+        with self.lock:
+            for key, id in ids.items() if isinstance(ids, Mapping) else ids:
+                self.store(key, id.bytes)
+
+    def discard(self, keys: Iterable[Any]) -> None:
+        """forgets keys whose rows are gone, here and, once saved, in the segments"""
+        with self.lock:
+            self.removed.update(normal_key(key) for key in keys)
+
+    def items(self) -> Iterator[Tuple[Any, UUID]]:
+        """
+        every entry in memory, with keys as strings. ones in both generations show up
+        twice, and saved or removed ones don't show up at all
+        """
+        for table in (self.cold, self.hot):
+            if table is not None:
+                for key, packed in table.items():
+                    if normal_key(key) not in self.removed:
+                        yield key, UUID(bytes=packed)
+
+    def changes(self) -> Tuple[Dict[int, bytes], Dict[str, bytes]]:
+        """the entries in memory that the saved segments don't have, or have wrong"""
+        integers: Dict[int, bytes] = {}
+        strings: Dict[str, bytes] = {}
+        with self.lock:
+            for table in (self.cold, self.hot):
+                if table is None:
+                    continue
+                for key, packed in table.integers():
+                    if key not in self.removed and self.saved(key) != packed:
+                        integers[key] = packed
+                for key, packed in table.strings.items():
+                    if key not in self.removed and self.saved(key) != packed:
+                        strings[key] = packed
+            for key in self.removed:
+                if self.saved(key) is not None:
+                    if isinstance(key, int):
+                        integers[key] = REMOVED
+                    else:
+                        strings[key] = REMOVED
+        return integers, strings
+
+    def clear(self) -> None:
+        with self.lock:
+            self.hot, self.cold = Table(), None
+            self.removed = set()
+            for segment in self.segments:
+                segment.close()
+            self.segments = []
+
+    @property
+    def nbytes(self) -> int:
+        return self.hot.nbytes + (self.cold.nbytes if self.cold else 0)
+
+
+# keeps a package manager's id maps on disk, under data/<name>/idmap, so the next run
+# (or the next process) starts with the ids every earlier load learnt, instead of
+# asking postgres for them again
+#
+# the maps are only valid against the database they came from, as it was after the
+# load that saved them, so they're stamped with that load's load_history id, and
+# thrown away if the latest load doesn't match, e.g. a load that ran elsewhere, or
+# a database that was rebuilt
+class IdMapStore:
+    def __init__(self, name: str, root: str | None = None):
+        # hidden, so the snapshot store next to it doesn't take it for a snapshot
+        self.root = root or f"data/{name}/.idmap"
+        legacy = f"data/{name}/idmap"
+        if root is None and os.path.isdir(legacy) and not os.path.exists(self.root):
+            os.replace(legacy, self.root)
+        self.meta_path = os.path.join(self.root, "meta.json")
+        self.logger = Logger(f"{name}_idmap")
+
+    def meta(self) -> Dict:
+        if not os.path.exists(self.meta_path):
+            return {}
+        try:
+            with open(self.meta_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def attach(self, maps: Dict[str, IdMap], load_history: str | None) -> None:
+        """
+        gives each map its saved segments, if they're still valid against the latest
+        load. otherwise, they're removed, and the maps start empty
+        """
+        meta = self.meta()
+        if not meta:
+            return
+
+        if load_history is None or meta.get("load_history") != load_history:
+            self.logger.warn(
+                f"id maps were saved after load {meta.get('load_history')}, but the "
+                f"latest load is {load_history}, starting without them"
+            )
+            self.clear()
+            for idmap in maps.values():
+                idmap.clear()
+            return
+
+        for table, idmap in maps.items():
+            idmap.clear()
+            files = meta.get("segments", {}).get(table, [])
+            idmap.segments = [
+                Segment(os.path.join(self.root, file)) for file in reversed(files)
+            ]
+            self.logger.debug(
+                f"{table}: up to {len(idmap)} saved ids, {len(files)} segments"
+            )
+
+    def save(self, maps: Dict[str, IdMap], load_history: str) -> None:
+        """
+        adds a segment with what each map learnt since it was attached, stamps the
+        maps with `load_history`, and reattaches them
+        """
+        os.makedirs(self.root, exist_ok=True)
+        meta = self.meta()
+        segments: Dict[str, List[str]] = meta.get("segments", {})
+        sequence = meta.get("sequence", 0)
+
+        for table, idmap in maps.items():
+            integers, strings = idmap.changes()
+            files = segments.setdefault(table, [])
+            if integers or strings:
+                sequence += 1
+                file = f"{table}.{sequence:06d}.idmap"
+                Segment.write(
+                    os.path.join(self.root, file), sorted(integers.items()), strings
+                )
+                files.append(file)
+                self.logger.debug(f"{table}: saved {len(integers) + len(strings)} ids")
+
+            if len(files) > MAX_SEGMENTS:
+                sequence += 1
+                file = f"{table}.{sequence:06d}.idmap"
+                self.compact(files, file)
+                segments[table] = [file]
+
+        # the segments are only part of the map once meta.json says so
+        self.write_meta(
+            {"load_history": load_history, "sequence": sequence, "segments": segments}
+        )
+        self.prune()
+        self.attach(maps, load_history)
+
+    def compact(self, files: List[str], file: str) -> None:
+        """
+        merges segments, oldest to newest, into one, where the newest id wins. with
+        nothing older left, the removed keys are dropped
+        """
+        opened = [Segment(os.path.join(self.root, f)) for f in files]
+        try:
+            merged = heapq.merge(
+                *(self.aged(segment, age) for age, segment in enumerate(opened))
+            )
+            strings: Dict[str, bytes] = {}
+            for segment in opened:
+                strings.update(segment.strings)
+            Segment.write(
+                os.path.join(self.root, file),
+                (entry for entry in self.newest(merged) if entry[1] != REMOVED),
+                {k: packed for k, packed in strings.items() if packed != REMOVED},
+            )
+        finally:
+            for segment in opened:
+                segment.close()
+        self.logger.debug(f"compacted {len(files)} segments into {file}")
+
+    @staticmethod
+    def aged(segment: Segment, age: int) -> Iterator[Tuple[int, int, bytes]]:
+        # for each key, the newest segment's entry sorts first
+        for key, packed in segment.integers():
+            yield key, -age, packed
+
+    @staticmethod
+    def newest(merged: Iterable[Tuple[int, int, bytes]]) -> Iterator[Tuple[int, bytes]]:
+        last = None
+        for key, _, packed in merged:
+            if key != last:
+                yield key, packed
+                last = key
+
+    def write_meta(self, meta: Dict) -> None:
+        tmp_path = f"{self.meta_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(meta, f, indent=2)
+        os.replace(tmp_path, self.meta_path)
+
+    def prune(self) -> None:
+        """removes segments meta.json doesn't reference anymore"""
+        if not os.path.isdir(self.root):
+            return
+        referenced = {
+            file for files in self.meta().get("segments", {}).values() for file in files
+        }
+        for file in os.listdir(self.root):
+            if file.endswith(".idmap") and file not in referenced:
+                os.remove(os.path.join(self.root, file))
+
+    def clear(self) -> None:
+        if os.path.exists(self.meta_path):
+            os.remove(self.meta_path)
+        self.prune()
@@ -0,0 +1,97 @@
+import re
+from functools import lru_cache
+from typing import Iterator, List, Tuple
+
+# an spdx license expression, split into parentheses and everything between spaces
+TOKEN = re.compile(r"\(|\)|[^\s()]+")
+OPERATORS = ("AND", "OR")
+
+# a parsed expression: a license (with its exception, if any), or an operator and the
+# expressions it joins
+Node = str | Tuple[str, List["Node"]]
+
+
+class Parser:
+    def __init__(self, expression: str):
+        # crates used to separate alternatives with a slash: MIT/Apache-2.0
+        tokens = TOKEN.findall(expression.replace("/", " OR "))
+        self.tokens: Iterator[str] = iter(tokens)
+        self.token = next(self.tokens, None)
+
+    def advance(self) -> str:
+        token = self.token
+        if token is None:
+            raise ValueError("unexpected end of expression")
+        self.token = next(self.tokens, None)
+        return token
+
+    def operator(self) -> str | None:
+        return self.token.upper() if self.token else None
+
+    def parse(self) -> Node:
+        node = self.expression("OR")
+        if self.token is not None:
+            raise ValueError(f"unexpected {self.token}")
+        return node
+
+    def expression(self, operator: str) -> Node:
+        # AND binds tighter than OR
+        operand = self.atom if operator == "AND" else lambda: self.expression("AND")
+        nodes = [operand()]
+        while self.operator() == operator:
+            self.advance()
+            nodes.append(operand())
+        return nodes[0] if len(nodes) == 1 else (operator, nodes)
+
+    def atom(self) -> Node:
+        token = self.advance()
+        if token == "(":
+            node = self.expression("OR")
+            if self.advance() != ")":
+                raise ValueError("unbalanced parentheses")
+            return node
+        if token == ")" or token.upper() in OPERATORS + ("WITH",):
+            raise ValueError(f"unexpected {token}")
+        if self.operator() == "WITH":
+            self.advance()
+            return f"{token} WITH {self.advance()}"
+        return token
+
+
+def flatten(operator: str, nodes: List[Node]) -> Iterator[Node]:
+    """(A OR B) OR C is A OR B OR C"""
+    for node in nodes:
+        if isinstance(node, str) or node[0] != operator:
+            yield node
+        else:
+            yield from flatten(operator, node[1])
+
+
+def render(node: Node) -> str:
+    if isinstance(node, str):
+        return node
+
+    operator, nodes = node
+    operands = set()
+    for child in flatten(operator, nodes):
+        # an OR inside an AND keeps its parentheses
+        if isinstance(child, str) or operator == "OR":
+            operands.add(render(child))
+        else:
+            operands.add(f"({render(child)})")
+    return f" {operator} ".join(sorted(operands, key=str.casefold))
+
+
+@lru_cache(maxsize=4096)
+def normalize_license(expression: str) -> str:
+    """
+    one name for every way of writing the same license expression: operators in upper
+    case, alternatives joined by OR rather than a slash, the operands of an AND or an
+    OR sorted, without duplicates or redundant parentheses. so "MIT/Apache-2.0" and
+    "Apache-2.0 or MIT" are both "Apache-2.0 OR MIT". anything that doesn't parse only
+    has its whitespace collapsed
+    """
+    try:
+        return render(Parser(expression).parse())
+    except ValueError:
+        return " ".join(expression.split())
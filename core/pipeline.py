@@ -0,0 +1,203 @@
+import time
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from os import getenv
+from queue import Empty, Full, Queue
+from threading import Event, Thread
+from typing import Any, Callable, Deque, Generic, Iterable, List, TypeVar
+
+from core.logger import Logger
+
+# how many threads write batches to the db. 0 runs every stage serially, on one
+# thread. with 1, parsing and writing still overlap, but batches are written in order
+WRITERS = int(getenv("WRITERS", 1))
+# how many parsed batches may wait for the writers, before parsing pauses
+QUEUE_DEPTH = int(getenv("QUEUE_DEPTH", 4))
+
+T = TypeVar("T")
+R = TypeVar("R")
+
+Job = Callable[[], R]
+
+
+# what the parser thread hands over when it's done, or when it failed
+class End:
+    pass
+
+
+class Failed:
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+# runs one load stage as three overlapping steps:
+#
+# 1. a parser thread pulls batches from the transformer into a bounded queue
+# 2. the calling thread takes them off it, and prepares each into a job: this is where
+#    the id caches are read and filled, so they're only ever touched by one thread
+# 3. writer threads run the jobs, each with its own pooled connection
+#
+# the results are handed to `finish` on the calling thread, in the order the batches
+# came in, and so are errors: a failure surfaces only once every batch before it is
+# done. once a write fails, no other one starts, and no more batches are prepared, but
+# the writes already running when it failed are finished, and committed. the queue,
+# and the cap on jobs in flight, keep the parser from running ahead of the writers
+class Pipeline(Generic[T, R]):
+    def __init__(
+        self,
+        name: str,
+        writers: int = WRITERS,
+        depth: int = QUEUE_DEPTH,
+        logger: Logger | None = None,
+    ):
+        self.name = name
+        self.writers = writers
+        self.depth = max(depth, 1)
+        self.logger = logger or Logger(f"{name}_pipeline")
+
+    def run(
+        self,
+        items: Iterable[T],
+        prepare: Callable[[T], Job | None],
+        finish: Callable[[R], Any] | None = None,
+    ) -> None:
+        start = time.perf_counter()
+        if self.writers <= 0:
+            count = self.serial(items, prepare, finish)
+        else:
+            count = self.pipelined(items, prepare, finish)
+        self.logger.debug(
+            f"{self.name}: {count} batches in {time.perf_counter() - start:.1f}s"
+        )
+
+    def serial(
+        self,
+        items: Iterable[T],
+        prepare: Callable[[T], Job | None],
+        finish: Callable[[R], Any] | None,
+    ) -> int:
+        count = 0
+        for item in items:
+            count += 1
+            job = prepare(item)
+            if job is None:
+                continue
+            result = job()
+            if finish:
+                finish(result)
+        return count
+
+    def pipelined(
+        self,
+        items: Iterable[T],
+        prepare: Callable[[T], Job | None],
+        finish: Callable[[R], Any] | None,
+    ) -> int:
+        queue: Queue = Queue(maxsize=self.depth)
+        stop = Event()
+        parser = Thread(
+            target=self.parse, args=(items, queue, stop), name=f"{self.name}-parser"
+        )
+        in_flight: Deque[Future] = deque()
+        # the first write that failed, so the ones queued behind it don't start
+        failed: List[BaseException] = []
+        count = 0
+        waited_on_parser = waited_on_writers = 0.0
+
+        def collect() -> None:
+            nonlocal waited_on_writers
+            future = in_flight.popleft()
+            waited = time.perf_counter()
+            try:
+                result = future.result()
+            except CancelledError:
+                # it was skipped, because a write that started after it failed first
+                raise failed[0]
+            waited_on_writers += time.perf_counter() - waited
+            if finish:
+                finish(result)
+
+        executor = ThreadPoolExecutor(
+            max_workers=self.writers, thread_name_prefix=f"{self.name}-writer"
+        )
+        parser.start()
+        try:
+            while True:
+                waited = time.perf_counter()
+                item = queue.get()
+                waited_on_parser += time.perf_counter() - waited
+
+                if isinstance(item, End):
+                    break
+                if isinstance(item, Failed):
+                    # the batches before the one that failed to parse come first
+                    while in_flight:
+                        collect()
+                    raise item.error
+
+                count += 1
+                job = prepare(item)
+                if job is not None:
+                    in_flight.append(executor.submit(self.write, job, failed))
+
+                # backpressure: don't take more off the queue until the oldest job is
+                # done, which also keeps the results in order. after a failure, the
+                # jobs before it are collected, and then it's raised
+                while in_flight and (
+                    failed or len(in_flight) >= self.writers + self.depth
+                ):
+                    collect()
+
+            while in_flight:
+                collect()
+        finally:
+            stop.set()
+            for future in in_flight:
+                future.cancel()
+            executor.shutdown(wait=True)
+            self.drain(queue)
+            parser.join()
+
+        self.logger.debug(
+            f"{self.name}: waited {waited_on_parser:.1f}s for batches, "
+            f"{waited_on_writers:.1f}s for writes"
+        )
+        return count
+
+    @staticmethod
+    def write(job: Job, failed: List[BaseException]) -> R:
+        if failed:
+            raise CancelledError("another write failed")
+        try:
+            return job()
+        except BaseException as e:
+            failed.append(e)
+            raise
+
+    def parse(self, items: Iterable[T], queue: Queue, stop: Event) -> None:
+        try:
+            for item in items:
+                if not self.put(queue, item, stop):
+                    return
+            self.put(queue, End(), stop)
+        except BaseException as e:
+            self.put(queue, Failed(e), stop)
+
+    @staticmethod
+    def put(queue: Queue, item: Any, stop: Event) -> bool:
+        """blocks while the queue is full, unless the stage is being torn down"""
+        while not stop.is_set():
+            try:
+                queue.put(item, timeout=0.1)
+                return True
+            except Full:
+                continue
+        return False
+
+    @staticmethod
+    def drain(queue: Queue) -> None:
+        while True:
+            try:
+                queue.get_nowait()
+            except Empty:
+                return
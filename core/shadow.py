@@ -0,0 +1,346 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+from os import getenv
+from typing import Any, ContextManager, Dict, List, Tuple
+
+from psycopg2.errors import LockNotAvailable
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+from core.bulk import raw_cursor
+from core.dag import Stage
+from core.db import MAX_DELETE_FRACTION
+from core.fastload import INDEX_WORKERS, LOOKUP_COLUMNS
+from core.logger import Logger
+
+# where the tables readers see live
+LIVE = "public"
+# how long the load waits for the writes in progress to lock the live tables. readers
+# queue behind a lock that's waited for, so it gives up rather than wait for long
+SHADOW_LOCK_TIMEOUT = getenv("SHADOW_LOCK_TIMEOUT", "30s")
+# how long the swap waits for readers to let go of the live tables, each attempt
+SWAP_LOCK_TIMEOUT = "5s"
+SWAP_ATTEMPTS = 3
+
+# the tables with a foreign key to `%s`
+REFERENCING = """
+SELECT DISTINCT c.relname FROM pg_constraint f
+JOIN pg_class c ON c.oid = f.conrelid
+WHERE f.confrelid = %s::regclass AND f.contype = 'f' AND f.conrelid <> f.confrelid
+"""
+
+CONSTRAINTS = """
+SELECT conname, contype, pg_get_constraintdef(oid) FROM pg_constraint
+WHERE conrelid = %s::regclass AND contype IN ('p', 'u', 'f')
+ORDER BY conname
+"""
+
+# a table's indexes that back no constraint, whether they're unique, and their columns
+INDEXES = """
+SELECT i.relname, pg_get_indexdef(i.oid), x.indisunique, ARRAY(
+    SELECT a.attname::text FROM unnest(x.indkey) k
+    JOIN pg_attribute a ON a.attrelid = x.indrelid AND a.attnum = k
+)
+FROM pg_index x
+JOIN pg_class i ON i.oid = x.indexrelid
+WHERE x.indrelid = %s::regclass
+AND NOT EXISTS (SELECT 1 FROM pg_constraint c WHERE c.conindid = x.indexrelid)
+ORDER BY i.relname
+"""
+
+# who else may read or write a table, which a new table doesn't inherit
+GRANTS = """
+SELECT coalesce(quote_ident(r.rolname), 'PUBLIC'), a.privilege_type
+FROM pg_class c, aclexplode(c.relacl) a
+LEFT JOIN pg_roles r ON r.oid = a.grantee
+WHERE c.oid = %s::regclass AND a.grantee <> c.relowner
+"""
+
+
+# loads a package manager's tables into copies in a schema of their own, and swaps
+# them in all at once, so readers never see a load halfway
+#
+# the copies are unlogged, seeded with the live rows, so the load upserts, and keeps
+# the ids, just like it would into the live tables. only their primary keys, unique
+# indexes and the indexes on `LOOKUP_COLUMNS` are built before the load, since it
+# conflicts on and looks rows up by those. every connection the load checks out
+# resolves table names to the copies first, and doesn't wait for its commits to be
+# flushed. once the load is done, the rest of the indexes are built, a few at once,
+# the copies are logged, their foreign keys added and validated, and they're analyzed
+#
+# if no table shrank by more than `MAX_DELETE_FRACTION`, the live tables are moved out
+# of the way, and the copies into their place, in one transaction, and the old tables
+# dropped. tables with a foreign key to one that's copied are copied too, so no key
+# ever points at a table that was swapped out
+#
+# the tables are shared by every package manager, so every package manager's rows are
+# copied, and anything written to the live tables after that would be dropped with
+# them. so from before they're copied until they're swapped, i.e. for the whole load,
+# they're locked against writes, in the transaction that swaps them: readers aren't
+# blocked, but every other loader's writes wait for the swap. the lock is given up on
+# if it isn't granted within `SHADOW_LOCK_TIMEOUT`, and its transaction, idle for
+# most of the load, is exempt from `idle_in_transaction_session_timeout`
+class ShadowLoad:
+    def __init__(self, name: str, engine: Engine, workers: int = INDEX_WORKERS):
+        self.engine = engine
+        self.workers = max(1, workers)
+        self.schema = f"{name}_shadow"
+        self.retired = f"{name}_retired"
+        self.logger = Logger(f"{name}_shadow")
+        self.tables: List[str] = []
+        # what's built before the load, and once it's done, by table
+        self.needed: Dict[str, List[str]] = {}
+        self.indexes: Dict[str, List[str]] = {}
+        self.foreign_keys: Dict[str, Dict[str, str]] = {}
+        self.attached = False
+        # holds the live tables' lock, and swaps them
+        self.connection: Any = None
+
+    def cursor(self) -> ContextManager[Any]:
+        search_path = f"SET LOCAL search_path TO {self.schema}, {LIVE}"
+        return raw_cursor(self.engine, search_path)
+
+    def execute(self, statement: str) -> None:
+        with self.cursor() as cursor:
+            cursor.execute(statement)
+
+    def parallel(self, statements: List[str], name: str) -> None:
+        with ThreadPoolExecutor(
+            max_workers=self.workers, thread_name_prefix=f"shadow-{name}"
+        ) as executor:
+            for future in [executor.submit(self.execute, s) for s in statements]:
+                future.result()
+
+    def prepare(self, stages: List[Stage]) -> List[Stage]:
+        """
+        copies the tables the stages fill into the shadow schema, and points the
+        engine's connections at them
+        """
+        start = time.perf_counter()
+        self.execute(
+            f"DROP SCHEMA IF EXISTS {self.schema} CASCADE; "
+            f"DROP SCHEMA IF EXISTS {self.retired} CASCADE; "
+            f"CREATE SCHEMA {self.schema}"
+        )
+
+        with self.cursor() as cursor:
+            # so the live tables are described by the names the copies will have
+            cursor.execute(f"SET LOCAL search_path TO {LIVE}")
+            self.tables = self.referenced(
+                cursor, [stage.model.__tablename__ for stage in stages if stage.model]
+            )
+            for table in self.tables:
+                self.create(cursor, table)
+
+        self.lock()
+        self.parallel(
+            [
+                f"INSERT INTO {self.schema}.{t} SELECT * FROM {LIVE}.{t}"
+                for t in self.tables
+            ],
+            "seed",
+        )
+        # a table at a time, its indexes a few at once
+        for table in self.tables:
+            self.parallel(self.needed.pop(table), table)
+
+        self.attach()
+        self.logger.log(
+            f"loading into {self.schema}: {', '.join(self.tables)}, copied in "
+            f"{time.perf_counter() - start:.1f}s"
+        )
+        return stages
+
+    @staticmethod
+    def referenced(cursor: Any, tables: List[str]) -> List[str]:
+        """the tables, and every table with a foreign key to one of them"""
+        tables = list(dict.fromkeys(tables))
+        for table in tables:
+            cursor.execute(REFERENCING, (f"{LIVE}.{table}",))
+            for (referencing,) in cursor.fetchall():
+                if referencing not in tables:
+                    tables.append(referencing)
+        return tables
+
+    def create(self, cursor: Any, table: str) -> None:
+        """an empty, unlogged copy of a live table, and what's built for it later"""
+        live = f"{LIVE}.{table}"
+        cursor.execute(
+            f"CREATE UNLOGGED TABLE {self.schema}.{table} (LIKE {live} "
+            "INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING GENERATED "
+            "INCLUDING IDENTITY INCLUDING STORAGE)"
+        )
+        cursor.execute(GRANTS, (live,))
+        for grantee, privilege in cursor.fetchall():
+            cursor.execute(f"GRANT {privilege} ON {self.schema}.{table} TO {grantee}")
+
+        # the load conflicts on the constraints and unique indexes, and looks rows
+        # up by the lookup columns, so those are built before it
+        self.needed[table], self.indexes[table] = [], []
+        self.foreign_keys[table] = {}
+        cursor.execute(CONSTRAINTS, (live,))
+        for name, kind, definition in cursor.fetchall():
+            if kind == "f":
+                self.foreign_keys[table][name] = definition
+            else:
+                self.needed[table].append(
+                    f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition}'
+                )
+
+        cursor.execute(INDEXES, (live,))
+        for name, definition, unique, columns in cursor.fetchall():
+            definition = definition.replace(f" ON {live} ", f" ON {table} ")
+            if f" ON {table} " not in definition:
+                raise ValueError(f"can't copy {name} to {self.schema}: {definition}")
+            if unique or set(columns) & set(LOOKUP_COLUMNS):
+                self.needed[table].append(definition)
+            else:
+                self.indexes[table].append(definition)
+
+    def lock(self) -> None:
+        """keeps everyone else from writing to the live tables until they're swapped"""
+        tables = ", ".join(f"{LIVE}.{table}" for table in self.tables)
+        start = time.perf_counter()
+        self.connection = self.engine.raw_connection()
+        with self.connection.cursor() as cursor:
+            cursor.execute(
+                f"SET LOCAL lock_timeout = '{SHADOW_LOCK_TIMEOUT}'; "
+                "SET LOCAL idle_in_transaction_session_timeout = 0"
+            )
+            cursor.execute(f"LOCK TABLE {tables} IN EXCLUSIVE MODE")
+            cursor.execute("SET LOCAL lock_timeout = 0")
+        self.logger.log(
+            f"locked the live tables against writes, after waiting "
+            f"{time.perf_counter() - start:.1f}s for the ones in progress"
+        )
+
+    def unlock(self) -> None:
+        if self.connection is not None:
+            self.connection.rollback()
+            self.connection.close()
+            self.connection = None
+
+    def checkout(self, connection: Any, record: Any, proxy: Any) -> None:
+        # unlogged tables lose their rows in a crash anyway, so commits needn't wait
+        # for the WAL
+        with connection.cursor() as cursor:
+            cursor.execute(
+                f"SET search_path TO {self.schema}, {LIVE}; "
+                "SET synchronous_commit TO off"
+            )
+        connection.commit()
+
+    def attach(self) -> None:
+        event.listen(self.engine, "checkout", self.checkout)
+        self.attached = True
+
+    def detach(self) -> None:
+        """points the engine back at the live tables"""
+        if self.attached:
+            event.remove(self.engine, "checkout", self.checkout)
+            self.attached = False
+            # the pooled connections still have the shadow schema's search path
+            self.engine.dispose()
+
+    def finish(self, loaded: Dict[str, Tuple[int, int]]) -> None:
+        """
+        builds what's left of the copies, checks them, and swaps them in. `loaded` is
+        how many of the package manager's rows each table ended up with, and how many
+        the snapshot has, see DB.delete_missing
+        """
+        start = time.perf_counter()
+        self.detach()
+
+        self.parallel(
+            [statement for table in self.tables for statement in self.indexes[table]],
+            "index",
+        )
+        # a logged table can't reference an unlogged one, so the foreign keys go last
+        self.parallel(
+            [f"ALTER TABLE {self.schema}.{t} SET LOGGED" for t in self.tables], "log"
+        )
+        for table, foreign_keys in self.foreign_keys.items():
+            for name, definition in foreign_keys.items():
+                self.execute(
+                    f'ALTER TABLE {table} ADD CONSTRAINT "{name}" {definition} '
+                    "NOT VALID"
+                )
+                self.execute(f'ALTER TABLE {table} VALIDATE CONSTRAINT "{name}"')
+        self.parallel([f"ANALYZE {self.schema}.{t}" for t in self.tables], "analyze")
+        self.logger.log(f"built and logged {self.schema}")
+
+        self.validate(loaded)
+        self.swap()
+        self.logger.log(
+            f"swapped {len(self.tables)} tables in "
+            f"{time.perf_counter() - start:.1f}s after the load"
+        )
+
+    def validate(self, loaded: Dict[str, Tuple[int, int]]) -> None:
+        """
+        refuses copies that are missing more of the snapshot's rows, or lost more of
+        the live ones, than a load may delete
+        """
+        for table, (rows, source) in loaded.items():
+            self.logger.log(f"{table}: {rows} of the snapshot's {source} rows loaded")
+            if source - rows > MAX_DELETE_FRACTION * source:
+                raise ValueError(
+                    f"{self.schema}.{table} has {rows} of the snapshot's {source} "
+                    f"rows, more than {MAX_DELETE_FRACTION:.1%} fewer, not swapping"
+                )
+        if not loaded:
+            self.logger.warn("no row counts from the snapshot to check the load by")
+
+        with self.cursor() as cursor:
+            for table in self.tables:
+                cursor.execute(
+                    f"SELECT (SELECT count(*) FROM {self.schema}.{table}), "
+                    f"(SELECT count(*) FROM {LIVE}.{table})"
+                )
+                rows, live = cursor.fetchone()
+                self.logger.log(f"{table}: {rows} rows, {live} live")
+                if live - rows > MAX_DELETE_FRACTION * live:
+                    raise ValueError(
+                        f"{self.schema}.{table} has {rows} rows, {live} live, "
+                        f"more than {MAX_DELETE_FRACTION:.1%} fewer, not swapping"
+                    )
+
+    def swap(self) -> None:
+        # moving a table takes its lock, which waits for the queries reading it. so
+        # it only waits so long, and the queries queued behind it with it. a failed
+        # attempt is rolled back to the savepoint, which keeps the write lock
+        statements = [f"CREATE SCHEMA {self.retired}"]
+        for table in self.tables:
+            statements += [
+                f"ALTER TABLE {LIVE}.{table} SET SCHEMA {self.retired}",
+                f"ALTER TABLE {self.schema}.{table} SET SCHEMA {LIVE}",
+            ]
+
+        with self.connection.cursor() as cursor:
+            for attempt in range(1, SWAP_ATTEMPTS + 1):
+                cursor.execute("SAVEPOINT swap")
+                try:
+                    cursor.execute(f"SET LOCAL lock_timeout = '{SWAP_LOCK_TIMEOUT}'")
+                    for statement in statements:
+                        cursor.execute(statement)
+                    break
+                except LockNotAvailable:
+                    cursor.execute("ROLLBACK TO SAVEPOINT swap")
+                    if attempt == SWAP_ATTEMPTS:
+                        raise
+                    self.logger.warn(f"the live tables are busy, retrying ({attempt})")
+        self.connection.commit()
+        self.unlock()
+
+        self.execute(
+            f"DROP SCHEMA {self.retired} CASCADE; DROP SCHEMA {self.schema} CASCADE"
+        )
+
+    def close(self) -> None:
+        """
+        detaches from the engine, lets go of the live tables, and drops whatever copies
+        are left, e.g. from a load that failed
+        """
+        self.detach()
+        self.unlock()
+        self.execute(f"DROP SCHEMA IF EXISTS {self.schema} CASCADE")
@@ -0,0 +1,128 @@
+from os import getenv
+from threading import Lock
+from typing import Iterable, Iterator, List, Tuple
+
+from core.logger import Logger
+from core.structs import Batch
+from core.utils import env_vars
+
+# how many rows each batch a transformer yields holds, and what a stage's batches
+# start at, before there's anything to size them by
+BATCH_SIZE = int(getenv("BATCH_SIZE", 10000))
+# how long writing one batch should take. batches are sized so they're big enough
+# to amortize the round trip, and small enough to keep the pipeline moving
+TARGET_BATCH_SECONDS = float(getenv("TARGET_BATCH_SECONDS", 1.0))
+MIN_BATCH_ROWS = int(getenv("MIN_BATCH_ROWS", 100))
+MAX_BATCH_ROWS = int(getenv("MAX_BATCH_ROWS", 100000))
+ADAPTIVE_BATCHES = env_vars("ADAPTIVE_BATCHES", "true")
+# how much each new measurement moves the rolling averages
+SMOOTHING = 0.3
+# how many rows of a batch are looked at to estimate its width
+SAMPLE_ROWS = 50
+
+
+def row_bytes(rows: List[Tuple]) -> float:
+    """the average width of a row, estimated from a sample of them"""
+    sample = rows[:: max(1, len(rows) // SAMPLE_ROWS)][:SAMPLE_ROWS]
+    if not sample:
+        return 0.0
+    widths = (
+        sum(len(str(value)) for value in row if value is not None) for row in sample
+    )
+    return sum(widths) / len(sample)
+
+
+# sizes one table's batches from how fast its writes have actually been going
+#
+# every write reports its rows, bytes, and how long it took, which feed rolling rows/s
+# and bytes/s. the next batch is as many rows as either says fits in the target
+# latency, at most double the last one, and never more than MAX_BATCH_ROWS. a
+# stage's sizer is kept by DB, so the next load of the same table starts from what
+# this one learnt
+class BatchSizer:
+    def __init__(self, name: str, initial: int, logger: Logger | None = None):
+        self.name = name
+        self.logger = logger or Logger(f"{name}_sizer")
+        self.limit = MAX_BATCH_ROWS
+        self.size = max(MIN_BATCH_ROWS, min(initial, self.limit))
+        self.rows_per_second = 0.0
+        self.bytes_per_second = 0.0
+        self.row_bytes = 0.0
+        self.lock = Lock()
+        self.reset()
+
+    def reset(self) -> None:
+        """starts a new stage's tally, keeping the rates"""
+        self.sizes: List[int] = []
+        self.rows = 0
+        self.bytes = 0.0
+        self.seconds = 0.0
+
+    def rebatch(self, batches: Iterable[Batch]) -> Iterator[Batch]:
+        """re-chunks batches of any size into batches of the current size"""
+        if not ADAPTIVE_BATCHES:
+            yield from batches
+            return
+
+        pending: List[Tuple] = []
+        columns: Tuple[str, ...] = ()
+        for batch in batches:
+            columns = batch.columns
+            pending.extend(batch.rows)
+            while len(pending) >= self.size:
+                size = self.size
+                self.sizes.append(size)
+                yield Batch(columns, pending[:size])
+                pending = pending[size:]
+        if pending:
+            self.sizes.append(len(pending))
+            yield Batch(columns, pending)
+
+    def record(self, rows: List[Tuple], seconds: float) -> None:
+        """updates the rates with a finished write, and resizes the next batches"""
+        if not rows or seconds <= 0:
+            return
+
+        width = row_bytes(rows)
+        nbytes = width * len(rows)
+        with self.lock:
+            self.rows += len(rows)
+            self.bytes += nbytes
+            self.seconds += seconds
+            self.row_bytes = self.smooth(self.row_bytes, width)
+            self.rows_per_second = self.smooth(
+                self.rows_per_second, len(rows) / seconds
+            )
+            self.bytes_per_second = self.smooth(self.bytes_per_second, nbytes / seconds)
+
+            if ADAPTIVE_BATCHES:
+                self.resize()
+
+    @staticmethod
+    def smooth(average: float, value: float) -> float:
+        if not average:
+            return value
+        return (1 - SMOOTHING) * average + SMOOTHING * value
+
+    def resize(self) -> None:
+        by_rows = self.rows_per_second * TARGET_BATCH_SECONDS
+        by_bytes = (
+            self.bytes_per_second * TARGET_BATCH_SECONDS / self.row_bytes
+            if self.row_bytes
+            else by_rows
+        )
+        size = int(min(by_rows, by_bytes, self.size * 2, self.limit))
+        size = max(MIN_BATCH_ROWS, size)
+        if size != self.size:
+            self.logger.debug(f"{self.name}: batch size {self.size} -> {size}")
+            self.size = size
+
+    def report(self) -> None:
+        if not self.sizes or not self.seconds:
+            return
+        self.logger.log(
+            f"{self.name}: {len(self.sizes)} batches of {min(self.sizes)}-"
+            f"{max(self.sizes)} rows (next {self.size}, limit {self.limit}), "
+            f"{self.rows / self.seconds:,.0f} rows/s, "
+            f"{self.bytes / self.seconds / 1024 / 1024:.1f}MB/s written"
+        )
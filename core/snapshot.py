@@ -0,0 +1,230 @@
+import json
+import os
+from datetime import datetime, timedelta
+from hashlib import sha256
+from os import getenv
+from shutil import rmtree
+from tempfile import mkdtemp
+from typing import Dict, List
+
+from core.logger import Logger
+
+# retention: how many snapshots to keep, and for how many days. 0 means no limit
+KEEP_SNAPSHOTS = int(getenv("KEEP_SNAPSHOTS", 7))
+KEEP_DAYS = int(getenv("KEEP_DAYS", 0))
+MANIFEST = ".manifest.json"
+# which snapshot the db was last loaded from
+LOADED = "loaded.json"
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path: str) -> str:
+    hash = sha256()
+    with open(path, "rb") as f:
+        while data := f.read(CHUNK_SIZE):
+            hash.update(data)
+    return hash.hexdigest()
+
+
+# a snapshot store manages the directories under data/<name>: every fetch is built in
+# a staging directory, published under its final name in one rename, and only then
+# does the `latest` symlink swap over to it, so readers never see a half-written
+# snapshot. files that didn't change since the previous snapshot are hard links to
+# it, so history costs disk only for what actually changed
+#
+# snapshots are shared by hard links, so treat everything in them as read-only
+class SnapshotStore:
+    def __init__(
+        self,
+        root: str,
+        keep: int = KEEP_SNAPSHOTS,
+        keep_days: int = KEEP_DAYS,
+        logger: Logger | None = None,
+    ):
+        self.root = root
+        self.keep = keep
+        self.keep_days = keep_days
+        self.latest_symlink = os.path.join(root, "latest")
+        self.loaded_path = os.path.join(root, LOADED)
+        self.logger = logger or Logger("snapshots")
+
+    def path(self, name: str) -> str:
+        return os.path.join(self.root, name)
+
+    def exists(self, name: str) -> bool:
+        return os.path.isdir(self.path(name))
+
+    def staging(self) -> str:
+        """a fresh directory to build a snapshot in, before it's published"""
+        os.makedirs(self.root, exist_ok=True)
+        staging_path = mkdtemp(prefix=".partial-", dir=self.root)
+        os.chmod(staging_path, 0o755)
+        return staging_path
+
+    def latest(self) -> str | None:
+        """the name of the snapshot the latest symlink points at"""
+        if not os.path.islink(self.latest_symlink):
+            return None
+        return os.path.basename(os.readlink(self.latest_symlink))
+
+    def snapshots(self) -> List[str]:
+        """every published snapshot, oldest first"""
+        if not os.path.isdir(self.root):
+            return []
+
+        names = [
+            name
+            for name in os.listdir(self.root)
+            if not name.startswith(".")
+            and not os.path.islink(self.path(name))
+            and os.path.isdir(self.path(name))
+        ]
+        return sorted(names, key=self.created_at)
+
+    def previous(self) -> str | None:
+        """the snapshot published right before the latest one"""
+        latest = self.latest()
+        older = [name for name in self.snapshots() if name != latest]
+        return older[-1] if older else None
+
+    def mark_loaded(self, load_history: str) -> None:
+        """records that the latest snapshot is what the db holds, as of a load"""
+        tmp_path = f"{self.loaded_path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"snapshot": self.latest(), "load_history": load_history}, f)
+        os.replace(tmp_path, self.loaded_path)
+
+    def loaded(self, load_history: str | None) -> str | None:
+        """
+        the snapshot the db was last loaded from, if it's still here, and nothing was
+        loaded since. a load that failed leaves it as it was, so the next one starts
+        from the last snapshot that did go in
+        """
+        try:
+            with open(self.loaded_path) as f:
+                loaded = json.load(f)
+        except (OSError, ValueError):
+            return None
+
+        if load_history is None or loaded.get("load_history") != load_history:
+            return None
+        if not loaded.get("snapshot") or not self.exists(loaded["snapshot"]):
+            return None
+        return loaded["snapshot"]
+
+    def created_at(self, name: str) -> datetime:
+        manifest = self.manifest(name)
+        if "created_at" in manifest:
+            return datetime.fromisoformat(manifest["created_at"])
+        return datetime.fromtimestamp(os.path.getmtime(self.path(name)))
+
+    def manifest(self, name: str) -> Dict:
+        """what publish recorded about a snapshot: when, and each file's size / hash"""
+        manifest_path = os.path.join(self.path(name), MANIFEST)
+        if not os.path.exists(manifest_path):
+            return {}
+        try:
+            with open(manifest_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def publish(self, staging_path: str, name: str, replace: bool = False) -> str:
+        """
+        publishes a staging directory as snapshot `name`, and makes it the latest
+
+        if `name` already exists, the staged copy is thrown away, unless `replace` is
+        set, in which case it takes the existing snapshot's place
+        """
+        snapshot_path = self.path(name)
+
+        if self.exists(name) and not replace:
+            self.logger.log(f"snapshot {name} already exists, not writing it again")
+            rmtree(staging_path)
+            return self.activate(name)
+
+        files = self.deduplicate(staging_path, self.latest())
+        self.write_manifest(staging_path, files)
+
+        if self.exists(name):
+            # move the old one aside first, so `name` is never missing or half there
+            retired = mkdtemp(prefix=".retired-", dir=self.root)
+            os.rename(snapshot_path, os.path.join(retired, name))
+            os.rename(staging_path, snapshot_path)
+            rmtree(retired)
+        else:
+            os.rename(staging_path, snapshot_path)
+
+        self.logger.debug(f"published snapshot {name}")
+        return self.activate(name)
+
+    def activate(self, name: str) -> str:
+        """atomically points the latest symlink at a snapshot, then prunes old ones"""
+        tmp_symlink = f"{self.latest_symlink}.tmp"
+        if os.path.lexists(tmp_symlink):
+            os.remove(tmp_symlink)
+        os.symlink(name, tmp_symlink)
+        os.replace(tmp_symlink, self.latest_symlink)
+        self.logger.debug(f"{self.latest_symlink} -> {name}")
+
+        self.prune()
+        return self.path(name)
+
+    def deduplicate(self, staging_path: str, previous: str | None) -> Dict[str, Dict]:
+        """
+        replaces every staged file that's identical to the one in the previous snapshot
+        with a hard link to it, and returns the size / hash of every staged file
+        """
+        known = self.manifest(previous).get("files", {}) if previous else {}
+        files: Dict[str, Dict] = {}
+        linked = 0
+
+        for root, _, names in os.walk(staging_path):
+            for file_name in names:
+                staged = os.path.join(root, file_name)
+                relative = os.path.relpath(staged, staging_path)
+                entry = {"size": os.path.getsize(staged), "sha256": file_digest(staged)}
+                files[relative] = entry
+
+                if known.get(relative) != entry:
+                    continue
+
+                original = os.path.join(self.path(previous), relative)
+                try:
+                    tmp_link = f"{staged}.link"
+                    os.link(original, tmp_link)
+                    os.replace(tmp_link, staged)
+                    linked += 1
+                except OSError as e:
+                    # e.g. a different filesystem, then we just keep the copy
+                    self.logger.debug(f"couldn't link {relative}: {e}")
+
+        if linked:
+            self.logger.log(f"{linked} files unchanged since {previous}, hard linked")
+        return files
+
+    def write_manifest(self, staging_path: str, files: Dict[str, Dict]) -> None:
+        manifest = {"created_at": datetime.now().isoformat(), "files": files}
+        with open(os.path.join(staging_path, MANIFEST), "w") as f:
+            json.dump(manifest, f, indent=2)
+
+    def prune(self) -> None:
+        """drops snapshots past the retention policy. the latest one always stays"""
+        latest = self.latest()
+        snapshots = self.snapshots()
+        now = datetime.now()
+        expired = []
+
+        for i, name in enumerate(reversed(snapshots)):
+            if name == latest:
+                continue
+            too_many = self.keep and i >= self.keep
+            too_old = self.keep_days and now - self.created_at(name) > timedelta(
+                days=self.keep_days
+            )
+            if too_many or too_old:
+                expired.append(name)
+
+        for name in expired:
+            self.logger.log(f"removing snapshot {name}, it's past retention")
+            rmtree(self.path(name), ignore_errors=True)
@@ -0,0 +1,63 @@
+from dataclasses import dataclass, field
+from typing import Any, Dict, List, Tuple
+
+# the shape of every transformer output, in order
+# transformers yield batches of plain tuples in these shapes, and the loaders in
+# core.db unpack them positionally, so no row ever becomes a dict or an ORM object
+PACKAGES = ("import_id", "name", "readme")
+VERSIONS = (
+    "crate_id",
+    "version",
+    "import_id",
+    "size",
+    "published_at",
+    "license",
+    "downloads",
+    "checksum",
+)
+DEPENDENCIES = ("version_id", "crate_id", "semver_range", "dependency_type_id")
+USERS = ("import_id", "username", "source_id")
+USER_PACKAGES = ("crate_id", "owner_id")
+USER_VERSIONS = ("version_id", "published_by")
+URLS = ("url", "url_type_id")
+PACKAGE_URLS = ("import_id", "url", "url_type_id")
+
+
+@dataclass
+class Batch:
+    columns: Tuple[str, ...]
+    rows: List[Tuple[Any, ...]]
+
+    def __len__(self) -> int:
+        return len(self.rows)
+
+    def column(self, name: str) -> List[Any]:
+        i = self.columns.index(name)
+        return [row[i] for row in self.rows]
+
+    def expect(self, columns: Tuple[str, ...]) -> None:
+        """guards the positional unpacking in the loaders"""
+        if self.columns != columns:
+            raise ValueError(f"expected a batch of {columns}, got {self.columns}")
+
+
+# what writing a batch did to its rows: how many went in, how many refreshed a row that
+# was already there, and how many were already there as they are. with a key, it also
+# has the id of every row, by that key
+@dataclass
+class Written:
+    inserted: int = 0
+    updated: int = 0
+    unchanged: int = 0
+    ids: Dict[Any, Any] = field(default_factory=dict)
+
+    def add(self, other: "Written") -> None:
+        self.inserted += other.inserted
+        self.updated += other.updated
+        self.unchanged += other.unchanged
+
+    def __str__(self) -> str:
+        return (
+            f"{self.inserted} inserted, {self.updated} updated, "
+            f"{self.unchanged} unchanged"
+        )
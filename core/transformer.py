@@ -1,16 +1,109 @@
 import csv
+import gzip
+import io
+import json
 import os
-from typing import Dict
+import pickle
+import tarfile
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass
+from operator import itemgetter
+from tempfile import SpooledTemporaryFile
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Set, TextIO, Tuple
 
 from sqlalchemy import UUID
 
+from core.diff import FileDiff
 from core.logger import Logger
+from core.sizing import BATCH_SIZE
+from core.structs import Batch
+from core.utils import is_tarball
 
 # this is a temporary fix, but sometimes the raw files have weird characters
 # and lots of data within certain fields
 # this fix allows us to read the files with no hassles
 csv.field_size_limit(10000000)
 
+# spools keep up to SPOOL_MEMORY bytes in memory before spilling to a temporary file
+SPOOL_MEMORY = 64 * 1024 * 1024
+SPOOL_BATCH = 1000
+
+# compressed files we can read directly, in order of preference
+COMPRESSED = (".gz", ".zst")
+
+
+@dataclass
+class IndexEntry:
+    path: str  # the file on disk, or the tarball it's in
+    size: int  # uncompressed, if we know it
+    stamp: Tuple[int, float]  # size and mtime of path, when we indexed it
+    member: str | None = None  # the member name, for files inside a tarball
+
+    def valid(self) -> bool:
+        """whether path is still the file we indexed"""
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return False
+        return (stat.st_size, stat.st_mtime) == tuple(self.stamp)
+
+
+# a projection is called with the source columns of one row of a raw file, as
+# positional arguments, and returns zero or more output rows
+Projection = Callable[..., Iterable[Tuple]]
+
+
+@dataclass
+class Output:
+    file: str  # the key of the raw file in Transformer.files
+    source: Tuple[str, ...]  # the columns of the raw file the projection needs
+    columns: Tuple[str, ...]  # the columns of the rows it returns, see core.structs
+    project: Projection
+
+
+def getter(header: List[str], columns: Tuple[str, ...]) -> Callable[[List], Tuple]:
+    """picks `columns` out of a csv row, as a tuple, always"""
+    indices = [header.index(column) for column in columns]
+    if len(indices) == 1:
+        i = indices[0]
+        return lambda row: (row[i],)
+    return itemgetter(*indices)
+
+
+class Spool:
+    """an append-only stream of rows, that can be read back once it's written"""
+
+    def __init__(self, max_size: int = SPOOL_MEMORY):
+        self.file = SpooledTemporaryFile(max_size=max_size)
+        self.pending: List[Any] = []
+        self.count = 0
+
+    def extend(self, records: Iterable[Any]) -> None:
+        for record in records:
+            self.pending.append(record)
+            self.count += 1
+        if len(self.pending) >= SPOOL_BATCH:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            pickle.dump(self.pending, self.file, protocol=pickle.HIGHEST_PROTOCOL)
+            self.pending = []
+
+    def __iter__(self) -> Iterator[Any]:
+        self.flush()
+        self.file.seek(0)
+        while True:
+            try:
+                batch = pickle.load(self.file)
+            except EOFError:
+                return
+            yield from batch
+
+    def close(self) -> None:
+        self.file.close()
+
 
 # the transformer class knows what files to open, and provide a generic wrapper
 # for the data within the files
@@ -29,17 +122,353 @@ class Transformer:
             "urls": "",
         }
         self.url_types: Dict[str, UUID] = {}
+        # every output, and how to get it from the raw files
+        self.outputs: Dict[str, Output] = {}
+        self.batch_size = BATCH_SIZE
+        self.spools: Dict[str, Spool] = {}
+        # where every file in the snapshot lives, see build_index
+        self.file_index: Dict[str, IndexEntry] | None = None
+        self.index_root: str | None = None
+        # for an incremental load, the snapshot the db was last loaded from. then only
+        # the rows that changed since are read from the files with a primary key in
+        # `keys`, and the keys of the ones that are gone end up in `diffs`
+        self.previous: str | None = None
+        self.keys: Dict[str, Tuple[str, ...]] = {}
+        self.diffs: Dict[str, FileDiff] = {}
 
-    def finder(self, file_name: str) -> str:
+    def manifest(self) -> Set[str]:
+        """the files this transformer reads, so fetchers can skip everything else"""
+        return {file_name for file_name in self.files.values() if file_name}
+
+    def build_index(self) -> Dict[str, IndexEntry]:
+        """
+        maps every file name in the latest snapshot to where it lives, with a single
+        walk of the snapshot. plain files win over compressed ones (.gz, .zst), which
+        win over members of a tarball
+        """
         input_dir = os.path.realpath(self.input)
+        if self.file_index is not None and self.index_root == input_dir:
+            return self.file_index
+
+        index = self.index_files(input_dir)
+        self.logger.debug(f"indexed {len(index)} files in {input_dir}")
+        self.file_index = index
+        self.index_root = input_dir
+        return index
+
+    def index_files(self, input_dir: str) -> Dict[str, IndexEntry]:
+        index: Dict[str, IndexEntry] = {}
+        priorities: Dict[str, int] = {}
+        tarballs = []
+
+        def add(name: str, entry: IndexEntry, priority: int) -> None:
+            if priorities.get(name, len(COMPRESSED) + 2) > priority:
+                index[name] = entry
+                priorities[name] = priority
 
         for root, _, files in os.walk(input_dir):
-            if file_name in files:
-                return os.path.join(root, file_name)
-        else:
-            self.logger.error(f"{file_name} not found in {input_dir}")
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if is_tarball(file_name):
+                    tarballs.append(path)
+                    continue
+
+                stat = os.stat(path)
+                entry = IndexEntry(path, stat.st_size, (stat.st_size, stat.st_mtime))
+                name, extension = os.path.splitext(file_name)
+                if extension in COMPRESSED:
+                    add(name, entry, COMPRESSED.index(extension) + 1)
+                else:
+                    add(file_name, entry, 0)
+
+        for path in tarballs:
+            stat = os.stat(path)
+            for name, (member, size) in self.tarball_members(path).items():
+                entry = IndexEntry(path, size, (stat.st_size, stat.st_mtime), member)
+                add(name, entry, len(COMPRESSED) + 1)
+
+        return index
+
+    def tarball_members(self, path: str) -> Dict[str, Tuple[str, int]]:
+        """
+        lists the files in a tarball as {file name: (member name, size)}
+
+        that takes reading the whole tarball, so the listing is cached next to it, and
+        reused for as long as the tarball doesn't change
+        """
+        index_path = f"{path}.index.json"
+        stat = os.stat(path)
+        stamp = [stat.st_size, stat.st_mtime]
+
+        if os.path.exists(index_path):
+            try:
+                with open(index_path) as f:
+                    cached = json.load(f)
+                if cached["stamp"] == stamp:
+                    return {name: tuple(v) for name, v in cached["members"].items()}
+            except (ValueError, KeyError):
+                pass
+
+        members = {}
+        with tarfile.open(path, mode="r:gz") as tar:
+            for member in tar:
+                if member.isfile():
+                    members[os.path.basename(member.name)] = (member.name, member.size)
+
+        try:
+            with open(index_path, "w") as f:
+                json.dump({"stamp": stamp, "members": members}, f)
+        except OSError as e:
+            self.logger.debug(f"couldn't cache the listing of {path}: {e}")
+
+        return members
+
+    def resolve(self, name: str) -> IndexEntry:
+        """
+        resolves a logical name ("versions") or a file name ("versions.csv") to where
+        it lives in the latest snapshot. the index is rebuilt if the file changed
+        """
+        file_name = self.files.get(name) or name
+        entry = self.build_index().get(file_name)
+
+        if entry is None or not entry.valid():
+            self.file_index = None
+            entry = self.build_index().get(file_name)
+
+        if entry is None:
+            self.logger.error(f"{file_name} not found in {self.index_root}")
             raise FileNotFoundError(f"Missing {file_name} file")
 
+        return entry
+
+    def finder(self, file_name: str) -> str:
+        """
+        the path of file_name in the latest snapshot, as a plain file, a compressed
+        file_name.gz / file_name.zst, or failing both, the tarball that contains it
+        """
+        return self.resolve(file_name).path
+
+    def sizes(self) -> Dict[str, int]:
+        """the size of each of our inputs, for progress and throughput reporting"""
+        return {
+            key: self.resolve(key).size
+            for key, file_name in self.files.items()
+            if file_name
+        }
+
+    @contextmanager
+    def open(self, file_name: str) -> Iterator[TextIO]:
+        """
+        opens one of the input files as text, decompressing it on the fly if it was
+        stored compressed, so the dump never has to be extracted to disk
+        """
+        entry = self.resolve(file_name)
+        start = time.perf_counter()
+
+        with self.open_entry(entry) as f:
+            yield f
+
+        elapsed = time.perf_counter() - start
+        megabytes = entry.size / (1024 * 1024)
+        self.logger.log(
+            f"read {file_name} ({megabytes:.1f}MB) in {elapsed:.1f}s, "
+            f"{megabytes / max(elapsed, 1e-6):.1f}MB/s"
+        )
+
+    @contextmanager
+    def open_entry(self, entry: IndexEntry) -> Iterator[TextIO]:
+        path = entry.path
+
+        if entry.member is not None:
+            # iterating reads forward through the tarball until it reaches our member
+            with tarfile.open(path, mode="r:gz") as tar:
+                for member in tar:
+                    if member.name == entry.member:
+                        self.logger.debug(f"reading {member.name} from {path}")
+                        yield io.TextIOWrapper(
+                            tar.extractfile(member), encoding="utf-8"
+                        )
+                        return
+            self.logger.error(f"{entry.member} not found in {path}")
+            raise FileNotFoundError(f"Missing {entry.member} file")
+        elif path.endswith(".gz"):
+            with gzip.open(path, "rt", encoding="utf-8") as f:
+                yield f
+        elif path.endswith(".zst"):
+            # zstandard is optional, only sources stored as .zst need it
+            try:
+                import zstandard
+            except ImportError as e:
+                self.logger.error("reading .zst files requires `pip install zstandard`")
+                raise e
+
+            with open(path, "rb") as raw:
+                reader = zstandard.ZstdDecompressor().stream_reader(raw)
+                yield io.TextIOWrapper(reader, encoding="utf-8")
+        else:
+            with open(path) as f:
+                yield f
+
+    def read(self, file_key: str, source: Tuple[str, ...]) -> Iterator[Tuple]:
+        """yields the `source` columns of every row of a raw csv file, as tuples"""
+        with self.open(self.files[file_key]) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            get = getter(header, source)
+            for row in self.changed(file_key, header, reader, source):
+                # like csv.DictReader, skip blank lines
+                if row:
+                    yield get(row)
+
+    def changed(
+        self,
+        file_key: str,
+        header: List[str],
+        rows: Iterable[List[str]],
+        columns: Iterable[str],
+    ) -> Iterable[List[str]]:
+        """
+        in an incremental load, the rows of a raw file that were inserted or updated
+        since the previous snapshot, as far as `columns` go. otherwise, all of them
+        """
+        key = self.keys.get(file_key)
+        if self.previous is None or key is None:
+            return rows
+
+        file_name = self.files[file_key]
+        diff = FileDiff(file_name, key, tuple(sorted(set(columns))), self.logger)
+        previous = self.index_files(os.path.realpath(self.previous)).get(file_name)
+        if previous is None:
+            self.logger.warn(f"{file_name} isn't in {self.previous}, reading all of it")
+            return rows
+
+        latest = self.resolve(file_name)
+        if previous.member is None and latest.member is None:
+            if os.path.samefile(previous.path, latest.path):
+                # the snapshots share the file, so nothing in it changed
+                self.logger.log(f"{file_name} is unchanged since {self.previous}")
+                self.diffs[file_key] = diff
+                return ()
+
+        with self.open_entry(previous) as f:
+            reader = csv.reader(f)
+            if not diff.load(next(reader), reader):
+                self.logger.warn(
+                    f"{file_name} in {self.previous} doesn't have {key} and "
+                    f"{diff.columns}, reading all of it"
+                )
+                return rows
+
+        self.diffs[file_key] = diff
+        return diff.filter(header, rows)
+
+    def deleted(self, file_key: str) -> List[Tuple]:
+        """
+        the keys of the rows of a raw file that an incremental load found gone since
+        the previous snapshot. only known once the file has been read
+        """
+        diff = self.diffs.get(file_key)
+        return diff.deleted if diff else []
+
+    def key_rows(self, output: str) -> Tuple[Iterable[Tuple], bool]:
+        """
+        the keys an output's rows are reconciled by, and whether they're the current
+        ones, i.e. every row's. an incremental load has the keys of the rows that are
+        gone instead, since it only read the ones that changed
+        """
+        definition = self.outputs[output]
+        diff = self.diffs.get(definition.file)
+        if diff is None:
+            return self.fanned_out(output), True
+
+        # the changed rows it spooled aren't needed
+        spool = self.spools.pop(output, None)
+        if spool:
+            spool.close()
+        key = self.keys[definition.file]
+        rows = (
+            row
+            for deleted in diff.deleted
+            for row in definition.project(
+                *(dict(zip(key, deleted))[column] for column in definition.source)
+            )
+        )
+        return rows, False
+
+    def source(self, name: str) -> str:
+        """
+        the file an output (or a file key read directly) comes from. outputs fanned
+        out of the same file replay each other's spools, so they can't run at once
+        """
+        if name in self.outputs:
+            return self.files[self.outputs[name].file]
+        return self.files[name]
+
+    def batched(
+        self, columns: Tuple[str, ...], rows: Iterable[Tuple]
+    ) -> Iterator[Batch]:
+        batch = []
+        for row in rows:
+            batch.append(row)
+            if len(batch) == self.batch_size:
+                yield Batch(columns, batch)
+                batch = []
+        if batch:
+            yield Batch(columns, batch)
+
+    def batches(self, output: str) -> Iterator[Batch]:
+        """the rows of an output, in batches of batch_size"""
+        return self.batched(self.outputs[output].columns, self.fanned_out(output))
+
+    def fanned_out(self, output: str) -> Iterator[Tuple]:
+        """
+        yields the rows of `output`, parsing its file only once for all the outputs
+        that share it
+
+        the first output asked for is streamed while the file is parsed, and the
+        rows for the others are spooled, so they can be replayed without reopening
+        or reparsing the file
+        """
+        if output in self.spools:
+            spool = self.spools.pop(output)
+            try:
+                yield from spool
+            finally:
+                spool.close()
+            return
+
+        file_key = self.outputs[output].file
+        outputs = {
+            name: definition
+            for name, definition in self.outputs.items()
+            if definition.file == file_key
+        }
+        others = {name: Spool() for name in outputs if name != output}
+
+        with self.open(self.files[file_key]) as f:
+            reader = csv.reader(f)
+            header = next(reader)
+            getters = {
+                name: getter(header, definition.source)
+                for name, definition in outputs.items()
+            }
+            project, get = outputs[output].project, getters[output]
+            columns = [c for definition in outputs.values() for c in definition.source]
+
+            for row in self.changed(file_key, header, reader, columns):
+                if not row:
+                    continue
+                for name, spool in others.items():
+                    spool.extend(outputs[name].project(*getters[name](row)))
+                yield from project(*get(row))
+
+        # only hand out spools that saw the whole file
+        for name, spool in others.items():
+            if name in self.spools:
+                self.spools[name].close()
+            self.spools[name] = spool
+            self.logger.debug(f"spooled {spool.count} {name}")
+
     def packages(self):
         pass
 
@@ -1,5 +1,5 @@
 from os import getenv
-from typing import Dict, List
+from typing import Container, Iterable, List
 
 
 def safe_int(val: str) -> int | None:
@@ -8,15 +8,9 @@ def safe_int(val: str) -> int | None:
     return int(val)
 
 
-# TODO: needs explanation or simplification
-def build_query_params(
-    items: List[Dict[str, str]], cache: dict, attr: str
-) -> List[str]:
-    params = set()
-    for item in items:
-        if item[attr] not in cache:
-            params.add(item[attr])
-    return list(params)
+# the distinct values that aren't in the cache yet, i.e. the ones we need to query for
+def build_query_params(values: Iterable[str], cache: Container) -> List[str]:
+    return list({value for value in values if value not in cache})
 
 
 # env vars could be true or 1, or anything else -- here's a centralized location to
@@ -24,3 +18,7 @@ def build_query_params(
 def env_vars(env_var: str, default: str):
     var = getenv(env_var, default).lower()
     return var == "true" or var == "1"
+
+
+def is_tarball(file_name: str) -> bool:
+    return file_name.endswith((".tar.gz", ".tgz"))
@@ -1,46 +1,195 @@
 import time
 
+from core.bulk import Keys
 from core.config import Config, PackageManager
+from core.dag import DAG, Stage
 from core.db import DB
+from core.fastload import FastLoad
 from core.fetcher import TarballFetcher
+from core.idmap import IdMapStore
 from core.logger import Logger
+from core.models import (
+    URL,
+    DependsOn,
+    Package,
+    PackageURL,
+    User,
+    UserPackage,
+    UserVersion,
+    Version,
+)
 from core.scheduler import Scheduler
+from core.shadow import ShadowLoad
+from core.snapshot import SnapshotStore
 from package_managers.crates.transformer import CratesTransformer
 
 logger = Logger("crates_orchestrator")
 
 
-def fetch(config: Config) -> TarballFetcher:
-    fetcher = TarballFetcher("crates", config)
-    files = fetcher.fetch()
-    fetcher.write(files)
+def fetch(config: Config, transformer: CratesTransformer) -> TarballFetcher:
+    # only extract the tables the transformer actually reads
+    fetcher = TarballFetcher("crates", config, transformer.manifest())
+    fetcher.download()
     return fetcher
 
 
 def load(db: DB, transformer: CratesTransformer, config: Config) -> None:
-    db.insert_packages(
-        transformer.packages(),
-        config.pm_config.pm_id,
-        PackageManager.CRATES.value,
-    )
-    db.insert_users(transformer.users(), config.user_types.github)
-    db.insert_user_packages(transformer.user_packages())
+    pm_id = config.pm_config.pm_id
+    github = config.user_types.github
+
+    latest = db.select_latest_load_history(pm_id)
+    load_history = str(latest.id) if latest else None
+
+    # start from the ids the earlier loads saved, if they still match the db
+    id_maps = IdMapStore("crates") if config.exec_config.id_maps else None
+    if id_maps:
+        id_maps.attach(db.caches(), load_history)
+
+    # only read the rows that changed since the snapshot the db was last loaded from
+    snapshots = SnapshotStore("data/crates")
+    if config.exec_config.incremental:
+        previous = snapshots.loaded(load_history)
+        if previous:
+            logger.log(f"loading what changed since {previous}")
+            transformer.previous = snapshots.path(previous)
+        else:
+            logger.log("no snapshot the db was loaded from, loading everything")
+
+    # each stage waits for the ones filling the tables it has foreign keys to
+    stages = [
+        Stage(
+            "packages",
+            lambda: db.insert_packages(
+                transformer.packages(), pm_id, PackageManager.CRATES.value
+            ),
+            Package,
+            source=transformer.source("packages"),
+        ),
+        Stage(
+            "users",
+            lambda: db.insert_users(transformer.users(), github),
+            User,
+            source=transformer.source("users"),
+        ),
+        Stage(
+            "user_packages",
+            lambda: db.insert_user_packages(transformer.user_packages()),
+            UserPackage,
+            source=transformer.source("user_packages"),
+        ),
+    ]
 
     if not config.exec_config.test:
-        db.insert_urls(transformer.urls())
-        db.insert_package_urls(transformer.package_urls())
-        db.insert_versions(transformer.versions())
-        db.insert_user_versions(transformer.user_versions(), config.user_types.github)
-        db.insert_dependencies(transformer.dependencies())
+        stages += [
+            Stage(
+                "urls",
+                lambda: db.insert_urls(transformer.urls()),
+                URL,
+                source=transformer.source("urls"),
+            ),
+            Stage(
+                "package_urls",
+                lambda: db.insert_package_urls(transformer.package_urls()),
+                PackageURL,
+                source=transformer.source("package_urls"),
+            ),
+            Stage(
+                "versions",
+                lambda: db.insert_versions(transformer.versions()),
+                Version,
+                source=transformer.source("versions"),
+            ),
+            Stage(
+                "user_versions",
+                lambda: db.insert_user_versions(transformer.user_versions(), github),
+                UserVersion,
+                source=transformer.source("user_versions"),
+            ),
+            Stage(
+                "dependencies",
+                lambda: db.insert_dependencies(transformer.dependencies()),
+                DependsOn,
+                source=transformer.source("dependencies"),
+            ),
+        ]
+
+        # once everything's loaded, delete what the snapshot doesn't have anymore
+        def reconcile():
+            return db.delete_missing(
+                pm_id,
+                Keys(("import_id",), *transformer.key_rows("package_keys")),
+                Keys(("import_id",), *transformer.key_rows("version_keys")),
+                Keys(("crate_id", "owner_id"), *transformer.key_rows("owner_keys")),
+            )
+
+        stages.append(
+            Stage(
+                "deletions",
+                reconcile,
+                after=tuple(stage.name for stage in stages),
+            )
+        )
+
+    # into copies of the tables, swapped in once they're done, so readers never see
+    # a load halfway. or into empty tables, e.g. on a first load, without indexes to
+    # keep up as it goes
+    shadow = ShadowLoad("crates", db.engine) if config.exec_config.shadow_load else None
+    fast_load = FastLoad("crates", db.engine)
+    # a fast load that died may have left tables without some of their indexes, which
+    # a shadow load would copy, so they're put back whether or not this one is fast
+    fast_load.recover()
+
+    try:
+        if shadow:
+            stages = shadow.prepare(stages)
+        elif config.exec_config.fast_load:
+            stages = fast_load.prepare(stages)
+        DAG("crates", stages).run()
+        if shadow:
+            # checked against the snapshot's rows, which the deletions stage counted
+            shadow.finish(db.loaded)
+    except Exception:
+        if shadow:
+            # the ids the load learnt belong to the copies, which are dropped
+            for idmap in db.caches().values():
+                idmap.clear()
+        raise
+    finally:
+        if shadow:
+            shadow.close()
+        fast_load.restore_all()
+
+    db.insert_load_history(pm_id)
+    latest = db.select_latest_load_history(pm_id)
+
+    if id_maps:
+        id_maps.save(db.caches(), str(latest.id))
+    snapshots.mark_loaded(str(latest.id))
 
-    db.insert_load_history(config.pm_config.pm_id)
     logger.log("✅ crates")
 
 
 def run_pipeline(db: DB, config: Config) -> None:
-    fetcher = fetch(config)
-    transformer = CratesTransformer(config.url_types, config.user_types)
+    transformer = CratesTransformer(
+        config.url_types, config.user_types, config.dependency_types
+    )
+
+    if config.exec_config.fetch:
+        fetcher = fetch(config, transformer)
+        if not fetcher.changed:
+            logger.log("crates hasn't changed since the last load, skipping")
+            # the same dump may have come under new validators, which are kept so
+            # the next run can skip it without downloading it again
+            fetcher.save_validators()
+            fetcher.cleanup()
+            return
+    else:
+        fetcher = TarballFetcher("crates", config)
+
     load(db, transformer, config)
+
+    # only remember what we loaded once the load went through
+    fetcher.save_validators()
     fetcher.cleanup()
 
     coda = (
@@ -1,16 +1,33 @@
-import csv
-from typing import Dict, Generator
-
-from core.config import URLTypes, UserTypes
-from core.transformer import Transformer
+from typing import Iterator, Tuple
+
+from core.config import DependencyTypes, URLTypes, UserTypes
+from core.structs import (
+    DEPENDENCIES,
+    PACKAGE_URLS,
+    PACKAGES,
+    URLS,
+    USER_PACKAGES,
+    USER_VERSIONS,
+    USERS,
+    VERSIONS,
+    Batch,
+)
+from core.transformer import Output, Transformer
 from core.utils import safe_int
 from package_managers.crates.structs import DependencyType
 
+Rows = Tuple[Tuple, ...]
+
 
 # crates provides homepage and repository urls, so we'll initialize this transformer
-# with the ids for those url types
+# with the ids for those url types, and the dependency types its kinds map to
 class CratesTransformer(Transformer):
-    def __init__(self, url_types: URLTypes, user_types: UserTypes):
+    def __init__(
+        self,
+        url_types: URLTypes,
+        user_types: UserTypes,
+        dependency_types: DependencyTypes,
+    ):
         super().__init__("crates")
         self.files = {
             "projects": "crates.csv",
@@ -23,180 +40,194 @@ class CratesTransformer(Transformer):
         }
         self.url_types = url_types
         self.user_types = user_types
+        self.dependency_types = {
+            DependencyType.NORMAL: dependency_types.runtime,
+            DependencyType.BUILD: dependency_types.build,
+            DependencyType.DEV: dependency_types.development,
+            DependencyType.OPTIONAL: dependency_types.optional,
+        }
+        # the primary key of each raw file, so an incremental load can match its rows
+        # to the previous snapshot's
+        self.keys = {
+            "projects": ("id",),
+            "versions": ("id",),
+            "dependencies": ("id",),
+            "users": ("id",),
+            "user_packages": ("crate_id", "owner_id", "owner_kind"),
+        }
+        # crates.csv has the packages and their urls, and versions.csv has the versions
+        # and who published them, so each is parsed once, and fanned out to every
+        # output that needs it
+        self.outputs = {
+            "packages": Output(
+                "projects", ("id", "name", "readme"), PACKAGES, self.package
+            ),
+            "urls": Output(
+                "projects",
+                ("homepage", "repository", "documentation"),
+                URLS,
+                self.url,
+            ),
+            "package_urls": Output(
+                "projects",
+                ("id", "homepage", "repository", "documentation"),
+                PACKAGE_URLS,
+                self.package_url,
+            ),
+            "versions": Output(
+                "versions",
+                (
+                    "crate_id",
+                    "num",
+                    "id",
+                    "crate_size",
+                    "created_at",
+                    "license",
+                    "downloads",
+                    "checksum",
+                ),
+                VERSIONS,
+                self.version,
+            ),
+            "user_versions": Output(
+                "versions", ("id", "published_by"), USER_VERSIONS, self.user_version
+            ),
+            "dependencies": Output(
+                "dependencies",
+                ("version_id", "crate_id", "req", "kind"),
+                DEPENDENCIES,
+                self.dependency,
+            ),
+            "user_packages": Output(
+                "user_packages",
+                ("crate_id", "owner_id", "owner_kind"),
+                USER_PACKAGES,
+                self.user_package,
+            ),
+            # the keys the rows are reconciled by, so the ones gone can be deleted
+            "package_keys": Output("projects", ("id",), ("import_id",), self.key),
+            "version_keys": Output("versions", ("id",), ("import_id",), self.key),
+            "owner_keys": Output(
+                "user_packages",
+                ("crate_id", "owner_id", "owner_kind"),
+                ("crate_id", "owner_id"),
+                self.user_package,
+            ),
+        }
 
-    def packages(self) -> Generator[Dict[str, str], None, None]:
-        projects_path = self.finder(self.files["projects"])
-
-        with open(projects_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                crate_id = row["id"]
-                name = row["name"]
-                readme = row["readme"]
-
-                yield {"name": name, "import_id": crate_id, "readme": readme}
-
-    def versions(self) -> Generator[Dict[str, str], None, None]:
-        versions_path = self.finder(self.files["versions"])
-
-        with open(versions_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                crate_id = row["crate_id"]
-                version_num = row["num"]
-                version_id = row["id"]
-                crate_size = safe_int(row["crate_size"])
-                created_at = row["created_at"]
-                license = row["license"]
-                downloads = safe_int(row["downloads"])
-                checksum = row["checksum"]
-
-                yield {
-                    "crate_id": crate_id,
-                    "version": version_num,
-                    "import_id": version_id,
-                    "size": crate_size,
-                    "published_at": created_at,
-                    "license": license,
-                    "downloads": downloads,
-                    "checksum": checksum,
-                }
-
-    def dependencies(self) -> Generator[Dict[str, str], None, None]:
-        dependencies_path = self.finder(self.files["dependencies"])
-
-        with open(dependencies_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                start_id = row["version_id"]
-                end_id = row["crate_id"]
-                req = row["req"]
-                kind = int(row["kind"])
-
-                # map string to enum
-                dependency_type = DependencyType(kind)
-
-                yield {
-                    "version_id": start_id,
-                    "crate_id": end_id,
-                    "semver_range": req,
-                    "dependency_type": dependency_type,
-                }
+    def key(self, import_id: str) -> Rows:
+        return ((import_id,),)
+
+    def packages(self) -> Iterator[Batch]:
+        return self.batches("packages")
+
+    def package(self, crate_id: str, name: str, readme: str) -> Rows:
+        return ((crate_id, name, readme),)
+
+    def versions(self) -> Iterator[Batch]:
+        return self.batches("versions")
+
+    def version(
+        self,
+        crate_id: str,
+        version_num: str,
+        version_id: str,
+        crate_size: str,
+        created_at: str,
+        license: str,
+        downloads: str,
+        checksum: str,
+    ) -> Rows:
+        return (
+            (
+                crate_id,
+                version_num,
+                version_id,
+                safe_int(crate_size),
+                created_at,
+                license,
+                safe_int(downloads),
+                checksum,
+            ),
+        )
+
+    def dependencies(self) -> Iterator[Batch]:
+        return self.batches("dependencies")
+
+    def dependency(self, start_id: str, end_id: str, req: str, kind: str) -> Rows:
+        # map string to enum, and the enum to its depends_on_types id
+        dependency_type = self.dependency_types[DependencyType(int(kind))]
+        return ((start_id, end_id, req, dependency_type),)
 
     # gh_id is unique to github, and is from GitHub
     # our users table is unique on import_id and source_id
     # so, we actually get some github data for free here!
-    def users(self) -> Generator[Dict[str, str], None, None]:
-        users_path = self.finder(self.files["users"])
-        usernames = set()
+    def users(self) -> Iterator[Batch]:
+        return self.batched(USERS, self.unique_users())
 
-        with open(users_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                gh_login = row["gh_login"]
-                id = row["id"]
+    def unique_users(self) -> Iterator[Tuple]:
+        usernames = set()
+        # gh_login is a non-nullable column in crates, so we'll always be able to
+        # load this
+        source_id = self.user_types.github
 
-                # deduplicate
-                if gh_login in usernames:
-                    self.logger.warn(f"duplicate username: {id}, {gh_login}")
-                    continue
-                usernames.add(gh_login)
+        for id, gh_login in self.read("users", ("id", "gh_login")):
+            # deduplicate
+            if gh_login in usernames:
+                self.logger.warn(f"duplicate username: {id}, {gh_login}")
+                continue
+            usernames.add(gh_login)
 
-                # gh_login is a non-nullable column in crates, so we'll always be
-                # able to load this
-                source_id = self.user_types.github
-                yield {"import_id": id, "username": gh_login, "source_id": source_id}
+            yield (id, gh_login, source_id)
 
     # for crate_owners, owner_id and created_by are foreign keys on users.id
     # and owner_kind is 0 for user and 1 for team
     # secondly, created_at is nullable. we'll ignore for now and focus on owners
-    def user_packages(self) -> Generator[Dict[str, str], None, None]:
-        user_packages_path = self.finder(self.files["user_packages"])
-
-        with open(user_packages_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                owner_kind = int(row["owner_kind"])
-                if owner_kind == 1:
-                    continue
-
-                crate_id = row["crate_id"]
-                owner_id = row["owner_id"]
-
-                yield {
-                    "crate_id": crate_id,
-                    "owner_id": owner_id,
-                }
-
-    # TODO: reopening files: versions.csv contains all the published_by ids
-    def user_versions(self) -> Generator[Dict[str, str], None, None]:
-        user_versions_path = self.finder(self.files["user_versions"])
+    def user_packages(self) -> Iterator[Batch]:
+        return self.batches("user_packages")
 
-        with open(user_versions_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                version_id = row["id"]
-                published_by = row["published_by"]
+    def user_package(self, crate_id: str, owner_id: str, owner_kind: str) -> Rows:
+        if int(owner_kind) == 1:
+            return ()
+        return ((crate_id, owner_id),)
 
-                if published_by == "":
-                    continue
+    def user_versions(self) -> Iterator[Batch]:
+        return self.batches("user_versions")
 
-                yield {"version_id": version_id, "published_by": published_by}
+    def user_version(self, version_id: str, published_by: str) -> Rows:
+        if published_by == "":
+            return ()
+        return ((version_id, published_by),)
 
     # crates provides three urls for each crate: homepage, repository, and documentation
     # however, any of these could be null, so we should check for that
     # also, we're not going to deduplicate here
-    def urls(self) -> Generator[Dict[str, str], None, None]:
-        urls_path = self.finder(self.files["urls"])
-
-        with open(urls_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                homepage = row["homepage"]
-                repository = row["repository"]
-                documentation = row["documentation"]
-
-                if homepage:
-                    yield {"url": homepage, "url_type_id": self.url_types.homepage}
-
-                if repository:
-                    yield {"url": repository, "url_type_id": self.url_types.repository}
-
-                if documentation:
-                    yield {
-                        "url": documentation,
-                        "url_type_id": self.url_types.documentation,
-                    }
-
-    # TODO: reopening files: crates.csv contains all the urls
-    def package_urls(self) -> Generator[Dict[str, str], None, None]:
-        urls_path = self.finder(self.files["urls"])
-
-        with open(urls_path) as f:
-            reader = csv.DictReader(f)
-            for row in reader:
-                crate_id = row["id"]
-                homepage = row["homepage"]
-                repository = row["repository"]
-                documentation = row["documentation"]
-
-                if homepage:
-                    yield {
-                        "import_id": crate_id,
-                        "url": homepage,
-                        "url_type_id": self.url_types.homepage,
-                    }
-
-                if repository:
-                    yield {
-                        "import_id": crate_id,
-                        "url": repository,
-                        "url_type_id": self.url_types.repository,
-                    }
-
-                if documentation:
-                    yield {
-                        "import_id": crate_id,
-                        "url": documentation,
-                        "url_type_id": self.url_types.documentation,
-                    }
+    def urls(self) -> Iterator[Batch]:
+        return self.batches("urls")
+
+    def url(self, homepage: str, repository: str, documentation: str) -> Rows:
+        return tuple(
+            (url, url_type_id)
+            for url, url_type_id in (
+                (homepage, self.url_types.homepage),
+                (repository, self.url_types.repository),
+                (documentation, self.url_types.documentation),
+            )
+            if url
+        )
+
+    def package_urls(self) -> Iterator[Batch]:
+        return self.batches("package_urls")
+
+    def package_url(
+        self, crate_id: str, homepage: str, repository: str, documentation: str
+    ) -> Rows:
+        return tuple(
+            (crate_id, url, url_type_id)
+            for url, url_type_id in (
+                (homepage, self.url_types.homepage),
+                (repository, self.url_types.repository),
+                (documentation, self.url_types.documentation),
+            )
+            if url
+        )
@@ -0,0 +1,101 @@
+import threading
+import time
+
+import pytest
+
+from core.dag import DAG, Stage
+from core.models import DependsOn, Package, PackageManager, Version
+
+
+def recorder(order: list, name: str, seconds: float = 0.0):
+    def run():
+        time.sleep(seconds)
+        order.append(name)
+
+    return run
+
+
+def test_stages_run_after_the_tables_they_reference():
+    order = []
+    # listed children first, so only the foreign keys put them in order
+    stages = [
+        Stage("dependencies", recorder(order, "dependencies"), DependsOn),
+        Stage("versions", recorder(order, "versions"), Version),
+        Stage("packages", recorder(order, "packages"), Package),
+        Stage("package_managers", recorder(order, "package_managers"), PackageManager),
+    ]
+
+    dag = DAG("test", stages, workers=4, connections=100)
+    dag.run()
+
+    assert dag.stages["dependencies"].depends_on == {"versions", "packages"}
+    assert dag.stages["versions"].depends_on == {"packages"}
+    assert order == ["package_managers", "packages", "versions", "dependencies"]
+
+
+def test_stages_run_after_the_ones_they_name():
+    order = []
+    stages = [
+        Stage("urls", recorder(order, "urls"), after=("cleanup",)),
+        Stage("cleanup", recorder(order, "cleanup", 0.05)),
+    ]
+
+    DAG("test", stages, workers=2, connections=100).run()
+
+    assert order == ["cleanup", "urls"]
+
+
+def test_stages_reading_the_same_source_never_overlap():
+    running, overlapped = set(), []
+    lock = threading.Lock()
+
+    def stage(name: str):
+        def run():
+            with lock:
+                overlapped.extend(running)
+                running.add(name)
+            time.sleep(0.05)
+            with lock:
+                running.discard(name)
+
+        return Stage(name, run, source="versions.csv")
+
+    DAG("test", [stage("a"), stage("b"), stage("c")], workers=3, connections=100).run()
+
+    assert overlapped == []
+
+
+def test_a_cycle_is_rejected_before_anything_runs():
+    order = []
+    stages = [
+        Stage("a", recorder(order, "a"), after=("c",)),
+        Stage("b", recorder(order, "b"), after=("a",)),
+        Stage("c", recorder(order, "c"), after=("b",)),
+        Stage("d", recorder(order, "d")),
+    ]
+
+    with pytest.raises(ValueError, match=r"\['a', 'b', 'c'\] depend on each other"):
+        DAG("test", stages)
+    assert order == []
+
+
+def test_an_unknown_dependency_is_rejected():
+    with pytest.raises(ValueError, match="unknown stages"):
+        DAG("test", [Stage("a", lambda: None, after=("b",))])
+
+
+def test_a_failed_stage_stops_its_dependents():
+    order = []
+
+    def fail():
+        raise RuntimeError("boom")
+
+    stages = [
+        Stage("packages", fail, Package),
+        Stage("versions", recorder(order, "versions"), Version),
+        Stage("other", recorder(order, "other")),
+    ]
+
+    with pytest.raises(RuntimeError, match="boom"):
+        DAG("test", stages, workers=1, connections=100).run()
+    assert "versions" not in order
@@ -0,0 +1,148 @@
+import os
+from uuid import uuid4
+
+import pytest
+
+import core.db
+from core.db import DB
+from core.structs import DEPENDENCIES, PACKAGES, VERSIONS, Batch
+
+# these load into a migrated database, like the one docker compose starts
+pytestmark = pytest.mark.skipif(
+    not os.getenv("CHAI_DATABASE_URL"), reason="needs CHAI_DATABASE_URL"
+)
+
+
+@pytest.fixture
+def package_managers():
+    """two package managers, deleted along with everything loaded for them"""
+    db = DB()
+    ids = []
+    for _ in range(2):
+        source = db.insert_source(f"test-{uuid4()}")
+        ids.append(db.insert_package_manager(source.id).id)
+
+    yield ids
+
+    packages = "SELECT id FROM packages WHERE package_manager_id = ANY(%s)"
+    with db._cursor() as cursor:
+        cursor.execute(
+            f"DELETE FROM dependencies WHERE dependency_id IN ({packages})", (ids,)
+        )
+        cursor.execute(f"DELETE FROM versions WHERE package_id IN ({packages})", (ids,))
+        cursor.execute(
+            "DELETE FROM packages WHERE package_manager_id = ANY(%s)", (ids,)
+        )
+        cursor.execute(
+            "DELETE FROM package_managers WHERE id = ANY(%s) RETURNING source_id",
+            (ids,),
+        )
+        sources = [source_id for (source_id,) in cursor.fetchall()]
+        cursor.execute("DELETE FROM sources WHERE id = ANY(%s)", (sources,))
+    db.engine.dispose()
+
+
+def dependency_type(db: DB, name: str):
+    with db._cursor() as cursor:
+        cursor.execute("SELECT id FROM depends_on_types WHERE name = %s", (name,))
+        return cursor.fetchone()[0]
+
+
+def load(db: DB, package_manager_id, dependency_type_id) -> None:
+    """two packages, one version of the first, depending on the second"""
+    name = f"test-{package_manager_id}"
+    db.insert_packages(
+        [Batch(PACKAGES, [("1", "serde", ""), ("2", "rand", "")])],
+        package_manager_id,
+        name,
+    )
+    db.insert_versions(
+        [Batch(VERSIONS, [("1", "1.0.0", "10", None, None, "MIT", 0, "")])]
+    )
+    db.insert_dependencies(
+        [Batch(DEPENDENCIES, [("10", "2", "^1", dependency_type_id)])]
+    )
+
+
+def dependencies(db: DB, package_manager_id) -> list:
+    """the package managers of the versions depending on the package manager's"""
+    with db._cursor() as cursor:
+        cursor.execute(
+            "SELECT p.package_manager_id FROM dependencies d "
+            "JOIN versions v ON v.id = d.version_id "
+            "JOIN packages p ON p.id = v.package_id "
+            "JOIN packages dp ON dp.id = d.dependency_id "
+            "WHERE dp.package_manager_id = %s",
+            (package_manager_id,),
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+@pytest.mark.parametrize("server_side", [False, True])
+def test_versions_are_looked_up_within_their_package_manager(
+    package_managers, monkeypatch, server_side
+):
+    monkeypatch.setattr(core.db, "SERVER_SIDE", server_side)
+    # both use the same import ids, like homebrew's formula names could
+    # each with a loader of its own, and empty caches. the first one again last, so
+    # its rows are already there, and the other's were loaded after them
+    db = DB()
+    runtime = dependency_type(db, "runtime")
+    for package_manager_id in package_managers + package_managers[:1]:
+        load(DB(), package_manager_id, runtime)
+
+    for package_manager_id in package_managers:
+        assert dependencies(db, package_manager_id) == [package_manager_id]
+
+
+@pytest.mark.parametrize("server_side", [False, True])
+def test_reload_replaces_untyped_dependencies(
+    package_managers, monkeypatch, server_side
+):
+    monkeypatch.setattr(core.db, "SERVER_SIDE", server_side)
+    package_manager_id = package_managers[0]
+    db = DB()
+    runtime = dependency_type(db, "runtime")
+
+    # loads from before dependency types were mapped left them NULL
+    load(DB(), package_manager_id, None)
+    load(DB(), package_manager_id, runtime)
+
+    with db._cursor() as cursor:
+        cursor.execute(
+            "SELECT d.dependency_type_id FROM dependencies d "
+            "JOIN packages p ON p.id = d.dependency_id "
+            "WHERE p.package_manager_id = %s",
+            (package_manager_id,),
+        )
+        assert cursor.fetchall() == [(runtime,)]
+
+
+def import_ids(db: DB, package_manager_id) -> list:
+    with db._cursor() as cursor:
+        cursor.execute(
+            "SELECT import_id FROM packages WHERE package_manager_id = %s "
+            "ORDER BY import_id",
+            (package_manager_id,),
+        )
+        return [import_id for (import_id,) in cursor.fetchall()]
+
+
+def test_republished_packages_count_against_the_delete_limit(
+    package_managers, monkeypatch
+):
+    package_manager_id = package_managers[0]
+    db = DB()
+    load(db, package_manager_id, dependency_type(db, "runtime"))
+    name = f"test-{package_manager_id}"
+    # serde was deleted, and published again
+    republished = [Batch(PACKAGES, [("3", "serde", "")])]
+
+    # one of two packages is more than the 5% a load may delete
+    with pytest.raises(ValueError, match="published again"):
+        DB().insert_packages(republished, package_manager_id, name)
+    assert import_ids(db, package_manager_id) == ["1", "2"]
+
+    monkeypatch.setattr(core.db, "MAX_DELETE_FRACTION", 0.5)
+    DB().insert_packages(republished, package_manager_id, name)
+    assert import_ids(db, package_manager_id) == ["2", "3"]
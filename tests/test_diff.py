@@ -0,0 +1,91 @@
+import csv
+import io
+
+from core.diff import FileDiff
+from core.transformer import Transformer
+
+BEFORE = """id,name,downloads
+1,serde,10
+2,rand,20
+3,tokio,30
+"""
+
+# rand changed, tokio is gone, and libc is new
+AFTER = """id,name,downloads
+1,serde,10
+2,rand,25
+
+4,libc,40
+"""
+
+
+def rows(text: str):
+    reader = csv.reader(io.StringIO(text))
+    return next(reader), reader
+
+
+def test_changed_rows_and_deleted_keys():
+    diff = FileDiff("crates.csv", ("id",), ("name", "downloads"))
+    assert diff.load(*rows(BEFORE))
+
+    changed = list(diff.filter(*rows(AFTER)))
+
+    assert changed == [["2", "rand", "25"], ["4", "libc", "40"]]
+    assert diff.deleted == [("3",)]
+    assert (diff.inserted, diff.updated, diff.unchanged) == (1, 1, 1)
+
+
+def test_columns_that_are_not_read_do_not_count_as_changes():
+    diff = FileDiff("crates.csv", ("id",), ("name",))
+    diff.load(*rows(BEFORE))
+
+    changed = list(diff.filter(*rows(AFTER)))
+
+    assert changed == [["4", "libc", "40"]]
+    assert diff.updated == 0
+
+
+def test_composite_keys():
+    before = "crate_id,owner_id,kind\n1,7,user\n1,8,team\n"
+    after = "crate_id,owner_id,kind\n1,7,user\n2,8,team\n"
+    diff = FileDiff("crate_owners.csv", ("crate_id", "owner_id"), ("kind",))
+    diff.load(*rows(before))
+
+    assert list(diff.filter(*rows(after))) == [["2", "8", "team"]]
+    assert diff.deleted == [("1", "8")]
+
+
+def test_earlier_file_without_the_columns_cannot_be_compared():
+    diff = FileDiff("crates.csv", ("id",), ("name", "readme"))
+
+    assert not diff.load(*rows(BEFORE))
+
+
+def snapshot(root, name: str, text: str) -> str:
+    path = root / name
+    path.mkdir()
+    (path / "crates.csv").write_text(text)
+    return str(path)
+
+
+def test_incremental_read(tmp_path):
+    transformer = Transformer("crates")
+    transformer.files = {"projects": "crates.csv"}
+    transformer.keys = {"projects": ("id",)}
+    transformer.previous = snapshot(tmp_path, "before", BEFORE)
+    transformer.input = snapshot(tmp_path, "after", AFTER)
+
+    changed = list(transformer.read("projects", ("id", "downloads")))
+
+    assert changed == [("2", "25"), ("4", "40")]
+    assert transformer.deleted("projects") == [("3",)]
+
+
+def test_full_read_without_a_previous_snapshot(tmp_path):
+    transformer = Transformer("crates")
+    transformer.files = {"projects": "crates.csv"}
+    transformer.keys = {"projects": ("id",)}
+    transformer.input = snapshot(tmp_path, "after", AFTER)
+
+    assert [row[0] for row in transformer.read("projects", ("id",))] == ["1", "2", "4"]
+    assert transformer.deleted("projects") == []
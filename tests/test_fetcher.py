@@ -0,0 +1,353 @@
+import io
+import json
+import os
+import tarfile
+from hashlib import sha256
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from threading import Thread
+from types import SimpleNamespace
+
+import pytest
+import yaml
+
+from core.fetcher import (
+    Downloader,
+    JSONFetcher,
+    TarballFetcher,
+    YAMLFetcher,
+    iter_json_array,
+)
+from package_managers.crates.main import run_pipeline
+
+RANGE_SIZE = 1024
+
+
+def tarball(files: dict) -> bytes:
+    buffer = io.BytesIO()
+    with tarfile.open(fileobj=buffer, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+    return buffer.getvalue()
+
+
+# a dump with a couple of files a transformer reads, and one it doesn't
+DUMP = tarball(
+    {
+        "2024-01-01/data/crates.csv": b"id,name\n1,serde\n" * 200,
+        "2024-01-01/data/versions.csv": os.urandom(4 * RANGE_SIZE),
+        "2024-01-01/data/unused.csv": b"x\n",
+    }
+)
+
+
+class Handler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_HEAD(self):
+        self.respond(body=False)
+
+    def do_GET(self):
+        self.respond(body=True)
+
+    def respond(self, body: bool) -> None:
+        source = self.server.source
+        source.requests.append((self.command, self.headers.get("Range")))
+
+        etag = self.headers.get("If-None-Match")
+        if source.conditional and etag == source.etag:
+            self.send_response(304)
+            self.end_headers()
+            return
+
+        content, status = source.content, 200
+        headers = {"ETag": source.etag}
+        if source.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        requested = self.headers.get("Range")
+        if (
+            source.ranges
+            and requested
+            and self.headers.get("If-Range", source.etag) == source.etag
+        ):
+            start, end = requested.removeprefix("bytes=").split("-")
+            start, end = int(start), int(end)
+            content, status = content[start : end + 1], 206
+            headers["Content-Range"] = f"bytes {start}-{end}/{len(source.content)}"
+
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(content)))
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.end_headers()
+        if body:
+            self.wfile.write(content)
+
+
+@pytest.fixture
+def source():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.source = SimpleNamespace(
+        content=DUMP,
+        etag='"v1"',
+        conditional=True,
+        ranges=True,
+        requests=[],
+        url=f"http://127.0.0.1:{server.server_port}/db-dump.tar.gz",
+    )
+    thread = Thread(target=server.serve_forever, args=(0.05,), daemon=True)
+    thread.start()
+    yield server.source
+    server.shutdown()
+    server.server_close()
+
+
+def ranges(source) -> list:
+    return [r for method, r in source.requests if method == "GET"]
+
+
+def test_download_in_ranges(source, tmp_path):
+    destination = str(tmp_path / "dump.tar.gz")
+
+    with Downloader(source.url, destination, range_size=RANGE_SIZE) as downloader:
+        download = downloader.download()
+
+    with open(destination, "rb") as f:
+        assert f.read() == DUMP
+    assert download.digest == sha256(DUMP).hexdigest()
+    assert download.etag == '"v1"'
+    assert len(ranges(source)) == -(-len(DUMP) // RANGE_SIZE)
+    assert not os.path.exists(f"{destination}.partial")
+    assert not os.path.exists(f"{destination}.state.json")
+
+
+def test_download_resumes(source, tmp_path):
+    destination = str(tmp_path / "dump.tar.gz")
+    chunks = -(-len(DUMP) // RANGE_SIZE)
+
+    # an earlier attempt got the first two chunks before it died
+    with open(f"{destination}.partial", "wb") as f:
+        f.write(DUMP[: 2 * RANGE_SIZE])
+        f.truncate(len(DUMP))
+    with open(f"{destination}.state.json", "w") as f:
+        state = {
+            "url": source.url,
+            "etag": '"v1"',
+            "size": len(DUMP),
+            "range_size": RANGE_SIZE,
+            "done": [0, 1],
+        }
+        json.dump(state, f)
+
+    with Downloader(source.url, destination, range_size=RANGE_SIZE) as downloader:
+        download = downloader.download()
+
+    with open(destination, "rb") as f:
+        assert f.read() == DUMP
+    assert download.digest == sha256(DUMP).hexdigest()
+    assert len(ranges(source)) == chunks - 2
+    assert f"bytes=0-{RANGE_SIZE - 1}" not in ranges(source)
+
+
+def test_download_restarts_when_the_file_changed(source, tmp_path):
+    destination = str(tmp_path / "dump.tar.gz")
+
+    with open(f"{destination}.partial", "wb") as f:
+        f.write(b"\0" * len(DUMP))
+    with open(f"{destination}.state.json", "w") as f:
+        state = {
+            "url": source.url,
+            "etag": '"v0"',
+            "size": len(DUMP),
+            "range_size": RANGE_SIZE,
+            "done": [0, 1],
+        }
+        json.dump(state, f)
+
+    with Downloader(source.url, destination, range_size=RANGE_SIZE) as downloader:
+        downloader.download()
+
+    with open(destination, "rb") as f:
+        assert f.read() == DUMP
+    assert len(ranges(source)) == -(-len(DUMP) // RANGE_SIZE)
+
+
+def test_corrupt_download_is_discarded(source, tmp_path):
+    destination = str(tmp_path / "dump.tar.gz")
+
+    with Downloader(source.url, destination, range_size=RANGE_SIZE) as downloader:
+        with pytest.raises(ValueError, match="failed verification"):
+            downloader.download(expected_digest=sha256(b"other").hexdigest())
+
+    assert not os.path.exists(destination)
+    assert not os.path.exists(f"{destination}.partial")
+    assert not os.path.exists(f"{destination}.state.json")
+
+
+def configure(source) -> SimpleNamespace:
+    return SimpleNamespace(
+        pm_config=SimpleNamespace(source=source.url),
+        exec_config=SimpleNamespace(
+            no_cache=False,
+            test=False,
+            keep_archive=False,
+            incremental=False,
+            fetch=True,
+        ),
+        url_types=SimpleNamespace(homepage=1, repository=2, documentation=3),
+        user_types=SimpleNamespace(crates=1, github=2),
+        dependency_types=SimpleNamespace(runtime=1, build=2, development=3, optional=4),
+    )
+
+
+def fetcher(source) -> TarballFetcher:
+    return TarballFetcher("crates", configure(source), ["crates.csv", "versions.csv"])
+
+
+def test_fetch_extracts_the_wanted_members(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = fetcher(source)
+
+    assert first.download()
+
+    latest = "data/crates/latest/2024-01-01/data"
+    assert sorted(os.listdir(latest)) == ["crates.csv", "versions.csv"]
+    assert first.snapshots.latest() == sha256(DUMP).hexdigest()
+    assert not os.listdir("data/crates/.download")
+
+
+def test_dump_without_ranges_is_streamed(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.ranges = False
+    first = fetcher(source)
+
+    assert first.download()
+
+    latest = "data/crates/latest/2024-01-01/data"
+    assert sorted(os.listdir(latest)) == ["crates.csv", "versions.csv"]
+    assert first.validators.digest == sha256(DUMP).hexdigest()
+    assert first.validators.size == len(DUMP)
+    # one request for all of it, that never went to disk whole
+    assert ranges(source) == [None]
+    assert not os.path.exists("data/crates/.download")
+
+
+def test_unchanged_dump_is_skipped(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = fetcher(source)
+    first.download()
+    first.save_validators()
+    source.requests.clear()
+
+    second = fetcher(source)
+
+    assert not second.download()
+    assert not second.changed
+    # the server said 304 to the probe, so nothing was downloaded
+    assert source.requests == [("HEAD", None)]
+
+
+def test_same_dump_under_a_new_etag_is_not_loaded_again(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    first = fetcher(source)
+    first.download()
+    first.save_validators()
+
+    # the dump was republished, byte for byte the same
+    source.etag, source.conditional = '"v2"', False
+    run_pipeline(None, configure(source))
+
+    with open("data/crates/latest.json") as f:
+        assert json.load(f)["etag"] == '"v2"'
+    assert first.snapshots.snapshots() == [sha256(DUMP).hexdigest()]
+    assert not os.listdir("data/crates/.download")
+
+    # so the next run is skipped on the server's say-so
+    source.conditional = True
+    source.requests.clear()
+    run_pipeline(None, configure(source))
+
+    assert source.requests == [("HEAD", None)]
+
+
+RECORDS = [
+    {
+        "name": "wget",
+        "versions": {"stable": "1.21.4"},
+        "deps": ["openssl@3", "libidn2"],
+    },
+    {"name": "zstd", "size": 12.5, "bottle": None, "head": True, "ratio": -3e-10},
+    "é, and a \\u escape: \u00e9",
+    [],
+]
+
+
+@pytest.mark.parametrize("size", [1, 2, 3, 7, 64, 4096])
+def test_json_array_split_across_chunks(size):
+    text = json.dumps(RECORDS, indent=2)
+    chunks = [text[i : i + size] for i in range(0, len(text), size)]
+
+    assert list(iter_json_array(chunks)) == RECORDS
+
+
+@pytest.mark.parametrize(
+    "text", ["[1 2]", "[1,,2]", "[,1]", "[1,]", "[1", "[", '["a]', "[1] 2", "[tru]"]
+)
+@pytest.mark.parametrize("size", [1, 2, 100])
+def test_malformed_json_array(text, size):
+    chunks = [text[i : i + size] for i in range(0, len(text), size)]
+
+    with pytest.raises(ValueError):
+        list(iter_json_array(chunks))
+
+
+@pytest.mark.parametrize(
+    "text, records",
+    [('{"name": "wget"}', [{"name": "wget"}]), ("[]", []), (" [ ] ", []), ("", [])],
+)
+def test_json_document_that_is_not_an_array(text, records):
+    assert list(iter_json_array([text[:3], text[3:]])) == records
+
+
+def test_json_fetcher_streams_records(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.content = json.dumps(RECORDS).encode()
+
+    assert list(JSONFetcher("homebrew", configure(source)).fetch()) == RECORDS
+
+
+def test_json_fetcher_rejects_a_malformed_array(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.content = b'[{"name": "wget"} {"name": "zstd"}]'
+
+    with pytest.raises(ValueError):
+        list(JSONFetcher("homebrew", configure(source)).fetch())
+
+
+def test_json_fetcher_yields_a_single_document_whole(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.content = json.dumps(RECORDS[0]).encode()
+
+    assert list(JSONFetcher("homebrew", configure(source)).fetch()) == RECORDS[:1]
+
+
+def test_yaml_fetcher_streams_documents(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.content = b"name: wget\n---\nname: zstd\nsize: 12.5\n---\n- a list\n"
+
+    documents = list(YAMLFetcher("pkgx", configure(source)).fetch())
+
+    assert documents == [{"name": "wget"}, {"name": "zstd", "size": 12.5}, ["a list"]]
+
+
+def test_yaml_fetcher_rejects_malformed_documents(source, tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    source.content = b"name: wget\n---\nname: [zstd\n"
+
+    fetched = YAMLFetcher("pkgx", configure(source)).fetch()
+
+    assert next(fetched) == {"name": "wget"}
+    with pytest.raises(yaml.YAMLError):
+        next(fetched)
@@ -0,0 +1,35 @@
+import pytest
+
+from core.licenses import normalize_license
+
+
+@pytest.mark.parametrize(
+    "expression, normalized",
+    [
+        ("MIT", "MIT"),
+        ("MIT/Apache-2.0", "Apache-2.0 OR MIT"),
+        ("Apache-2.0 or MIT", "Apache-2.0 OR MIT"),
+        ("MIT OR Apache-2.0", "Apache-2.0 OR MIT"),
+        ("MIT OR (Apache-2.0 OR MIT)", "Apache-2.0 OR MIT"),
+        ("mit and mit", "mit"),
+        ("(MIT AND BSD-3-Clause) OR Apache-2.0", "Apache-2.0 OR BSD-3-Clause AND MIT"),
+        (
+            "MIT AND (Apache-2.0 OR BSD-3-Clause)",
+            "(Apache-2.0 OR BSD-3-Clause) AND MIT",
+        ),
+        (
+            "MIT OR Apache-2.0 WITH LLVM-exception",
+            "Apache-2.0 WITH LLVM-exception OR MIT",
+        ),
+    ],
+)
+def test_normalize_license(expression, normalized):
+    assert normalize_license(expression) == normalized
+
+
+@pytest.mark.parametrize(
+    "expression, normalized",
+    [("", ""), ("MIT  OR ", "MIT OR"), (" (MIT", "(MIT"), ("MIT WITH", "MIT WITH")],
+)
+def test_what_does_not_parse_only_has_its_whitespace_collapsed(expression, normalized):
+    assert normalize_license(expression) == normalized
@@ -0,0 +1,54 @@
+import pytest
+
+from core.pipeline import Pipeline
+
+
+def jobs(written: list, failing: int | None = None):
+    def prepare(item: int):
+        def job() -> int:
+            if item == failing:
+                raise ValueError(f"batch {item} failed")
+            written.append(item)
+            return item
+
+        return job
+
+    return prepare
+
+
+@pytest.mark.parametrize("writers", [0, 1, 3])
+def test_results_come_in_order(writers):
+    written, finished = [], []
+
+    Pipeline("test", writers=writers, depth=2).run(
+        range(20), jobs(written), finished.append
+    )
+
+    assert finished == list(range(20))
+    assert sorted(written) == list(range(20))
+
+
+def test_nothing_is_written_after_a_failed_write():
+    written, finished = [], []
+
+    with pytest.raises(ValueError, match="batch 3 failed"):
+        Pipeline("test", writers=1, depth=4).run(
+            range(20), jobs(written, failing=3), finished.append
+        )
+
+    assert written == [0, 1, 2]
+    assert finished == [0, 1, 2]
+
+
+def test_a_failed_parse_is_raised_after_the_batches_before_it():
+    def items():
+        yield from range(3)
+        raise ValueError("bad row")
+
+    written, finished = [], []
+    with pytest.raises(ValueError, match="bad row"):
+        Pipeline("test", writers=2, depth=2).run(
+            items(), jobs(written), finished.append
+        )
+
+    assert finished == [0, 1, 2]
@@ -0,0 +1,91 @@
+import pytest
+
+import core.sizing
+from core.sizing import BatchSizer
+from core.structs import Batch
+
+COLUMNS = ("id", "name")
+
+
+@pytest.fixture(autouse=True)
+def limits(monkeypatch):
+    monkeypatch.setattr(core.sizing, "TARGET_BATCH_SECONDS", 1.0)
+    monkeypatch.setattr(core.sizing, "MIN_BATCH_ROWS", 100)
+    monkeypatch.setattr(core.sizing, "MAX_BATCH_ROWS", 100000)
+    monkeypatch.setattr(core.sizing, "ADAPTIVE_BATCHES", True)
+
+
+def rows(count: int) -> list:
+    return [(str(i), "serde") for i in range(count)]
+
+
+def write(sizer: BatchSizer, rows_per_second: float, batches: int) -> list:
+    """writes batches of the sizer's size to a table that takes that many rows/s"""
+    sizes = []
+    for _ in range(batches):
+        sizes.append(sizer.size)
+        sizer.record(rows(sizer.size), sizer.size / rows_per_second)
+    return sizes
+
+
+def test_batches_grow_to_the_target_latency_at_most_doubling():
+    sizer = BatchSizer("test", 1000)
+
+    sizes = write(sizer, 20000, 10)
+
+    assert sizes[:5] == [1000, 2000, 4000, 8000, 16000]
+    assert sizes[5:] == [pytest.approx(20000, abs=1)] * 5
+    assert sizer.size == pytest.approx(20000, abs=1)
+
+
+def test_batches_shrink_when_writes_slow_down():
+    sizer = BatchSizer("test", 1000)
+    write(sizer, 20000, 10)
+
+    write(sizer, 2000, 20)
+
+    assert sizer.size == pytest.approx(2000, rel=0.01)
+
+
+def test_batches_stay_within_the_limits():
+    fast = BatchSizer("fast", 1000)
+    write(fast, 10**7, 20)
+    slow = BatchSizer("slow", 1000)
+    write(slow, 10, 20)
+
+    assert fast.size == 100000
+    assert slow.size == 100
+
+
+def test_rebatch_rechunks_to_the_current_size():
+    sizer = BatchSizer("test", 100)
+    batches = [Batch(COLUMNS, rows(30)) for _ in range(8)]
+
+    rebatched = list(sizer.rebatch(batches))
+
+    assert [len(batch.rows) for batch in rebatched] == [100, 100, 40]
+    assert [row for batch in rebatched for row in batch.rows] == [
+        row for batch in batches for row in batch.rows
+    ]
+    assert all(batch.columns == COLUMNS for batch in rebatched)
+
+
+def test_rebatch_leaves_batches_alone_when_not_adaptive(monkeypatch):
+    monkeypatch.setattr(core.sizing, "ADAPTIVE_BATCHES", False)
+    sizer = BatchSizer("test", 100)
+    batches = [Batch(COLUMNS, rows(30)) for _ in range(8)]
+
+    assert list(sizer.rebatch(batches)) == batches
+    sizer.record(rows(100), 100.0)
+    assert sizer.size == 100
+
+
+def test_reset_keeps_the_rates():
+    sizer = BatchSizer("test", 1000)
+    write(sizer, 20000, 10)
+
+    sizer.reset()
+
+    assert sizer.sizes == [] and sizer.rows == 0
+    assert sizer.size == pytest.approx(20000, abs=1)
+    assert sizer.rows_per_second == pytest.approx(20000)
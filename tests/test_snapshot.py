@@ -0,0 +1,45 @@
+import os
+
+from core.idmap import IdMap, IdMapStore
+from core.snapshot import SnapshotStore
+
+
+def publish(store: SnapshotStore, name: str) -> None:
+    staging = store.staging()
+    with open(os.path.join(staging, "crates.csv"), "w") as f:
+        f.write(f"id\n{name}\n")
+    store.publish(staging, name)
+
+
+def test_prune_keeps_id_maps(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    store = SnapshotStore("data/crates", keep=1)
+    publish(store, "a")
+
+    maps = IdMapStore("crates")
+    idmap = IdMap()
+    idmap.store(1, bytes(range(16)))
+    maps.save({"packages": idmap}, "load")
+
+    publish(store, "b")
+    publish(store, "c")
+
+    assert store.snapshots() == ["c"]
+    assert store.previous() is None
+    assert os.path.exists(maps.meta_path)
+
+    attached = IdMap()
+    maps.attach({"packages": attached}, "load")
+    assert attached.packed(1) == bytes(range(16))
+
+
+def test_legacy_id_maps_are_moved(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    os.makedirs("data/crates/idmap")
+    open("data/crates/idmap/meta.json", "w").close()
+
+    store = IdMapStore("crates")
+
+    assert store.root == "data/crates/.idmap"
+    assert os.path.exists("data/crates/.idmap/meta.json")
+    assert not os.path.exists("data/crates/idmap")
@@ -0,0 +1,255 @@
+import csv
+import gzip
+import io
+import json
+import os
+import tarfile
+from contextlib import contextmanager
+
+import pytest
+
+from core.transformer import IndexEntry, Output, Spool, Transformer
+
+CRATES = """id,name,homepage,repository
+1,serde,https://serde.rs,https://github.com/serde-rs/serde
+2,rand,,https://github.com/rust-random/rand
+
+3,tokio,https://tokio.rs,
+"""
+
+
+def names(id, name):
+    yield (id, name)
+
+
+def urls(id, homepage, repository):
+    for url in (homepage, repository):
+        if url:
+            yield (id, url)
+
+
+@pytest.fixture
+def transformer(tmp_path):
+    """a transformer with two outputs fanned out of one file, counting its opens"""
+    (tmp_path / "crates.csv").write_text(CRATES)
+    transformer = Transformer("crates")
+    transformer.input = str(tmp_path)
+    transformer.files = {"projects": "crates.csv"}
+    transformer.outputs = {
+        "names": Output("projects", ("id", "name"), ("import_id", "name"), names),
+        "urls": Output(
+            "projects", ("id", "homepage", "repository"), ("import_id", "url"), urls
+        ),
+    }
+
+    transformer.opened = []
+    open_file = transformer.open
+
+    @contextmanager
+    def counted(file_name):
+        transformer.opened.append(file_name)
+        with open_file(file_name) as f:
+            yield f
+
+    transformer.open = counted
+    return transformer
+
+
+def test_outputs_of_one_file_parse_it_once(transformer):
+    assert list(transformer.fanned_out("names")) == [
+        ("1", "serde"),
+        ("2", "rand"),
+        ("3", "tokio"),
+    ]
+    assert list(transformer.spools) == ["urls"]
+
+    assert list(transformer.fanned_out("urls")) == [
+        ("1", "https://serde.rs"),
+        ("1", "https://github.com/serde-rs/serde"),
+        ("2", "https://github.com/rust-random/rand"),
+        ("3", "https://tokio.rs"),
+    ]
+    assert transformer.opened == ["crates.csv"]
+    assert transformer.spools == {}
+
+
+def test_either_output_can_go_first(transformer):
+    urls = list(transformer.fanned_out("urls"))
+    names = list(transformer.fanned_out("names"))
+
+    assert len(urls) == 4 and len(names) == 3
+    assert transformer.opened == ["crates.csv"]
+
+
+def test_an_output_asked_for_again_is_read_again(transformer):
+    list(transformer.fanned_out("names"))
+    list(transformer.fanned_out("urls"))
+
+    assert len(list(transformer.fanned_out("names"))) == 3
+    assert transformer.opened == ["crates.csv", "crates.csv"]
+
+
+def test_a_file_read_partway_spools_nothing(transformer):
+    rows = transformer.fanned_out("names")
+    next(rows)
+    rows.close()
+
+    assert transformer.spools == {}
+
+
+def test_batches_of_an_output(transformer):
+    transformer.batch_size = 2
+
+    batches = list(transformer.batches("urls"))
+
+    assert [len(batch.rows) for batch in batches] == [2, 2]
+    assert all(batch.columns == ("import_id", "url") for batch in batches)
+
+
+def test_spool_spills_to_disk_and_replays_in_order():
+    spool = Spool(max_size=1024)
+    records = [(str(i), "x" * 10) for i in range(5000)]
+
+    spool.extend(records[:10])
+    spool.extend(records[10:])
+
+    assert spool.file._rolled
+    assert spool.count == len(records)
+    assert list(spool) == records
+    spool.close()
+
+
+def tarball(path, files: dict) -> None:
+    with tarfile.open(path, mode="w:gz") as tar:
+        for name, content in files.items():
+            info = tarfile.TarInfo(name)
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+
+
+@pytest.fixture
+def snapshot(tmp_path):
+    """a snapshot with crates.csv stored three ways, and versions.csv only tarred"""
+    root = tmp_path / "latest"
+    (root / "data").mkdir(parents=True)
+    (root / "data" / "crates.csv").write_text(CRATES)
+    with gzip.open(root / "crates.csv.gz", "wt") as f:
+        f.write(CRATES)
+    tarball(
+        root / "dump.tar.gz",
+        {
+            "2024-01-01/data/crates.csv": CRATES.encode(),
+            "2024-01-01/data/versions.csv": b"id,num\n1,1.0.0\n",
+        },
+    )
+    transformer = Transformer("crates")
+    transformer.input = str(root)
+    transformer.files = {"projects": "crates.csv", "versions": "versions.csv"}
+    return transformer
+
+
+def test_index_prefers_plain_then_compressed_then_tarred(snapshot):
+    index = snapshot.build_index()
+
+    assert index["crates.csv"].path.endswith("data/crates.csv")
+    assert index["versions.csv"].member == "2024-01-01/data/versions.csv"
+    assert index["versions.csv"].size == len(b"id,num\n1,1.0.0\n")
+
+    os.remove(os.path.join(snapshot.input, "data", "crates.csv"))
+    snapshot.file_index = None
+    assert snapshot.finder("crates.csv").endswith("crates.csv.gz")
+
+    os.remove(os.path.join(snapshot.input, "crates.csv.gz"))
+    snapshot.file_index = None
+    assert snapshot.resolve("projects").member == "2024-01-01/data/crates.csv"
+
+
+def test_index_is_built_once(snapshot, monkeypatch):
+    snapshot.build_index()
+    walks = []
+    monkeypatch.setattr(snapshot, "index_files", lambda root: walks.append(root))
+
+    snapshot.resolve("projects")
+    snapshot.resolve("versions")
+
+    assert walks == []
+
+
+def test_tarball_listing_is_cached_until_it_changes(snapshot):
+    path = os.path.join(snapshot.input, "dump.tar.gz")
+    assert "versions.csv" in snapshot.tarball_members(path)
+    assert os.path.exists(f"{path}.index.json")
+
+    # a cached listing is used as is, without reading the tarball
+    with open(f"{path}.index.json") as f:
+        cached = json.load(f)
+    cached["members"]["cached.csv"] = ["cached.csv", 0]
+    with open(f"{path}.index.json", "w") as f:
+        json.dump(cached, f)
+    assert "cached.csv" in snapshot.tarball_members(path)
+
+    tarball(path, {"2024-01-02/data/versions.csv": b"id,num\n"})
+    os.utime(path, (0, 0))
+    assert list(snapshot.tarball_members(path)) == ["versions.csv"]
+
+
+def test_index_is_rebuilt_when_a_file_goes(snapshot):
+    snapshot.build_index()
+
+    os.remove(os.path.join(snapshot.input, "data", "crates.csv"))
+
+    assert snapshot.finder("crates.csv").endswith("crates.csv.gz")
+    with pytest.raises(FileNotFoundError):
+        snapshot.resolve("dependencies.csv")
+
+
+def test_manifest_and_sizes(snapshot):
+    assert snapshot.manifest() == {"crates.csv", "versions.csv"}
+    assert snapshot.sizes() == {
+        "projects": len(CRATES),
+        "versions": len(b"id,num\n1,1.0.0\n"),
+    }
+
+
+def rows_of(transformer: Transformer) -> list:
+    with transformer.open("crates.csv") as f:
+        return list(csv.reader(f))
+
+
+@pytest.mark.parametrize("stored", ["plain", "gz", "zst", "tarball"])
+def test_open_reads_the_file_however_it_is_stored(tmp_path, stored):
+    text = CRATES + "4,café,,\n"
+    if stored == "plain":
+        (tmp_path / "crates.csv").write_text(text, encoding="utf-8")
+    elif stored == "gz":
+        with gzip.open(tmp_path / "crates.csv.gz", "wt", encoding="utf-8") as f:
+            f.write(text)
+    elif stored == "zst":
+        zstandard = pytest.importorskip("zstandard")
+        compressed = zstandard.ZstdCompressor().compress(text.encode())
+        (tmp_path / "crates.csv.zst").write_bytes(compressed)
+    else:
+        tarball(
+            tmp_path / "dump.tar.gz",
+            {
+                "2024-01-01/data/other.csv": b"x\n" * 1000,
+                "2024-01-01/data/crates.csv": text.encode(),
+            },
+        )
+    transformer = Transformer("crates")
+    transformer.input = str(tmp_path)
+
+    assert rows_of(transformer) == list(csv.reader(io.StringIO(text)))
+
+
+def test_open_fails_when_a_tarred_file_is_gone(tmp_path):
+    path = tmp_path / "dump.tar.gz"
+    tarball(path, {"data/other.csv": CRATES.encode()})
+    stat = os.stat(path)
+    entry = IndexEntry(
+        str(path), len(CRATES), (stat.st_size, stat.st_mtime), "data/crates.csv"
+    )
+
+    with pytest.raises(FileNotFoundError):
+        with Transformer("crates").open_entry(entry):
+            pass